@@ -44,11 +44,14 @@ except ImportError:
 
 from PYME.IO import clusterIO
 from PYME.IO import PZFFormat
+from PYME.IO import eventFormat
+from PYME import config
 
 import numpy as np
 import random
 
 import json
+import dispatch
 
 import logging
 logger = logging.getLogger(__name__)
@@ -59,6 +62,11 @@ class EventLogger:
         #self.scope = scope
           
         self._events = []
+        
+        #events which have not yet been written to the binary event log (see `flush`)
+        self._unsent = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
     
     def logEvent(self, eventName, eventDescr = '', timestamp=None):
         if eventName == 'StartAq' and eventDescr == '':
@@ -66,11 +74,32 @@ class EventLogger:
 
         if timestamp is None:
             timestamp = sp.timeFcn()
-            
-        self._events.append((eventName, eventDescr, timestamp))
+        
+        with self._lock:
+            self._events.append((eventName, eventDescr, timestamp))
+            self._unsent.append((eventName, eventDescr, timestamp))
         
     def to_JSON(self):
-        return json.dumps(self._events)
+        with self._lock:
+            return json.dumps(self._events)
+    
+    def flush(self):
+        """
+        Append any events logged since the last flush to the series binary event log (see `PYME.IO.eventFormat`).
+        """
+        #only one flush at a time, so that blocks are appended in the order the events were logged
+        with self._flush_lock:
+            with self._lock:
+                events, self._unsent = self._unsent, []
+            
+            if len(events) > 0:
+                try:
+                    self.spooler._append_events(eventFormat.dumps(events))
+                except:
+                    #put the events back so that we try again on the next flush
+                    with self._lock:
+                        self._unsent = events + self._unsent
+                    raise
           
 
 CLUSTERID=''  
@@ -99,6 +128,39 @@ def exists(seriesName):
 NUM_POLL_THREADS = 10
 QUEUE_MAX_SIZE = 200 # ~10k frames
 
+#the maximum amount of (uncompressed) frame data to hold waiting to be sent, in bytes. When this is reached, the camera
+#side will block until data has been sent (and potentially drop frames).
+QUEUE_MAX_BYTES = float(config.get('httpspooler-max_queue_mb', 2000))*1e6
+
+#Batches are sized so that we send one about every BATCH_INTERVAL seconds at the current frame rate (subject to the
+#limits below). Larger batches amortise connection overhead, smaller batches spread data more evenly across servers.
+BATCH_INTERVAL = float(config.get('httpspooler-batch_interval', 0.25))
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 500
+MAX_BATCH_BYTES = 100e6
+
+#queue fill fraction at which we start warning that frames are at risk of being dropped (we warn again each time the
+#queue fills by a further half of this)
+BACKPRESSURE_WARN_LEVEL = 0.5
+
+#how often (in s) events are appended to the binary event log while spooling
+EVENT_FLUSH_INTERVAL = float(config.get('httpspooler-event_flush_interval', 1))
+
+_encode_pool = None
+_encode_pool_lock = threading.Lock()
+
+def _get_encode_pool():
+    """Get the (lazily created and shared between spoolers) thread pool used for PZF encoding"""
+    global _encode_pool
+    
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            from multiprocessing.pool import ThreadPool
+            import multiprocessing
+            _encode_pool = ThreadPool(int(config.get('httpspooler-num_encode_threads', multiprocessing.cpu_count())))
+            
+        return _encode_pool
+
 defaultCompSettings = {
     'compression' : PZFFormat.DATA_COMP_HUFFCODE,
     'quantization' : PZFFormat.DATA_QUANT_NONE,
@@ -123,16 +185,35 @@ class Spooler(sp.Spooler):
         self.clusterFilter = kwargs.get('serverfilter', CLUSTERID)
         self._buffer = []
         
-        self.buflen = 50
+        self.buflen = MIN_BATCH_SIZE
         
         self._postQueue = Queue.Queue(QUEUE_MAX_SIZE)
         self._dPoll = True
+        self._stopping = False
         self._lock = threading.Lock()
         
         self._last_thread_exception = None
 
         self._numThreadsProcessing = 0
         
+        #back-pressure accounting - bytes of frame data which have been handed to us but not yet sent
+        self._queued_bytes = 0
+        self._queued_frames = 0
+        self._space_available = threading.Condition(self._lock)
+        self._frame_rate = 0
+        self._frame_interval = None
+        self._frame_bytes = 0
+        self._send_rate = 0
+        self._sent_bytes = 0
+        self._send_rate_t = time.time()
+        self._last_frame_t = None
+        self._warned_level = 0
+        self.blocked_time = 0
+        
+        #sent (from the camera / frame wrangler thread) with the current queue status (see `queue_status`) when the
+        #queue is filling up
+        self.onBackPressure = dispatch.Signal()
+        
         self._pollThreads = []
         for i in range(NUM_POLL_THREADS):
             pt = threading.Thread(target=self._queuePoll)
@@ -142,6 +223,8 @@ class Spooler(sp.Spooler):
         
         self.md = MetaDataHandler.NestedClassMDHandler()
         self.evtLogger = EventLogger(self)
+        self._event_flush_done = threading.Event()
+        self._event_flush_thread = None
         
         self.sequenceID = genSequenceID()
         self.md['imageID'] = self.sequenceID  
@@ -169,41 +252,97 @@ class Spooler(sp.Spooler):
             assert(scale >=.001)
             assert(scale <= 100)
             
+    def _encode_frame(self, frame_info):
+        imNum, frame = frame_info
+        if self._aggregate_h5:
+            fn = '/'.join(['__aggregate_h5', self.seriesName, 'frame%05d.pzf' % imNum])
+        else:
+            fn = '/'.join([self.seriesName, 'frame%05d.pzf' % imNum])
+            
+        return fn, PZFFormat.dumps(frame, sequenceID=self.sequenceID, frameNum = imNum, **self.compSettings)
+    
     def _queuePoll(self):
-        while self._dPoll:
+        #keep going until we are told to stop *and* we have sent everything
+        while self._dPoll or not self._postQueue.empty():
             try:
-                data = self._postQueue.get_nowait()
-
-                with self._lock:
-                    self._numThreadsProcessing += 1
+                data = self._postQueue.get(timeout=.1)
+            except Queue.Empty:
+                if self._stopping:
+                    #StopSpool has flushed the last of the data
+                    break
+                continue
 
-                try:
-                    files = []
-                    for imNum, frame in data:
-                        if self._aggregate_h5:
-                            fn = '/'.join(['__aggregate_h5', self.seriesName, 'frame%05d.pzf' % imNum])
-                        else:
-                            fn = '/'.join([self.seriesName, 'frame%05d.pzf' % imNum])
-                            
-                        pzf = PZFFormat.dumps(frame, sequenceID=self.sequenceID, frameNum = imNum, **self.compSettings)
-
-                        files.append((fn, pzf))
-
-                    if len(files) > 0:
-                        clusterIO.put_files(files, serverfilter=self.clusterFilter)
-                        
-                except Exception as e:
-                    self._last_thread_exception = e
-                    logging.exception('Exception whilst putting files')
-                    raise
-                finally:
-                    with self._lock:
-                        self._numThreadsProcessing -= 1
+            nbytes = sum([f.nbytes for i, f in data])
+            
+            with self._lock:
+                self._numThreadsProcessing += 1
 
-                time.sleep(.01)
-                #print 't', len(data)
-            except Queue.Empty:
-                time.sleep(.01)
+            try:
+                #encode the frames in parallel
+                files = _get_encode_pool().map(self._encode_frame, data)
+                
+                if len(files) > 0:
+                    clusterIO.put_files(files, serverfilter=self.clusterFilter)
+                
+            except Exception as e:
+                self._last_thread_exception = e
+                logging.exception('Exception whilst putting files')
+                raise
+            finally:
+                with self._lock:
+                    self._numThreadsProcessing -= 1
+                    self._queued_bytes -= nbytes
+                    self._queued_frames -= len(data)
+                    self._space_available.notify_all()
+                    
+                    #measure our throughput over intervals of at least 0.5 s
+                    self._sent_bytes += nbytes
+                    t = time.time()
+                    if (t - self._send_rate_t) > 0.5:
+                        self._send_rate = self._sent_bytes/(t - self._send_rate_t)
+                        self._sent_bytes = 0
+                        self._send_rate_t = t
+                
+    def queue_status(self):
+        """
+        The status of the queue of frames waiting to be sent.
+
+        Returns
+        -------
+        dict with keys:
+            queued_frames, queued_bytes : the number of frames (and their size) waiting to be sent
+            max_bytes : the size at which the queue is full, and the camera side will block
+            fill_fraction : queued_bytes/max_bytes
+            frame_rate : the rate at which frames are arriving [frames/s]
+            send_rate : the rate at which we are sending data [bytes/s]. If the queue is filling, this is as fast as we
+                can send.
+            time_to_full : the time until the queue is full (and we start to block / lose frames) at the current
+                arrival and send rates [s]. Infinite if we are keeping up.
+            blocked_time : the total time the camera side has been blocked waiting for the queue [s]
+        """
+        with self._lock:
+            queued_bytes = self._queued_bytes
+            status = {'queued_frames': self._queued_frames, 'queued_bytes': queued_bytes, 'max_bytes': QUEUE_MAX_BYTES,
+                      'fill_fraction': float(queued_bytes)/QUEUE_MAX_BYTES, 'frame_rate': self._frame_rate,
+                      'send_rate': self._send_rate, 'blocked_time': self.blocked_time}
+            
+        in_rate = self._frame_rate*self._frame_bytes if self._last_frame_t is not None else 0
+        if in_rate > status['send_rate']:
+            status['time_to_full'] = max(QUEUE_MAX_BYTES - queued_bytes, 0)/(in_rate - status['send_rate'])
+        else:
+            status['time_to_full'] = np.inf
+            
+        return status
+    
+    def _check_backpressure(self):
+        fill = float(self._queued_bytes)/QUEUE_MAX_BYTES
+        level = int(fill/BACKPRESSURE_WARN_LEVEL*2)/2.0 # in steps of half the warning level
+        if (fill >= BACKPRESSURE_WARN_LEVEL) and (level > self._warned_level):
+            status = self.queue_status()
+            logger.warning('Spooling queue %d%% full, frames at risk of being dropped in %3.1f s' % (100*fill, status['time_to_full']))
+            self.onBackPressure.send(self, status=status)
+            
+        self._warned_level = level if (fill >= BACKPRESSURE_WARN_LEVEL) else 0
                 
     def finished(self):
         if not self._last_thread_exception is None:
@@ -211,7 +350,10 @@ class Spooler(sp.Spooler):
             logging.error('An exception occurred in one of the spooling threads')
             raise RuntimeError('An exception occurred in one of the spooling threads')
         else:
-            return self._postQueue.empty() and (self._numThreadsProcessing == 0)
+            #NB - check the count of queued frames rather than the queue itself, as a batch has left the queue before
+            #the thread which took it starts processing it
+            with self._lock:
+                return (self._queued_frames == 0) and (self._numThreadsProcessing == 0)
 
         
     def getURL(self):
@@ -227,29 +369,59 @@ class Spooler(sp.Spooler):
             clusterIO.put_file('__aggregate_h5/' + self.seriesName + '/metadata.json', self.md.to_JSON().encode(), serverfilter=self.clusterFilter)
         else:
             clusterIO.put_file(self.seriesName + '/metadata.json', self.md.to_JSON().encode(), serverfilter=self.clusterFilter)
+            
+            #write events to the binary event log as we go, so that they can be used for live analysis
+            self._event_flush_thread = threading.Thread(target=self._eventPoll)
+            self._event_flush_thread.daemon = True
+            self._event_flush_thread.start()
+            
+    def _eventPoll(self):
+        while not self._event_flush_done.wait(EVENT_FLUSH_INTERVAL):
+            try:
+                self.evtLogger.flush()
+            except Exception:
+                logger.exception('Error writing events, will retry')
+                
+    def _append_events(self, data):
+        from PYME.IO import clusterResults #defer import as this pulls in pandas
+        
+        #the log is appended to using the data server text aggregation endpoint, which keeps all appends on one server
+        uri = clusterResults.pickResultsServer('__aggregate_txt/' + self.seriesName + '/events.bin', self.clusterFilter)
+        clusterResults.fileFormattedResults(uri, data)
     
     def StopSpool(self):
-        self._dPoll = False
         sp.Spooler.StopSpool(self)
         
+        #let the spooling threads finish sending anything which is still queued, then exit
+        self._stopping = True
+        self._dPoll = False
+        
         logger.debug('Stopping spooling %s' % self.seriesName)
         
         if self._aggregate_h5:
             clusterIO.put_file('__aggregate_h5/' + self.seriesName + '/final_metadata.json', self.md.to_JSON().encode(),
                                serverfilter=self.clusterFilter)
     
-            #save the acquisition events as json - TODO - consider a binary format as the events
-            #can be quite numerous
+            #save the acquisition events (these end up in the Events table of the .h5 file)
             clusterIO.put_file('__aggregate_h5/' + self.seriesName + '/events.json', self.evtLogger.to_JSON().encode(),
                                serverfilter=self.clusterFilter)
         
         else:
             clusterIO.put_file(self.seriesName + '/final_metadata.json', self.md.to_JSON().encode(), serverfilter=self.clusterFilter)
             
-            #save the acquisition events as json - TODO - consider a binary format as the events
-            #can be quite numerous
+            #write any remaining events to the binary event log
+            self._event_flush_done.set()
+            if self._event_flush_thread is not None:
+                self._event_flush_thread.join()
+            self.evtLogger.flush()
+            
+            #also save the acquisition events as json. This marks the series as complete, and is what older versions
+            #of PYME read.
             clusterIO.put_file(self.seriesName + '/events.json', self.evtLogger.to_JSON().encode(), serverfilter=self.clusterFilter)
         
+        if self.blocked_time > 0:
+            logger.error('Spooling could not keep up - the camera was blocked for a total of %3.2f s' % self.blocked_time)
+        
         
     def OnFrame(self, sender, frameData, **kwargs):
         # NOTE: copy is now performed in frameWrangler, so we don't need to worry about it here
@@ -260,6 +432,17 @@ class Spooler(sp.Spooler):
 
         #print len(self.buffer)
         t = time.time()
+        
+        #track the frame rate and adapt our batch size to it
+        if self._last_frame_t is not None:
+            dt = max(t - self._last_frame_t, 1e-6)
+            self._frame_interval = dt if self._frame_interval is None else (0.95*self._frame_interval + 0.05*dt)
+            self._frame_rate = 1.0/self._frame_interval
+        self._last_frame_t = t
+        self._frame_bytes = frameData.nbytes
+        
+        self.buflen = int(np.clip(self._frame_rate*BATCH_INTERVAL, MIN_BATCH_SIZE, MAX_BATCH_SIZE))
+        self.buflen = max(min(self.buflen, int(MAX_BATCH_BYTES/frameData.nbytes)), 1)
 
         #purge buffer if more than  self.buflen frames have been added, or more than 1 second elapsed
         if (len(self._buffer) >= self.buflen) or ((t - self._lastFrameTime) > 1):
@@ -270,12 +453,31 @@ class Spooler(sp.Spooler):
         
     def cleanup(self):
         self._dPoll = False
+        self._stopping = True
+        self._event_flush_done.set()
       
     def FlushBuffer(self):
-      self._postQueue.put(self._buffer)
-      self._buffer = []
-     
-
-
-
-   
+        if len(self._buffer) == 0:
+            return
+        
+        nbytes = sum([f.nbytes for i, f in self._buffer])
+        
+        with self._lock:
+            #apply back-pressure - wait for space in the queue
+            if (self._queued_bytes > 0) and (self._queued_bytes + nbytes > QUEUE_MAX_BYTES):
+                t = time.time()
+                logger.error('Spooling queue full, blocking until data has been sent - frames are likely to be lost')
+                while (self._queued_bytes > 0) and (self._queued_bytes + nbytes > QUEUE_MAX_BYTES):
+                    self._space_available.wait(.1)
+                    if self._last_thread_exception is not None:
+                        break
+                    
+                self.blocked_time += time.time() - t
+                
+            self._queued_bytes += nbytes
+            self._queued_frames += len(self._buffer)
+        
+        self._postQueue.put(self._buffer)
+        self._buffer = []
+        
+        self._check_backpressure()
@@ -27,8 +27,12 @@ class Tracker(object):
         #this will be changed to reflect linkages
         self.clumpIndex = np.arange(len(t))
         
-        self.xvsByT = [xvs[:,t==i] for i in xrange(t.max()+1)]
-        self.indicesByT = [self.objIndex[t==i] for i in xrange(t.max()+1)]
+        #split objects by frame. Sort once rather than comparing every object with each frame number (which is
+        #quadratic in the length of the series)
+        order = np.argsort(t, kind='mergesort')
+        bounds = np.searchsorted(t[order], np.arange(t.max() + 2))
+        self.indicesByT = np.split(self.objIndex[order], bounds)[1:-1]
+        self.xvsByT = [xvs[:, ind] for ind in self.indicesByT]
 
     def calcLinkageMatrix(self, i, j, manualLinkages = []):
         """Compare this frame (i) with another frame (j) """
@@ -142,11 +146,200 @@ class Tracker(object):
                     #we are not a new object
                     self.clumpIndex[int(n)] = self.clumpIndex[int(lji)]
                     allLinks[allLinks[:,1] == lji, 0] = 0
-                    
+
+    def linkFrames(self, i, j):
+        """Link objects in this frame (i) to those in another frame (j), updating clumpIndex"""
+        self.updateTrack(i, self.calcLinkages(i, j))
+
+
+class SparseTracker(Tracker):
+    """
+    A tracker which gives the same linkages as `Tracker`, but which only considers pairs of objects closer than
+    `maxLinkageDistance` (found with a KD-tree) rather than computing a dense distance matrix between all objects in
+    each pair of frames. Linkage probabilities are kept in sparse (coordinate) form, and linkages are assigned in
+    vectorised batches, making tracking of dense, long series practical.
+
+    The linkage probabilities of more distant pairs are vanishingly small (they fall off as exp(-d/r0)) so ignoring
+    them does not change the result, provided `maxLinkageDistance` is a reasonable multiple of `r0`.
+    """
+    def __init__(self, t, xvs, pNew=0.2, r0=500, linkageCuttoffProb=0.1, maxLinkageDistance=None):
+        """
+
+        Parameters
+        ----------
+        t, xvs, pNew, r0, linkageCuttoffProb : see `Tracker`
+        maxLinkageDistance : float
+            the distance beyond which objects are never linked. Defaults to r0*log(1e6), the distance at which the
+            (un-normalised) probability of a linkage drops below 1e-6.
+        """
+        Tracker.__init__(self, t, xvs, pNew=pNew, r0=r0, linkageCuttoffProb=linkageCuttoffProb)
+        self.maxLinkageDistance = maxLinkageDistance
+        
+        self._trees = {}
+
+    def _getTree(self, i, keep):
+        try:
+            return self._trees[i]
+        except KeyError:
+            tree = spatial.cKDTree(self.xvsByT[i].T)
+            
+            #we typically step through the frames in order - only keep the trees we are likely to use again
+            for k in list(self._trees.keys()):
+                if not k in keep:
+                    self._trees.pop(k)
+            
+            self._trees[i] = tree
+            return tree
+
+    def calcLinkageMatrix(self, i, j, manualLinkages=[]):
+        """
+        Compare this frame (i) with another frame (j).
+
+        Returns
+        -------
+        lMatch : scipy.sparse.coo_matrix
+            the linkage probabilities, with the same layout as the dense matrix returned by `Tracker.calcLinkageMatrix`
+            (a row for each object in frame j, followed by a row for the probability that the object is new, and a
+            column for each object in frame i). Only pairs closer than `maxLinkageDistance` are stored.
+        jIndices : ndarray
+            the object indices corresponding to the rows
+        """
+        from scipy import sparse
+        
+        if (i >= len(self.xvsByT)) or (len(self.indicesByT[i]) == 0) or (len(self.indicesByT[j]) == 0):
+            return sparse.coo_matrix((0, 0)), np.empty([0])
+        
+        nI, nJ = len(self.indicesByT[i]), len(self.indicesByT[j])
+        
+        rMax = self.maxLinkageDistance
+        if rMax is None:
+            rMax = self.r0*np.log(1e6)
+        
+        #find pairs which are close enough to be linked
+        pairs = self._getTree(i, (i, j)).sparse_distance_matrix(self._getTree(j, (i, j)), rMax, output_type='ndarray')
+        iInd, jInd = pairs['i'], pairs['j']
+        
+        #calculate probablility of a certain distance (given a mean jump length r0)
+        pMatch = np.exp(-pairs['v']/self.r0)
+        
+        #the probability that the object is new in this frame
+        pNew = self.pNew*np.ones(nI)
+        
+        #Set the probabilities for manually specified linkages:
+        for iLink, jLink in manualLinkages:
+            keep = (iInd != iLink) & (jInd != jLink)
+            iInd, jInd, pMatch = np.append(iInd[keep], iLink), np.append(jInd[keep], jLink), np.append(pMatch[keep], 1)
+            pNew[iLink] = 0
+        
+        #of all possible matches for a given object, what are the relative probabilities
+        norm = np.bincount(iInd, pMatch, minlength=nI) + pNew
+        lMatch = pMatch/norm[iInd]
+        lNew = pNew/norm
+        
+        #we don't want 2 objects in this frame to match to one object in frame j
+        #reduce likelihood of object according to the relative chance of another
+        #object in this frame assigning to the same object (this does not apply to new objects)
+        rowMax = np.zeros(nJ)
+        np.maximum.at(rowMax, jInd, lMatch)
+        lAdj = lMatch*(lMatch/np.maximum(rowMax[jInd], 1e-300))**2
+        
+        #now repeat the normalisation above to find new relative probabilities
+        norm = np.bincount(iInd, lAdj, minlength=nI) + lNew
+        
+        rows = np.concatenate([jInd, nJ*np.ones(nI, 'i')])
+        cols = np.concatenate([iInd, np.arange(nI)])
+        vals = np.concatenate([lAdj/norm[iInd], lNew/norm])
+        
+        return sparse.coo_matrix((vals, (rows, cols)), shape=(nJ + 1, nI)), self.indicesByT[j]
     
+    def _getCandidates(self, lMatch, jIndices):
+        """
+        Vectorised equivalent of `Tracker.getLinkageCandidates`.
 
+        Returns
+        -------
+        iInd, absJ, p : ndarray
+            flattened candidate linkages, sorted by object in frame i and then by decreasing probability. iInd is the
+            index of the object within frame i, absJ the object it could link to (-1 for a new object).
+        """
+        if lMatch.nnz == 0:
+            return np.empty(0, 'i'), np.empty(0, 'i'), np.empty(0)
+        
+        rows, cols, vals = lMatch.row, lMatch.col, lMatch.data
+        order = np.lexsort((-vals, cols))
+        rows, cols, vals = rows[order], cols[order], vals[order]
+        
+        #keep candidates above the cutoff, or the most likely candidate if none are
+        sig = vals > self.linkageCuttoffProb
+        first = np.ones(len(cols), 'bool')
+        first[1:] = cols[1:] != cols[:-1]
+        anySig = np.bincount(cols, sig, minlength=lMatch.shape[1]) > 0
+        keep = sig | (first & ~anySig[cols])
+        
+        rows, cols, vals = rows[keep], cols[keep], vals[keep]
+        
+        #find the real object numbers which correspond to our linkages. If we matched to a new event, replace by -1
+        absJ = -np.ones(len(rows), 'i')
+        notNew = rows < len(jIndices)
+        absJ[notNew] = jIndices[rows[notNew]]
+        
+        return cols, absJ, vals
+    
+    def getLinkageCandidates(self, lMatch, jIndices):
+        iInd, absJ, p = self._getCandidates(lMatch, jIndices)
+        
+        splits = np.flatnonzero(np.diff(iInd)) + 1
+        return dict([(int(iS[0]), (jS, pS)) for iS, jS, pS in zip(np.split(iInd, splits), np.split(absJ, splits),
+                                                                  np.split(p, splits)) if len(iS) > 0])
+    
+    def _assign(self, i, iInd, absJ, p):
+        """
+        Assign linkages, most probable first, with each object linking to at most one object in the other frame and
+        vice versa (the same greedy assignment as `Tracker.updateTrack`).
+        
+        Rather than assigning one linkage at a time, we assign (in a vectorised batch) every linkage which is the most
+        probable remaining linkage of both of the objects it links, discard the linkages those objects are involved in,
+        and repeat.
+        """
+        if i >= len(self.indicesByT):
+            return
+            
+        n = self.indicesByT[i][iInd]
         
+        #sort so that the highest probability comes first
+        order = np.argsort(-p, kind='mergesort')
+        n, absJ, p = n[order], absJ[order], p[order]
         
+        #linkages with zero probability are never made
+        nz = p > 0
+        n, absJ = n[nz], absJ[nz]
+        
+        while len(n) > 0:
+            #as we are sorted by probability, the first occurrence of each object is its most probable linkage
+            bestForN = np.zeros(len(n), 'bool')
+            bestForN[np.unique(n, return_index=True)[1]] = True
+            
+            bestForJ = absJ == -1 #new objects don't compete with each other
+            bestForJ[np.unique(absJ, return_index=True)[1]] = True
+            
+            accept = bestForN & bestForJ
+            
+            linked = accept & (absJ != -1)
+            self.clumpIndex[n[linked]] = self.clumpIndex[absJ[linked]]
+            
+            remaining = ~(np.in1d(n, n[accept]) | np.in1d(absJ, absJ[linked]))
+            n, absJ = n[remaining], absJ[remaining]
     
+    def updateTrack(self, i, linkages):
+        if len(linkages) == 0:
+            return
+        
+        iInd = np.concatenate([k*np.ones(len(links[0]), 'i') for k, links in linkages.items()])
+        absJ = np.concatenate([np.asarray(links[0]) for links in linkages.values()])
+        p = np.concatenate([np.asarray(links[1]) for links in linkages.values()])
+        
+        self._assign(i, iInd, absJ, p)
     
-    
\ No newline at end of file
+    def linkFrames(self, i, j):
+        """Link objects in this frame (i) to those in another frame (j), updating clumpIndex"""
+        self._assign(i, *self._getCandidates(*self.calcLinkageMatrix(i, j)))
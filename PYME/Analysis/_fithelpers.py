@@ -96,6 +96,119 @@ def FitModelWeightedJac_(modelFcn, startParameters, data, sigmas, *args):
     return optimize.leastsq(weightedMissfitF, startParameters, (modelFcn, data.ravel(), (1.0/sigmas).astype('d').ravel()) + args, Dfun = weightedJacF, full_output=1, col_deriv = 0, epsfcn=EPS_FCN)
 
 
+def FitModelWeightedBatch(modelFcn, startParameters, data, sigmas, *args, **kwargs):
+    """
+    Vectorised, weighted Levenberg-Marquardt fitting of the same model to a stack of independent ROIs.
+
+    This is the batched equivalent of `FitModelWeighted`, but rather than calling `scipy.optimize.leastsq` once per ROI
+    (with python overhead for every function evaluation), the Levenberg-Marquardt iterations are performed for all ROIs
+    at once using numpy array operations.
+
+    Parameters
+    ----------
+    modelFcn : function
+        batched model function, called as `modelFcn(p, *args)` where `p` is an [N, P] array of parameters. Must return
+        an array of shape [N, ...] with the same number of elements per ROI as `data`. The model function must also
+        have a `D` attribute giving the jacobian (called with the same arguments and returning an [N, ..., P] array).
+    startParameters : array_like
+        [N, P] array of start parameters
+    data : ndarray
+        [N, ...] array of data, one ROI per entry in the first dimension
+    sigmas : ndarray
+        [N, ...] array of per-pixel errors. Pixels with an infinite sigma get zero weight, allowing ROIs of different
+        sizes to be fitted together by padding.
+    args :
+        additional arguments to pass to modelFcn
+    maxIter : int, optional
+        maximum number of iterations (default 100)
+    ftol : float, optional
+        relative reduction in chi-squared at which an ROI is considered to have converged (default 1.49e-8, as for
+        leastsq)
+
+    Returns
+    -------
+    res : ndarray
+        [N, P] array of fitted parameters
+    cov_x : ndarray
+        [N, P, P] array of (unscaled) covariance matrices, as returned by leastsq
+    fvec : ndarray
+        [N, M] array of weighted residuals at the solution
+    resCode : ndarray
+        [N] array of result codes. As for leastsq, 1 indicates convergence and 5 that the maximum number of iterations
+        was reached.
+
+    """
+    maxIter = kwargs.get('maxIter', 100)
+    ftol = kwargs.get('ftol', 1.49e-8)
+    
+    p = np.array(startParameters, dtype='d')
+    n_rois, n_params = p.shape
+    
+    data = np.asarray(data, dtype='d').reshape(n_rois, -1)
+    weights = (1.0/np.asarray(sigmas, dtype='d')).reshape(n_rois, -1)
+    
+    def _eval(p, idx):
+        args_ = [a[idx] for a in args]
+        r = (data[idx] - modelFcn(p, *args_).reshape(len(idx), -1))*weights[idx]
+        return r, (r*r).sum(1)
+    
+    def _jac(p, idx):
+        args_ = [a[idx] for a in args]
+        return -modelFcn.D(p, *args_).reshape(len(idx), -1, n_params)*weights[idx][:,:,None]
+    
+    fvec, chi2 = _eval(p, np.arange(n_rois))
+    lam = 1e-3*np.ones(n_rois)
+    resCode = 5*np.ones(n_rois, 'i')
+    active = np.arange(n_rois)
+    diag = np.arange(n_params)
+    
+    for i in range(maxIter):
+        if len(active) == 0:
+            break
+        
+        J = _jac(p[active], active)
+        JtJ = np.einsum('nmp,nmq->npq', J, J)
+        Jtr = np.einsum('nmp,nm->np', J, fvec[active])
+        
+        #Marquardt scaling of the damping term
+        A = JtJ.copy()
+        A[:, diag, diag] += lam[active][:, None]*np.maximum(JtJ[:, diag, diag], 1e-12)
+        
+        try:
+            delta = np.linalg.solve(A, -Jtr[:,:,None])[:,:,0]
+        except np.linalg.LinAlgError:
+            delta = -np.einsum('npq,nq->np', np.linalg.pinv(A), Jtr)
+        
+        p_new = p[active] + delta
+        fvec_new, chi2_new = _eval(p_new, active)
+        
+        improved = chi2_new < chi2[active]
+        
+        converged = improved & ((chi2[active] - chi2_new) <= ftol*chi2[active])
+        converged |= (~improved) & (lam[active] > 1e10)
+        
+        #accept steps which improve chi2 (and reduce damping), otherwise increase the damping and try again
+        acc = active[improved]
+        p[acc] = p_new[improved]
+        fvec[acc] = fvec_new[improved]
+        chi2[acc] = chi2_new[improved]
+        lam[acc] *= 0.1
+        lam[active[~improved]] *= 10.
+        
+        resCode[active[converged]] = 1
+        active = active[~converged]
+    
+    #estimate covariance from the jacobian at the solution
+    J = _jac(p, np.arange(n_rois))
+    JtJ = np.einsum('nmp,nmq->npq', J, J)
+    try:
+        cov_x = np.linalg.inv(JtJ)
+    except np.linalg.LinAlgError:
+        cov_x = np.linalg.pinv(JtJ)
+    
+    return p, cov_x, fvec, resCode
+
+
 def FitWeightedMisfitFcn(misfitFcn, startParameters, data, sigmas, *args):
     return optimize.leastsq(misfitFcn, np.array(startParameters), (np.array(data, order='F'), np.array(1.0/sigmas, order='F')) + args, full_output=1)
 
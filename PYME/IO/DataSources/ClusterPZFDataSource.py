@@ -31,6 +31,8 @@ from .BaseDataSource import BaseDataSource
 #import cPickle as pickle
 import time
 import json
+import threading
+import collections
 #import pandas as pd
 import numpy as np
 SHAPE_LIFESPAN = 5
@@ -38,10 +40,45 @@ SHAPE_LIFESPAN = 5
 from PYME.IO import clusterIO
 from PYME.IO import PZFFormat
 from PYME.IO import MetaDataHandler
+from PYME import config
+
+import logging
+logger = logging.getLogger(__name__)
+
+#number of consecutive accesses with the same stride before we start prefetching
+MIN_RUN_LENGTH = 2
+
+_prefetch_pool = None
+_prefetch_pool_lock = threading.Lock()
+
+def _get_prefetch_pool():
+    """Get the (lazily created and shared between data sources) thread pool used for prefetching"""
+    global _prefetch_pool
+    
+    with _prefetch_pool_lock:
+        if _prefetch_pool is None:
+            from multiprocessing.pool import ThreadPool
+            _prefetch_pool = ThreadPool(int(config.get('datasource-cluster_prefetch_threads', 4)))
+            
+        return _prefetch_pool
+    
 
 class DataSource(BaseDataSource):
     moduleName = 'ClusterPZFDataSource'
-    def __init__(self, url, queue=None):
+    def __init__(self, url, queue=None, prefetch=None):
+        """
+        
+        Parameters
+        ----------
+        url : str
+            the series url, in the form `PYME-CLUSTER://<serverfilter>/<path/to/series>`
+        queue :
+            unused, for compatibility with other data sources
+        prefetch : int
+            if > 0, and frames are being accessed sequentially (with a constant stride), fetch and decode up to this
+            many of the following frames in background threads so that they are ready when requested. Defaults to the
+            `datasource-cluster_prefetch` config option.
+        """
         self.seriesName = url
         #print url
         self.clusterfilter = url.split('://')[1].split('/')[0]
@@ -59,6 +96,17 @@ class DataSource(BaseDataSource):
         
         self.fshape = None#(self.mdh['Camera.ROIWidth'],self.mdh['Camera.ROIHeight'])
         
+        if prefetch is None:
+            prefetch = config.get('datasource-cluster_prefetch', 0)
+        self._prefetch = int(prefetch)
+        
+        #frames which have been (or are being) prefetched, as {index : AsyncResult}. Bounded to 2x the prefetch depth.
+        self._prefetched = collections.OrderedDict()
+        self._prefetch_lock = threading.Lock()
+        self._last_ind = None
+        self._stride = 0
+        self._run_length = 0
+        
         self._getNumFrames()
     
     def _getNumFrames(self):
@@ -66,12 +114,58 @@ class DataSource(BaseDataSource):
         self.numFrames = len(frameNames)
         self.lastShapeTime = time.time()
     
-    def getSlice(self, ind):
+    def _load_slice(self, ind):
         frameName = '%s/frame%05d.pzf' % (self.sequenceName, ind)
         sl = PZFFormat.loads(clusterIO.get_file(frameName, self.clusterfilter))[0]
         
         #print sl.shape, sl.dtype
         return sl.squeeze()
+    
+    def _schedule_prefetch(self, ind):
+        """Track the access pattern and, if we are reading sequentially, prefetch the next frames (call with the
+        prefetch lock held)"""
+        stride = (ind - self._last_ind) if (self._last_ind is not None) else 0
+        if (stride != 0) and (stride == self._stride):
+            self._run_length += 1
+        else:
+            #random access - throw away anything we fetched for the previous run
+            self._run_length = 1 if stride != 0 else 0
+            self._prefetched.clear()
+            
+        self._stride = stride
+        self._last_ind = ind
+        
+        if self._run_length < MIN_RUN_LENGTH:
+            return
+        
+        pool = _get_prefetch_pool()
+        for i in range(1, self._prefetch + 1):
+            next_ind = ind + i*stride
+            if (next_ind < 0) or (next_ind >= self.numFrames):
+                #don't look for frames which are not there (yet) as this is slow
+                break
+                
+            if not next_ind in self._prefetched:
+                self._prefetched[next_ind] = pool.apply_async(self._load_slice, (next_ind,))
+            
+        while len(self._prefetched) > 2*self._prefetch:
+            self._prefetched.popitem(last=False)
+    
+    def getSlice(self, ind):
+        if self._prefetch <= 0:
+            return self._load_slice(ind)
+        
+        with self._prefetch_lock:
+            res = self._prefetched.pop(ind, None)
+            self._schedule_prefetch(ind)
+            
+        if res is not None:
+            try:
+                return res.get()
+            except Exception:
+                logger.exception('Error prefetching frame %d, retrying' % ind)
+        
+        return self._load_slice(ind)
 
     def getSliceShape(self):
         if self.fshape is None:
@@ -89,20 +183,36 @@ class DataSource(BaseDataSource):
     def eventFileName(self):
         return self.sequenceName + '/events.json'
 
+    @property
+    def binaryEventFileName(self):
+        return self.sequenceName + '/events.bin'
+
     def getEvents(self):
-        import pandas as pd #defer pandas import for as long as possible
+        if not self.isComplete():
+            #the series is still being spooled - use the binary event log (see `PYME.IO.eventFormat`), which is written
+            #during acquisition. Once spooling has finished we use events.json instead, as it is written in one piece
+            #and does not depend on the data server having flushed the (buffered) appends to the binary log.
+            from PYME.IO import eventFormat
+            try:
+                #NB - don't cache as the log is appended to, and don't retry as older series won't have a log at all
+                return eventFormat.loads(clusterIO.get_file(self.binaryEventFileName, self.clusterfilter, numRetries=1,
+                                                         use_file_cache=False))
+            except (IOError, ValueError, RuntimeError):
+                #series spooled by older versions of PYME don't have a binary event log
+                return []
+        
         try:
-            #return json.loads(clusterIO.getFile(eventFileName, self.clusterfilter))
-            ev = pd.read_json(clusterIO.get_file(self.eventFileName, self.clusterfilter))
+            #events.json holds a list of (EventName, EventDescr, Time) entries
+            ev = json.loads(clusterIO.get_file(self.eventFileName, self.clusterfilter))
             if len(ev) == 0:
                 return []
             
-            ev.columns = ['EventName', 'EventDescr', 'Time']
+            names, descrs, times = zip(*ev)
 
             evts = np.empty(len(ev), dtype=[('EventName', 'S32'), ('Time', 'f8'), ('EventDescr', 'S256')])
-            evts['EventName'] = ev['EventName']
-            evts['EventDescr'] = ev['EventDescr']
-            evts['Time'] = ev['Time']
+            evts['EventName'] = names
+            evts['EventDescr'] = descrs
+            evts['Time'] = times
             return evts
         except (IOError, ValueError):
             #our series might not have any events
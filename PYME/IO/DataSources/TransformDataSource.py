@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+##################
+# TransformDataSource.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+##################
+"""
+A data source which lazily applies a per-frame transform to one or more other data sources. Frames are only computed
+when they are requested, and a bounded number of computed frames are kept in an LRU cache.
+
+Used by the recipe filter modules to pass image data between modules without materialising the whole stack (see
+:class:`PYME.recipes.base.Filter`). As transform data sources can take other transform data sources as input, a chain
+of per-frame filters is evaluated in a single pass over the data, with memory use bounded by the caches.
+"""
+from .BaseDataSource import BaseDataSource
+import numpy as np
+import threading
+import collections
+
+from PYME import config
+
+
+class DataSource(BaseDataSource):
+    moduleName = 'TransformDataSource'
+
+    def __init__(self, sources, transform, cache_size_mb=None):
+        """
+
+        Parameters
+        ----------
+        sources : list
+            the input data. Each entry should be array like with a 4D (x, y, z/t, c) shape, as given by the `.data`
+            attribute of an ImageStack. All sources must have the same number of frames and channels.
+        transform : callable
+            the transform to apply, called as `transform(frames, z, c)` where `frames` is a list of the 2D (squeezed)
+            frames at `[:, :, z, c]` in each source. Should return a 2D array, or a 3D array with the same depth for
+            every frame, in which case the planes of each result become consecutive slices of the output (as for the
+            eager filtering in :func:`PYME.recipes.base._apply_framewise`).
+        cache_size_mb : float
+            maximum size of computed frames to keep. Defaults to the `datasource-transform_cache_mb` config option.
+        """
+        self._sources = sources
+        self._transform = transform
+
+        shape = sources[0].shape
+        self._n_frames = int(shape[2])
+        self.sizeC = int(shape[3])
+        self.additionalDims = 'TC' if self.sizeC > 1 else 'T'
+
+        if cache_size_mb is None:
+            cache_size_mb = config.get('datasource-transform_cache_mb', 256)
+        self._max_cache_bytes = cache_size_mb*1e6
+
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+        self._cache_lock = threading.Lock()
+
+        #sources are not necessarily thread-safe
+        self._source_lock = threading.Lock()
+        
+        #transform the first frame to find the output depth (number of slices per input frame)
+        self._depth = None
+        planes = self._compute_frame(0, 0)
+        self._depth = len(planes)
+        self._cache_planes(0, planes)
+
+    def _compute_frame(self, z, c):
+        """Transform frame z of channel c, returning a list of the resulting 2D planes"""
+        with self._source_lock:
+            frames = [s[:, :, z, c].squeeze() for s in self._sources]
+
+        res = np.asarray(self._transform(frames, z, c))
+        if res.ndim == 2:
+            planes = [res, ]
+        else:
+            planes = [np.ascontiguousarray(res[:, :, i]) for i in range(res.shape[2])]
+        
+        if (self._depth is not None) and (len(planes) != self._depth):
+            raise RuntimeError('Transform returned %d planes for frame %d, expected %d' % (len(planes), z, self._depth))
+        
+        return planes
+    
+    def _cache_planes(self, ind0, planes):
+        """Add the planes from one transformed frame, starting at slice ind0, to the cache"""
+        with self._cache_lock:
+            for ind, sl in enumerate(planes, ind0):
+                if not ind in self._cache:
+                    #the cached slice is shared between callers
+                    sl.setflags(write=False)
+                    self._cache[ind] = sl
+                    self._cache_bytes += sl.nbytes
+
+            while (self._cache_bytes > self._max_cache_bytes) and (len(self._cache) > len(planes)):
+                self._cache_bytes -= self._cache.popitem(last=False)[1].nbytes
+
+    def getSlice(self, ind):
+        with self._cache_lock:
+            try:
+                sl = self._cache.pop(ind)
+                self._cache[ind] = sl #move to the end (most recently used)
+                return sl
+            except KeyError:
+                pass
+
+        #compute without holding the lock so that multiple threads can compute slices at once
+        c, p = divmod(ind, self._n_frames*self._depth)
+        z, k = divmod(p, self._depth)
+        planes = self._compute_frame(z, c)
+        
+        #keep all the planes for this frame, as they are likely to be wanted next
+        self._cache_planes(ind - k, planes)
+
+        return planes[k]
+
+    def getSliceShape(self):
+        return self.getSlice(0).shape[:2]
+
+    def getNumSlices(self):
+        return self._n_frames*self._depth*self.sizeC
+
+    def getEvents(self):
+        try:
+            return self._sources[0].getEvents()
+        except (AttributeError, NotImplementedError):
+            return []
+
+    def release(self):
+        pass
+
+    def reloadData(self):
+        pass
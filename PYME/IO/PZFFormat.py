@@ -21,58 +21,212 @@ from multiprocessing.pool import ThreadPool
 from multiprocessing import cpu_count
 
 import threading
+import time
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
+from PYME import config
+
 try:
     from pymecompress import bcl
 except ImportError:
     logging.warning('''Could not import pymecompress library - saving or loading compressed PZF will fail
     (the library is installable from david_baddely conda channel, but requires an AVX capable processor)''')
 
-NUM_COMP_THREADS = 2#cpu_count()
+#default number of chunks (and threads) used for chunked Huffman coding. Can be changed for the current process using
+#set_num_threads(), or for an individual call using the `num_chunks` and `num_threads` arguments to dumps() and loads().
+NUM_COMP_THREADS = int(config.get('pzf-num_comp_threads', 2))
 
-compPool = ThreadPool(NUM_COMP_THREADS)
+_pools = {}
+_pool_lock = threading.Lock()
 
-def ChunkedHuffmanCompress(data, quantization=None):
-    num_chunks = NUM_COMP_THREADS
+def _get_pool(num_threads=None):
+    """Get a (lazily created and then re-used) thread pool with `num_threads` threads"""
+    if num_threads is None:
+        num_threads = NUM_COMP_THREADS
     
-    chunk_size = int(np.ceil(float(len(data))/num_chunks))
-    raw_chunks = [data[j*chunk_size:(j+1)*chunk_size].data for j in range(num_chunks)]
+    with _pool_lock:
+        try:
+            return _pools[num_threads]
+        except KeyError:
+            pool = ThreadPool(num_threads)
+            _pools[num_threads] = pool
+            return pool
+
+compPool = _get_pool(NUM_COMP_THREADS)
+
+def set_num_threads(num_threads):
+    """
+    Set the default number of chunks / threads used for chunked Huffman coding in this process.
     
-    #compPool = ThreadPool(NUM_COMP_THREADS)
+    Parameters
+    ----------
+    num_threads : int
+        number of threads. Use `multiprocessing.cpu_count()` to use all cores.
+    """
+    global NUM_COMP_THREADS, compPool
     
-    comp_chunk_d = {}
+    NUM_COMP_THREADS = max(int(num_threads), 1)
+    compPool = _get_pool(NUM_COMP_THREADS)
 
-    if quantization is None:
-        def _compChunk(c, j):
-            comp_chunk_d[j] = bcl.HuffmanCompress(c)
 
-        threads = [threading.Thread(target = _compChunk, args=(rc, j)) for j, rc in enumerate(raw_chunks)]
+class CodecStats(object):
+    """
+    Accumulates the number of bytes processed and the time spent encoding and decoding, so that we can monitor codec
+    throughput (e.g. in the spooler or on analysis nodes). A single, module level, instance (:data:`stats`) is updated by
+    :func:`dumps`, :func:`dumps_into` and :func:`loads`.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+        
+    def reset(self):
+        with self._lock:
+            self.n_encoded = 0
+            self.encode_raw_bytes = 0
+            self.encode_bytes = 0
+            self.encode_time = 0
+            
+            self.n_decoded = 0
+            self.decode_raw_bytes = 0
+            self.decode_bytes = 0
+            self.decode_time = 0
+            
+    def record_encode(self, raw_bytes, encoded_bytes, dt):
+        with self._lock:
+            self.n_encoded += 1
+            self.encode_raw_bytes += raw_bytes
+            self.encode_bytes += encoded_bytes
+            self.encode_time += dt
+            
+    def record_decode(self, raw_bytes, encoded_bytes, dt):
+        with self._lock:
+            self.n_decoded += 1
+            self.decode_raw_bytes += raw_bytes
+            self.decode_bytes += encoded_bytes
+            self.decode_time += dt
+            
+    def summary(self):
+        """
+        Returns
+        -------
+        dict of frame counts, throughputs (in MB/s of uncompressed data) and compression ratios
+        """
+        with self._lock:
+            return {'n_encoded': self.n_encoded,
+                    'encode_MBps': self.encode_raw_bytes/(1e6*self.encode_time) if self.encode_time > 0 else 0,
+                    'encode_ratio': float(self.encode_raw_bytes)/self.encode_bytes if self.encode_bytes > 0 else 0,
+                    'n_decoded': self.n_decoded,
+                    'decode_MBps': self.decode_raw_bytes/(1e6*self.decode_time) if self.decode_time > 0 else 0,
+                    'decode_ratio': float(self.decode_raw_bytes)/self.decode_bytes if self.decode_bytes > 0 else 0,
+                    }
+        
+    def __repr__(self):
+        return 'PZF codec stats: %s' % self.summary()
+    
+stats = CodecStats()
+
+
+def _as_u1(a):
+    """View a contiguous array (in memory order) or a bytes-like object as a flat uint8 array without copying"""
+    if isinstance(a, np.ndarray):
+        if not (a.flags['C_CONTIGUOUS'] or a.flags['F_CONTIGUOUS']):
+            raise ValueError('Array must be contiguous')
+        return a.reshape(-1, order='A').view('u1')
     else:
-        def _compChunk(c, j):
-            comp_chunk_d[j] = bcl.HuffmanCompressQuant(c, *quantization)
+        return np.frombuffer(a, 'u1')
+    
+def _as_output_buffer(out, nbytes):
+    """Get a flat, writeable, uint8 view of a caller supplied output buffer, checking that it is large enough"""
+    buf = _as_u1(out)
+    
+    if not buf.flags['WRITEABLE']:
+        raise ValueError('Output buffer is not writeable')
+    
+    if len(buf) < nbytes:
+        raise ValueError('Output buffer too small (%d bytes needed, %d available)' % (nbytes, len(buf)))
+    
+    return buf
 
-        threads = [threading.Thread(target=_compChunk, args=(rc, j)) for j, rc in enumerate(raw_chunks)]
-            
-    for p in threads:
-        #print p
-        p.start()
+def _write_parts(parts, out):
+    """Copy a list of uint8 arrays sequentially into `out`, returning the number of bytes written"""
+    nbytes = sum([len(p) for p in parts])
+    buf = _as_output_buffer(out, nbytes)
+    
+    sp = 0
+    for p in parts:
+        buf[sp:(sp + len(p))] = p
+        sp += len(p)
+        
+    return nbytes
 
-    for p in threads:
-        p.join()
+def _join_parts(parts):
+    if six.PY2:
+        return b''.join([p.tostring() for p in parts])
+    else:
+        return b''.join(parts)
 
+
+def _chunked_huffman_compress_parts(data, quantization=None, num_chunks=None, num_threads=None):
+    """
+    Chunked Huffman compression, returning the encoded stream as a list of uint8 arrays (which can then be joined or
+    written into an output buffer without further intermediate copies).
     
-    #comp_chunks = compPool.map(bcl.HuffmanCompress, raw_chunks) 
+    Chunks are taken from the array in memory order and always contain a whole number of pixels.
+    """
+    if num_chunks is None:
+        num_chunks = num_threads if num_threads else NUM_COMP_THREADS
+        
+    flat = data.reshape(-1, order='A')
     
-    s = np.array([num_chunks], 'u2').tostring()
+    chunk_size = int(np.ceil(float(len(flat)) / num_chunks))
+    raw_chunks = [flat[j * chunk_size:(j + 1) * chunk_size] for j in range(num_chunks)]
     
-    for j, r in enumerate(raw_chunks):
-        c = comp_chunk_d[j]
-        s += np.array([len(c), len(r)], 'u4').tostring()
-        s += c.tostring()
+    if quantization is None:
+        #length of the decompressed chunk is the raw byte length
+        raw_lens = [c.nbytes for c in raw_chunks]
+        comp_chunks = _get_pool(num_threads).map(bcl.HuffmanCompress, raw_chunks)
+    else:
+        #quantized data is always decompressed to 8 bit
+        raw_lens = [c.size for c in raw_chunks]
+        comp_chunks = _get_pool(num_threads).map(lambda c: bcl.HuffmanCompressQuant(c, *quantization), raw_chunks)
+    
+    parts = [np.array([num_chunks], 'u2').view('u1')]
+    
+    for c, raw_len in zip(comp_chunks, raw_lens):
+        c = _as_u1(c)
+        parts.append(np.array([len(c), raw_len], 'u4').view('u1'))
+        parts.append(c)
         
-    return s
+    return parts
+
+def ChunkedHuffmanCompress(data, quantization=None, num_chunks=None, num_threads=None, out=None):
+    """
+    Huffman compress data in independent chunks, each chunk being encoded by a separate thread.
+    
+    Parameters
+    ----------
+    data : ndarray
+        contiguous data to compress
+    quantization : tuple or None
+        (offset, scale) for sqrt quantization, or None for lossless compression
+    num_chunks : int
+        number of chunks to split the data into, defaults to `num_threads` or :data:`NUM_COMP_THREADS`
+    num_threads : int
+        number of threads to use, defaults to :data:`NUM_COMP_THREADS`
+    out : writeable buffer, optional
+        if provided, write the encoded data into `out` rather than returning a new string
+
+    Returns
+    -------
+    the encoded data as a bytes string, or the number of bytes written if `out` was provided
+    """
+    parts = _chunked_huffman_compress_parts(data, quantization, num_chunks, num_threads)
+    
+    if out is None:
+        return _join_parts(parts)
+    else:
+        return _write_parts(parts, out)
 
 def ChunkedHuffmanCompress_o(data):
     num_chunks = NUM_COMP_THREADS
@@ -92,31 +246,57 @@ def ChunkedHuffmanCompress_o(data):
         
     return s
 
-def _chunkDecompress(args):
-    chunk, length = args
-    return bcl.HuffmanDecompress(np.fromstring(chunk, 'u1'), length)
+def _huffman_decompress(chunk, length):
+    if not chunk.flags['WRITEABLE']:
+        #pymecompress needs a writeable input buffer - copy the (compressed, and hence small) chunk
+        chunk = chunk.copy()
+        
+    return bcl.HuffmanDecompress(chunk, length)
     
-def ChunkedHuffmanDecompress(datastring):
-    num_chunks = np.fromstring(datastring[:2], 'u2')
+def ChunkedHuffmanDecompress(datastring, out=None, num_threads=None):
+    """
+    Decompress data which was compressed with :func:`ChunkedHuffmanCompress`
     
-    #compPool = ThreadPool(NUM_COMP_THREADS)
+    Parameters
+    ----------
+    datastring : bytes-like
+        the compressed data
+    out : writeable buffer, optional
+        if provided, chunks are decompressed directly into the corresponding position in `out` rather than into a
+        newly allocated array
+    num_threads : int
+        number of threads to use, defaults to :data:`NUM_COMP_THREADS`
+
+    Returns
+    -------
+    a flat uint8 array of the decompressed data (a view into `out` if provided)
+    """
+    data = _as_u1(datastring)
+    num_chunks = int(data[:2].view('u2')[0])
     
     sp = 2
+    op = 0
     
     comp_chunks = []
     for i in range(num_chunks):
-        chunk_len, raw_len = np.fromstring(datastring[sp:(sp+8)], 'u4')
+        chunk_len, raw_len = [int(v) for v in data[sp:(sp+8)].view('u4')]
         sp += 8
-        comp_chunks.append((datastring[sp:(sp+ chunk_len)], raw_len))
+        comp_chunks.append((data[sp:(sp+ chunk_len)], raw_len, op))
         sp += chunk_len
+        op += raw_len
         
+    if out is None:
+        buf = np.empty(op, 'u1')
+    else:
+        buf = _as_output_buffer(out, op)[:op]
+        
+    def _decomp(args):
+        chunk, raw_len, offset = args
+        buf[offset:(offset + raw_len)] = _huffman_decompress(chunk, raw_len)
     
-    decomp_chunks = compPool.map(_chunkDecompress, comp_chunks) 
-    
-    data = np.hstack(decomp_chunks)
+    _get_pool(num_threads).map(_decomp, comp_chunks)
     
-    #print data.shape #, comp_chunks
-    return data
+    return buf
 
 #except ImportError:
 #    pass
@@ -185,42 +365,9 @@ HEADER_LENGTH = np.zeros(1, header_dtype).nbytes
 
 HEADER_LENGTH_V3 = np.zeros(1, header_dtype_v3).nbytes
 
-def dumps(data, sequenceID=0, frameNum=0, frameTimestamp=0, compression = DATA_COMP_RAW, quantization=DATA_QUANT_NONE, quantizationOffset=0, quantizationScale=1):
-    """Dump an image frame (supplied as a numpy array) into a string in PZF format.
-    
-    Parameters
-    ==========
-
-    data:  ndarray
-            The frame as a 2D (or optionally 3D) numpy array
-    
-    sequenceID:  int
-            A unique identifier for the sequence to which this frame belongs.
-            This will let us connect the frame with it's metadata even if
-            they end up in different directories etc ...
-                 
-    frameNum:   int
-            The position of this frame within the sequence
-    
-    frameTimestamp:  float
-            A timestamp for the frame (if provided by the camera)
-    
-    compression:  int (enum)
-            compression method to use - one of: `PZFFormat.DATA_COMP_RAW`,
-            `PZFFormat.DATA_COMP_HUFFCODE`, or `PZFFormat.DATA_COMP_HUFFCODE_CHUNKS`
-            Where raw stores the data with no compression, huffcode uses
-            Huffman coding, and huffcode chunks breaks the data into chunks
-            first, with each chunk meing encodes by a separate thread.
-                  
-    quantization: int (enum)
-            Whether or not the data is quantized before saving.
-            One of `DATA_QUANT_NONE` or `DATA_QUANT_SQRT`. If `DATA_QUANT_SQRT`
-            is selected, then the data is quantized as follows prior to
-            compression:
-                  
-            .. math:: data_{quant} =  \\frac{\\sqrt{data - quantizationOffset}}{quantizationScale}
-    """
-    
+def _encode(data, sequenceID=0, frameNum=0, frameTimestamp=0, compression = DATA_COMP_RAW, quantization=DATA_QUANT_NONE,
+            quantizationOffset=0, quantizationScale=1, num_chunks=None, num_threads=None):
+    """ Encode a frame as a list of uint8 arrays (header, followed by the data) which together make up the PZF string"""
     header = np.zeros(1, header_dtype_v3)
     
     header['ID'] = FILE_FORMAT_ID
@@ -271,37 +418,130 @@ def dumps(data, sequenceID=0, frameNum=0, frameTimestamp=0, compression = DATA_C
         header['DataCompression'] = DATA_COMP_HUFFCODE
 
         if quantization:
-            dataString = bcl.HuffmanCompressQuant(d1, quantizationOffset, quantizationScale).tostring()
+            data_parts = [_as_u1(bcl.HuffmanCompressQuant(d1, quantizationOffset, quantizationScale))]
         else:
-            d2 = bcl.HuffmanCompress(d1)
-            dataString = d2.tostring()
+            data_parts = [_as_u1(bcl.HuffmanCompress(d1))]
     elif compression == DATA_COMP_HUFFCODE_CHUNKS:
         header['DataCompression'] = DATA_COMP_HUFFCODE_CHUNKS
         
-        dataString = ChunkedHuffmanCompress(d1)
+        data_parts = _chunked_huffman_compress_parts(d1, (quantizationOffset, quantizationScale) if quantization else None,
+                                                     num_chunks=num_chunks, num_threads=num_threads)
     else:
-        #print('saving raw')
-        #print(header['DimOrder'][0])
-        dataString = d1.tostring(order=header['DimOrder'][0])
+        #raw data - d1 is contiguous, so we can use it's memory (in header['DimOrder'] order) directly
+        data_parts = [_as_u1(d1)]
         
-    return header.tostring() + dataString
+    return [header.view('u1')] + data_parts
+    
+    
+def dumps(data, sequenceID=0, frameNum=0, frameTimestamp=0, compression = DATA_COMP_RAW, quantization=DATA_QUANT_NONE,
+          quantizationOffset=0, quantizationScale=1, num_chunks=None, num_threads=None):
+    """Dump an image frame (supplied as a numpy array) into a string in PZF format.
+    
+    Parameters
+    ==========
+
+    data:  ndarray
+            The frame as a 2D (or optionally 3D) numpy array
+    
+    sequenceID:  int
+            A unique identifier for the sequence to which this frame belongs.
+            This will let us connect the frame with it's metadata even if
+            they end up in different directories etc ...
+                 
+    frameNum:   int
+            The position of this frame within the sequence
+    
+    frameTimestamp:  float
+            A timestamp for the frame (if provided by the camera)
+    
+    compression:  int (enum)
+            compression method to use - one of: `PZFFormat.DATA_COMP_RAW`,
+            `PZFFormat.DATA_COMP_HUFFCODE`, or `PZFFormat.DATA_COMP_HUFFCODE_CHUNKS`
+            Where raw stores the data with no compression, huffcode uses
+            Huffman coding, and huffcode chunks breaks the data into chunks
+            first, with each chunk meing encodes by a separate thread.
+                  
+    quantization: int (enum)
+            Whether or not the data is quantized before saving.
+            One of `DATA_QUANT_NONE` or `DATA_QUANT_SQRT`. If `DATA_QUANT_SQRT`
+            is selected, then the data is quantized as follows prior to
+            compression:
+                  
+            .. math:: data_{quant} =  \\frac{\\sqrt{data - quantizationOffset}}{quantizationScale}
+            
+    num_chunks: int
+            The number of chunks to use with `DATA_COMP_HUFFCODE_CHUNKS`. Defaults to `num_threads`.
+            
+    num_threads: int
+            The number of threads to use with `DATA_COMP_HUFFCODE_CHUNKS`. Defaults to :data:`NUM_COMP_THREADS`.
+            
+    See also
+    ========
+    
+    dumps_into : encode into a pre-allocated buffer
+    """
+    t0 = time.time()
+    parts = _encode(data, sequenceID, frameNum, frameTimestamp, compression, quantization, quantizationOffset,
+                    quantizationScale, num_chunks, num_threads)
+    s = _join_parts(parts)
+    stats.record_encode(data.nbytes, len(s), time.time() - t0)
+    
+    return s
+
+def dumps_into(out, data, **kwargs):
+    """
+    Encode an image frame into a caller supplied, pre-allocated, buffer rather than a new string. Keyword arguments are
+    as for :func:`dumps`.
+    
+    Parameters
+    ----------
+    out : writeable buffer (e.g. bytearray, memoryview, or contiguous numpy array)
+        The buffer to write into. Needs to be large enough to hold the encoded frame (`HEADER_LENGTH_V3 + data.nbytes` is
+        always sufficient for uncompressed data).
+    data : ndarray
+        The frame to encode
+
+    Returns
+    -------
+    nbytes : int
+        the number of bytes written to `out`
+    """
+    t0 = time.time()
+    nbytes = _write_parts(_encode(data, **kwargs), out)
+    stats.record_encode(data.nbytes, nbytes, time.time() - t0)
+    
+    return nbytes
  
 
+
 def load_header(datastring):
     if (_ord(datastring[2]) >= 3):
-        return np.fromstring(datastring[:HEADER_LENGTH_V3], header_dtype_v3)
+        return np.frombuffer(datastring, header_dtype_v3, count=1).copy()
     else:
-        return np.fromstring(datastring[:HEADER_LENGTH], header_dtype)
+        return np.frombuffer(datastring, header_dtype, count=1).copy()
 
    
-def loads(datastring):
+def loads(datastring, out=None, num_threads=None, copy=True):
     """
     Loads image data from a string in PZF format.
     
     Parameters
     ----------
     datastring : string / bytes
-        The encoded data
+        The encoded data. Any bytes-like object (e.g. a memoryview onto a larger receive buffer) is accepted.
+        
+    out : writeable buffer, optional
+        A pre-allocated buffer (e.g. bytearray, memoryview, or contiguous numpy array) to decode into. Must be at least
+        as large as the decoded frame. If provided, the returned data is a view into `out`, and compressed chunks are
+        decoded directly into their final position.
+        
+    num_threads : int, optional
+        The number of threads to use when decoding `DATA_COMP_HUFFCODE_CHUNKS` data. Defaults to
+        :data:`NUM_COMP_THREADS`.
+        
+    copy : bool
+        Only relevant for uncompressed data when `out` is not given. If False, return a (read-only) view onto
+        `datastring` rather than a copy.
     
     Returns
     -------
@@ -313,6 +553,7 @@ def loads(datastring):
         The image header, as a numpy record array with the :const:`header_dtype` dtype.
 
     """
+    t0 = time.time()
     header = load_header(datastring)
     
     if not header['ID'] == FILE_FORMAT_ID:
@@ -323,53 +564,63 @@ def loads(datastring):
     else:
         dimOrder = 'C'
         
-    #print(dimOrder)
-        
     w, h, d = header['Width'][0], header['Height'][0], header['Depth'][0]
+    dtype = DATA_FMTS[int(header['DataFormat'])]
+    quantized = header['DataQuantization'] == DATA_QUANT_SQRT
+    
+    nbytes = int(w*h*d*DATA_FMTS_SIZES[int(header['DataFormat'])])
 
-    if header['DataQuantization'] == DATA_QUANT_SQRT:
+    if quantized:
         #quantized data is always 8 bit
-        outsize = w * h * d
+        outsize = int(w * h * d)
     else:
-        outsize = w*h*d*DATA_FMTS_SIZES[int(header['DataFormat'])]
-    
+        outsize = nbytes
     
     if header['Version'] < 3:
         data_offset = HEADER_LENGTH
     else:
         data_offset = int(header['DataOffset'])
         
-    data_s = datastring[data_offset:]
-
-    #logging.debug('About to decompress')
-    #logging.debug({k:header[0][k] for k in header.dtype.names})
-
-    #logging.debug('Compressed size: %s' % len(data_s))
+    data_s = _as_u1(datastring)[data_offset:]
+    
+    if (out is not None) and not quantized:
+        #decode straight into the output buffer
+        dest = _as_output_buffer(out, nbytes)[:nbytes]
+    else:
+        dest = None
     
     if header['DataCompression'] == DATA_COMP_RAW:
         #no need to decompress
-        data = np.fromstring(data_s, 'u1')
+        data = data_s[:outsize]
+        if dest is not None:
+            dest[:] = data
+            data = dest
+        elif copy and not quantized:
+            data = data.copy()
     elif header['DataCompression'] == DATA_COMP_HUFFCODE:
-        #logging.debug('Decompressing ...')
-        data = bcl.HuffmanDecompress(np.fromstring(data_s, 'u1'), outsize)
+        data = _huffman_decompress(data_s, outsize)
+        if dest is not None:
+            dest[:] = data
+            data = dest
     elif header['DataCompression'] == DATA_COMP_HUFFCODE_CHUNKS:
-        data = ChunkedHuffmanDecompress(data_s)
+        data = ChunkedHuffmanDecompress(data_s, out=dest, num_threads=num_threads)
     else:
         raise RuntimeError('Compression type not understood')
-
-    #logging.debug('Uncompressed shape: %s, %s, (%d, %d, %d)' % (data.shape, w * h * d, w, h, d))
         
-    if header['DataQuantization'] == DATA_QUANT_SQRT:
+    if quantized:
         #un-quantize data
-        #logging.debug('Dequantizing')
-        
-        #print(data.max())
-
         data = data.astype('f')*header['QuantScale']
-        #print('data dtype: %s' % data.dtype)
-        data = (data*data + header['QuantOffset']).astype(DATA_FMTS[int(header['DataFormat'])])
+        data = (data*data + header['QuantOffset'])
+        
+        if out is None:
+            data = data.astype(dtype)
+        else:
+            dest = _as_output_buffer(out, nbytes)[:nbytes].view(dtype)
+            dest[:] = data
+            data = dest
+    
+    data = data.view(dtype).reshape([w,h,d], order=dimOrder)
     
-    #print(dimOrder, [w, h, d])
-    data = data.view(DATA_FMTS[int(header['DataFormat'])]).reshape([w,h,d], order=dimOrder)
+    stats.record_decode(nbytes, len(data_s) + data_offset, time.time() - t0)
     
-    return data, header
\ No newline at end of file
+    return data, header
@@ -5,11 +5,27 @@ Created on Fri Apr  3 10:45:24 2015
 @author: david
 """
 import numpy as np
+import contextlib
 
 #bufferMisses = 0
 
 class dataBuffer: #buffer our io to avoid decompressing multiple times
-    def __init__(self,dataSource, bLen = 12):
+    def __init__(self,dataSource, bLen = 12, sharedCache=None, dataSourceID=None):
+        """
+        
+        Parameters
+        ----------
+        dataSource : PYME.IO.DataSources.BaseDataSource.BaseDataSource
+            the data source to buffer
+        bLen : int
+            the number of frames to keep in our (per-process) buffer
+        sharedCache : SharedFrameCache, optional
+            a cache, shared between processes on this machine, to check before going to the data source (and into which
+            frames read from the data source are inserted).
+        dataSourceID : str, optional
+            a unique identifier for the data source (usually the URI) used as a key in the shared cache. Required if
+            sharedCache is given.
+        """
         self.bLen = bLen
         self.buffer = None #delay creation until we know the dtype
         #self.buffer = np.zeros((bLen,) + dataSource.getSliceShape(), 'uint16')
@@ -17,6 +33,24 @@ class dataBuffer: #buffer our io to avoid decompressing multiple times
         self.bufferedSlices = -1*np.ones((bLen,), 'i')
         self.dataSource = dataSource
         
+        self.sharedCache = sharedCache
+        self.dataSourceID = dataSourceID
+        
+    def _insert(self, ind, sl):
+        """Copy a slice into our buffer, returning the buffered copy"""
+        self.bufferedSlices[self.insertAt] = ind
+
+        if self.buffer is None: #buffer doesn't exist yet
+            self.buffer = np.zeros((self.bLen,) + self.dataSource.getSliceShape(), sl.dtype)
+            
+        self.buffer[self.insertAt, :,:] = sl
+        buffered = self.buffer[self.insertAt, :, :]
+        
+        self.insertAt += 1
+        self.insertAt %=self.bLen
+        
+        return buffered
+        
     def getSlice(self,ind):
         #global bufferMisses
         #print self.bufferedSlices, self.insertAt, ind
@@ -24,16 +58,19 @@ class dataBuffer: #buffer our io to avoid decompressing multiple times
         if ind in self.bufferedSlices: #return from buffer
             #print int(np.where(self.bufferedSlices == ind)[0])
             return self.buffer[int(np.where(self.bufferedSlices == ind)[0]),:,:]
+        elif self.sharedCache is not None:
+            #copy straight from the shared cache into our buffer if we can
+            with self.sharedCache.pinned(self.dataSourceID, ind) as sl:
+                if sl is not None:
+                    return self._insert(ind, sl)
+                
+            sl = self.dataSource.getSlice(ind)
+            self.sharedCache.put(self.dataSourceID, ind, sl)
+            self._insert(ind, sl)
+            return sl
         else: #get from our data source and store in buffer
             sl = self.dataSource.getSlice(ind)
-            self.bufferedSlices[self.insertAt] = ind
-
-            if self.buffer is None: #buffer doesn't exist yet
-                self.buffer = np.zeros((self.bLen,) + self.dataSource.getSliceShape(), sl.dtype)
-                
-            self.buffer[self.insertAt, :,:] = sl
-            self.insertAt += 1
-            self.insertAt %=self.bLen
+            self._insert(ind, sl)
 
             #bufferMisses += 1
             
@@ -41,6 +78,198 @@ class dataBuffer: #buffer our io to avoid decompressing multiple times
             #    print nTasksProcessed, bufferMisses
 
             return sl
+
+
+class SharedFrameCache(object):
+    """
+    A bounded LRU cache of (decompressed) frames, stored in shared memory so that it can be used by all the compute
+    processes on a node. Frames are keyed by (dataSourceID, frame index).
+    
+    Storage is allocated up-front as a single `size_mb` block, which is divided into slots sized to fit the first frame
+    which is cached (or `min_frame_bytes`, if larger). Frames which are larger than the slot size (i.e. from a series
+    with a larger frame size) are simply not cached. The cache uses `PYME.util.shmarray` and a multiprocessing lock,
+    both of which are inherited by child processes when they are forked, so it must be created in the parent BEFORE the
+    worker processes are started (and will not be shared with processes created using the 'spawn' start method).
+    
+    As a python dictionary can't be shared between processes, slots are indexed using a shared, set-associative, hash
+    table - each (dataSourceID, frame) pair hashes to a set of `ways` slots, and only that set needs to be searched
+    (and an LRU frame from that set evicted) on a lookup or insertion.
+    
+    Frames are read without copying using :meth:`pinned`, which pins the slot (so that it can't be re-used by another
+    process) while the frame is being used.
+    """
+    _index_dtype = [('key', '<i8'), ('frame', '<i8'), ('valid', 'u1'), ('dtype', 'S4'), ('shape', '<i4', (2,)),
+                    ('last_access', '<i8'), ('pins', '<i4')]
+    
+    #layout of the shared metadata array
+    _SLOT_BYTES, _N_SETS, _WAYS, _ACCESS_COUNT = range(4)
+    
+    def __init__(self, size_mb=512, min_frame_bytes=64*64*2, ways=8):
+        import multiprocessing
+        from PYME.util.shmarray import shmarray
+        
+        self.size_bytes = int(size_mb*1024*1024)
+        self.min_frame_bytes = int(min_frame_bytes)
+        self.max_ways = int(ways)
+        
+        self._data = shmarray.create(self.size_bytes, 'uint8')
+        #allocate enough index entries for the smallest slot size we will use
+        self._index = shmarray.zeros(max(self.size_bytes//self.min_frame_bytes, 1), self._index_dtype)
+        self._meta = shmarray.zeros(4, '<i8')
+        self._lock = multiprocessing.Lock()
+        
+    @property
+    def slot_bytes(self):
+        """The size of each slot (0 until the first frame is cached)"""
+        return int(self._meta[self._SLOT_BYTES])
+    
+    @property
+    def n_slots(self):
+        return int(self._meta[self._N_SETS]*self._meta[self._WAYS])
+        
+    @staticmethod
+    def _key(dataSourceID):
+        import zlib
+        
+        if not isinstance(dataSourceID, bytes):
+            dataSourceID = dataSourceID.encode()
+        
+        #combine two 32 bit checksums to make collisions between data sources unlikely
+        return np.int64((zlib.crc32(dataSourceID) & 0xffffffff) << 31) ^ np.int64(zlib.adler32(dataSourceID) & 0xffffffff)
+    
+    def _allocate_slots(self, nbytes):
+        """Divide our storage into slots of (at least) nbytes. Called (under the lock) when the first frame is cached"""
+        slot_bytes = max(int(nbytes), self.min_frame_bytes)
+        n_slots = max(self.size_bytes//slot_bytes, 1)
+        ways = min(self.max_ways, n_slots)
+        
+        self._meta[self._WAYS] = ways
+        self._meta[self._N_SETS] = n_slots//ways
+        self._meta[self._SLOT_BYTES] = slot_bytes
+    
+    def _set(self, key, frame):
+        """The range of slots which a frame can be stored in"""
+        ways = int(self._meta[self._WAYS])
+        s = int((int(key) ^ (int(frame)*0x9E3779B1)) % int(self._meta[self._N_SETS]))
+        return s*ways, (s + 1)*ways
+    
+    def _find(self, key, frame):
+        if self._meta[self._SLOT_BYTES] == 0:
+            #nothing cached yet
+            return None
+        
+        i0, i1 = self._set(key, frame)
+        idx = self._index[i0:i1]
+        slots = np.where((idx['key'] == key) & (idx['frame'] == frame) & (idx['valid'] > 0))[0]
+        
+        if len(slots) > 0:
+            return i0 + int(slots[0])
+    
+    def _touch(self, slot):
+        self._meta[self._ACCESS_COUNT] += 1
+        self._index['last_access'][slot] = self._meta[self._ACCESS_COUNT]
+        
+    def _slot_view(self, slot):
+        slot_bytes = self.slot_bytes
+        rec = self._index[slot]
+        dtype = np.dtype(rec['dtype'].decode())
+        shape = tuple(rec['shape'])
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        
+        return self._data[(slot*slot_bytes):(slot*slot_bytes + nbytes)].view(dtype).reshape(shape)
+    
+    @contextlib.contextmanager
+    def pinned(self, dataSourceID, frame):
+        """
+        Context manager giving zero-copy access to a cached frame.
+        
+        Yields a read-only view into the shared buffer (or None if the frame is not in the cache). The slot is pinned,
+        and won't be re-used, until the context exits, so the view must not be used after this.
+        
+        Examples
+        --------
+        
+        >>> with cache.pinned('PYME-CLUSTER://...', 10) as frame:
+        ...     if frame is not None:
+        ...         buffer[i] = frame
+        """
+        key = self._key(dataSourceID)
+        
+        with self._lock:
+            slot = self._find(key, frame)
+            if slot is not None:
+                self._touch(slot)
+                self._index['pins'][slot] += 1
+                view = self._slot_view(slot)
+                view.flags.writeable = False
+        
+        if slot is None:
+            yield None
+            return
+        
+        try:
+            yield view
+        finally:
+            with self._lock:
+                self._index['pins'][slot] -= 1
+                
+    def get(self, dataSourceID, frame):
+        """
+        Get a (process local) copy of a frame from the cache, or None if the frame is not in the cache. See also
+        :meth:`pinned`, which avoids the copy.
+        """
+        with self.pinned(dataSourceID, frame) as view:
+            if view is not None:
+                return view.copy()
+        
+    def put(self, dataSourceID, frame, data):
+        """
+        Add a frame to the cache, evicting the least recently used (unpinned) frame with the same hash if needed.
+        """
+        data = np.ascontiguousarray(data).squeeze()
+        
+        if data.ndim != 2:
+            #not a 2D frame - don't cache
+            return
+        
+        key = self._key(dataSourceID)
+        
+        with self._lock:
+            if self._meta[self._SLOT_BYTES] == 0:
+                self._allocate_slots(data.nbytes)
+                
+            if data.nbytes > self.slot_bytes:
+                #too big - don't cache
+                return
+            
+            slot = self._find(key, frame)
+            if slot is None:
+                i0, i1 = self._set(key, frame)
+                idx = self._index[i0:i1]
+                free_slots = np.where(idx['valid'] == 0)[0]
+                if len(free_slots) > 0:
+                    slot = i0 + int(free_slots[0])
+                else:
+                    candidates = np.where(idx['pins'] == 0)[0]
+                    if len(candidates) == 0:
+                        #everything is in use
+                        return
+                    slot = i0 + int(candidates[np.argmin(idx['last_access'][candidates])])
+                    
+                slot_bytes = self.slot_bytes
+                self._index['valid'][slot] = 0
+                self._data[(slot*slot_bytes):(slot*slot_bytes + data.nbytes)] = data.view('uint8').ravel()
+                
+                self._index['key'][slot] = key
+                self._index['frame'][slot] = frame
+                self._index['dtype'][slot] = data.dtype.str.encode()
+                self._index['shape'][slot] = data.shape
+                self._index['valid'][slot] = 1
+                
+            self._touch(slot)
+            
+    def __len__(self):
+        return int((self._index['valid'] > 0).sum())
         
 class backgroundBuffer:
     def __init__(self, dataBuffer):
@@ -194,6 +423,128 @@ class bgFrameBufferC(bgFrameBuffer):
         buffer_helpers.get_pct(self.frameBuffer, self.indices, pcIDX, pct_buf)
         return pct_buf
         
+class bgHistogramBuffer(object):
+    """
+    Streaming percentile estimator with the same interface as bgFrameBuffer.
+    
+    Rather than maintaining per-pixel ranks for every frame in the buffer (which makes adding or removing a frame
+    O(n_frames*n_pixels)), we keep a per-pixel histogram of the buffered frames. For each percentile which has been
+    asked for, we also track the histogram bin containing the percentile and the number of values below that bin.
+    Adding or removing a frame then costs a single histogram increment and comparison per pixel, and the tracked bins
+    only need to move by a bin or so per frame, making updates O(n_pixels) regardless of the number of frames in the
+    buffer. The percentile is found by linear interpolation within the bin.
+    
+    The histogram range is chosen per pixel from the frames in the buffer, so as to span both the requested and the
+    median percentiles with a generous margin, and is re-estimated (which is O(n_frames*n_pixels)) if the percentile
+    for any pixel drifts into one of the edge bins. The result is an approximation, but with the default 64 bins
+    the quantisation error is a small fraction of the pixel noise.
+    """
+    def __init__(self, initialSize=30, percentile=.25, n_bins=64):
+        self.pctile = percentile
+        self.n_bins = n_bins
+        
+        self.frames = {}
+        self.hist = None
+        self.lo = None
+        self.inv_bin_width = None
+        
+        #current bin and number of values below that bin for each percentile we are tracking
+        self._trackers = {}
+        
+    def _bin(self, data):
+        b = np.floor((data.ravel().astype('f') - self.lo)*self.inv_bin_width).astype('i')
+        return np.clip(b, 0, self.n_bins - 1)
+        
+    def _rebuild(self):
+        """Re-estimate the histogram range for each pixel and rebuild the histogram from the buffered frames"""
+        stack = np.array([f.ravel() for f in self.frames.values()], 'f')
+        
+        p_lo = np.percentile(stack, 100*max(self.pctile - .2, 0), axis=0)
+        p_hi = np.percentile(stack, 100*min(max(self.pctile, .5) + .2, 1), axis=0)
+        width = np.maximum(p_hi - p_lo, 1.0)
+        
+        self.lo = (p_lo - .5*width).astype('f')
+        self.inv_bin_width = (self.n_bins/(2*width)).astype('f')
+        
+        self.hist = np.zeros((self.n_bins, stack.shape[1]), np.uint16)
+        self._pix = np.arange(stack.shape[1])
+        for f in stack:
+            self.hist[self._bin(f), self._pix] += 1
+            
+        self._trackers = {}
+        
+    def addFrame(self, frameNo, data):
+        #take a copy, as data is potentially a view into a data buffer which will get overwritten
+        data = np.array(data, copy=True)
+        self.frames[frameNo] = data
+        
+        if not self.hist is None:
+            b = self._bin(data)
+            self.hist[b, self._pix] += 1
+            for j, below in self._trackers.values():
+                below += (b < j)
+            
+    def removeFrame(self, frameNo):
+        data = self.frames.pop(frameNo)
+        
+        if not self.hist is None:
+            b = self._bin(data)
+            self.hist[b, self._pix] -= 1
+            for j, below in self._trackers.values():
+                below -= (b < j)
+            
+    def _getPercentile(self, pctile):
+        pix = self._pix
+        
+        # index (into a sorted list) of the value we want - as for bgFrameBuffer
+        k = int(len(self.frames)*pctile)
+        
+        try:
+            j, below = self._trackers[pctile]
+        except KeyError:
+            # find the bin containing the k-th value from the cumulative histogram
+            cs = np.cumsum(self.hist, 0, dtype='i')
+            j = np.minimum((cs <= k).sum(0), self.n_bins - 1).astype('i')
+            below = np.where(j > 0, cs[np.maximum(j - 1, 0), pix], 0).astype('i')
+            self._trackers[pctile] = (j, below)
+        
+        # move the tracked bin until it contains the k-th value. As we add and remove one frame at a time, this will
+        # usually need at most a step or two.
+        while True:
+            m = np.where((below > k) & (j > 0))[0]
+            if len(m) == 0:
+                break
+            j[m] -= 1
+            below[m] -= self.hist[j[m], m]
+            
+        while True:
+            m = np.where(((below + self.hist[j, pix]) <= k) & (j < (self.n_bins - 1)))[0]
+            if len(m) == 0:
+                break
+            below[m] += self.hist[j[m], m]
+            j[m] += 1
+        
+        # interpolate within the bin
+        frac = (k - below + 0.5)/np.maximum(self.hist[j, pix], 1)
+        
+        return self.lo + (j + frac)/self.inv_bin_width, j
+        
+    def getPercentile(self, pctile):
+        shape = next(iter(self.frames.values())).shape
+        
+        if self.hist is None:
+            self._rebuild()
+        
+        pc, j = self._getPercentile(pctile)
+        if np.any(j == 0) or np.any(j == (self.n_bins - 1)):
+            # percentile has drifted out of our histogram range (or the range was estimated on too few frames) for
+            # some pixels - re-estimate the range
+            self._rebuild()
+            pc, j = self._getPercentile(pctile)
+            
+        return pc.reshape(shape)
+        
+        
 class backgroundBufferM:
     def __init__(self, dataBuffer, percentile=.5):
         self.dataBuffer = dataBuffer
@@ -239,4 +590,12 @@ class backgroundBufferMC(backgroundBufferM):
     def __init__(self, *args, **kwargs):
         backgroundBufferM.__init__(self, *args, **kwargs)
         
-        self.bfb = bgFrameBufferC(percentile=self.pctile)
\ No newline at end of file
+        self.bfb = bgFrameBufferC(percentile=self.pctile)
+
+
+class backgroundBufferH(backgroundBufferM):
+    """Percentile background buffer which uses a streaming histogram (see bgHistogramBuffer) to estimate the percentile"""
+    def __init__(self, *args, **kwargs):
+        backgroundBufferM.__init__(self, *args, **kwargs)
+        
+        self.bfb = bgHistogramBuffer(percentile=self.pctile)
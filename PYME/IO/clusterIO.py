@@ -134,10 +134,11 @@ import sys
 try:
     # noinspection PyCompatibility
     from urlparse import urlparse
+    from urllib import urlencode
 except ImportError:
     #py3
     # noinspection PyCompatibility
-    from urllib.parse import urlparse
+    from urllib.parse import urlparse, urlencode
 
 import logging
 
@@ -256,6 +257,40 @@ def _listSingleDir(dirurl, nRetries=1, timeout=5):
     return dirL, dt
 
 
+def _locateSingle(serverurl, filename, timeout=5):
+    """
+    Ask a single data server whether it holds a file, using its location index (the `__locate` endpoint). Falls back to
+    listing the parent directory for servers which don't have a location index.
+
+    Returns
+    -------
+    found : bool
+    dt : float
+        the time the query took (used to choose between servers)
+    """
+    t = time.time()
+    url = serverurl + '__locate?' + urlencode({'path': filename})
+    try:
+        r = _getSession(url).get(url, timeout=timeout)
+        dt = time.time() - t
+        
+        if r.status_code == 200:
+            return (filename in r.json()), dt
+        else:
+            #make sure we read a reply so that the far end doesn't hold the connection open
+            dump = r.content
+    except (requests.Timeout, requests.ConnectionError):
+        logger.exception('Timeout on locating file')
+        return False, time.time() - t
+    except ValueError:
+        pass
+
+    #older server without a location index - look for the file in the directory listing
+    dirname, fn = filename.rpartition('/')[::2]
+    dirList, dt = _listSingleDir(serverurl + (dirname + '/' if dirname else ''))
+    return (fn in dirList.keys()), dt
+
+
 def locate_file(filename, serverfilter=local_serverfilter, return_first_hit=False):
     """
     Searches the cluster to find which server(s) a given file is stored on
@@ -285,10 +320,7 @@ def locate_file(filename, serverfilter=local_serverfilter, return_first_hit=Fals
     except KeyError:
         locs = []
 
-        dirname = '/'.join(filename.split('/')[:-1])
-        fn = filename.split('/')[-1]
-        if (len(dirname) >= 1):
-            dirname += '/'
+        filename = filename.lstrip('/')
 
         servers = []
         localServers = []
@@ -306,52 +338,28 @@ def locate_file(filename, serverfilter=local_serverfilter, return_first_hit=Fals
                     Total number of nodes: %d
                     ''' % (name, len(services)))
                 else:
-                    dirurl = 'http://%s:%d/%s' % (socket.inet_ntoa(info.address), info.port, dirname)
+                    serverurl = 'http://%s:%d/' % (socket.inet_ntoa(info.address), info.port)
     
                     if compName in name:
-                        localServers.append(dirurl)
+                        localServers.append(serverurl)
                     else:
-                        servers.append(dirurl)
+                        servers.append(serverurl)
 
         #try data servers on the local machine first
-        for dirurl in localServers:
-            try:
-                dirL, rt, dt = _dirCache[dirurl]
-                cached = True
-            except KeyError:
-                cached = False
-
-            if cached and fn in dirL: #note we're using short-circuit evaluation here
-                locs.append((dirurl + fn, dt))
-
-            else:
-                dirList, dt = _listSingleDir(dirurl)
-
-                if fn in dirList.keys():
-                    locs.append((dirurl + fn, dt))
+        for serverurl in localServers:
+            found, dt = _locateSingle(serverurl, filename)
+            if found:
+                locs.append((serverurl + filename, dt))
 
             if return_first_hit and len(locs) > 0:
                 return locs
 
-        #now try data remote servers
-        for dirurl in servers:
-            try:
-                dirL, rt, dt = _dirCache[dirurl]
-                cached = True
-            except KeyError:
-                cached = False
-
-            if cached and fn in dirL: #note we're using short-circuit evaluation here
-                locs.append((dirurl + fn, dt))
-
-            else:
-                dirList, dt = _listSingleDir(dirurl)
-
-                if fn in dirList.keys():
-                    locs.append((dirurl + fn, dt))
-
-            if return_first_hit and len(locs) > 0:
-                return locs
+        #now ask the remote servers (all at once)
+        if len(servers) > 0:
+            results = _get_pool().map(lambda serverurl: _locateSingle(serverurl, filename), servers)
+            for serverurl, (found, dt) in zip(servers, results):
+                if found:
+                    locs.append((serverurl + filename, dt))
 
         if len(locs) > 0:
             #cache if we found something (this is safe due to write-once nature of fs)
@@ -362,22 +370,28 @@ def locate_file(filename, serverfilter=local_serverfilter, return_first_hit=Fals
 _pool = None
 
 _list_dir_lock = threading.Lock()
+_pool_lock = threading.Lock()
+def _get_pool():
+    global _pool
+    from multiprocessing.pool import ThreadPool
+    
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(10)
+            
+        return _pool
+    
 def listdirectory(dirname, serverfilter=local_serverfilter, timeout=5):
     """Lists the contents of a directory on the cluster.
 
     Returns a dictionary mapping filenames to clusterListing.FileInfo named tuples.
     """
-    global _pool
     from . import clusterListing as cl
-    from multiprocessing.pool import ThreadPool
 
     dirname = (dirname)
     serverfilter = (serverfilter)
 
     with _list_dir_lock:
-        if _pool is None:
-            _pool = ThreadPool(10)
-    
         dirlist = dict()
     
         urls = []
@@ -402,7 +416,7 @@ def listdirectory(dirname, serverfilter=local_serverfilter, timeout=5):
                 else:
                     urls.append('http://%s:%d/%s' % (socket.inet_ntoa(info.address), info.port, dirname))
     
-        listings = _pool.map(_listSingleDir, urls)
+        listings = _get_pool().map(_listSingleDir, urls)
     
         for dirL, dt in listings:
             cl.aggregate_dirlisting(dirlist, dirL)
@@ -500,16 +514,10 @@ def cglob(pattern, serverfilter=local_serverfilter):
     a list of files matching the glob
 
     """
-    global _pool
-    from multiprocessing.pool import ThreadPool
-
     pattern = (pattern)
     serverfilter = (serverfilter)
     
     with _list_dir_lock:
-        if _pool is None:
-            _pool = ThreadPool(10)
-        
         urls = []
         
         services = get_ns().get_advertised_services()
@@ -525,9 +533,9 @@ def cglob(pattern, serverfilter=local_serverfilter):
                     ''' % (name, len(services)))
                 
                 else:
-                    urls.append('http://%s:%d/__glob?pattern=%s' % (socket.inet_ntoa(info.address), info.port, pattern))
+                    urls.append('http://%s:%d/__glob?%s' % (socket.inet_ntoa(info.address), info.port, urlencode({'pattern': pattern})))
         
-        matches = _pool.map(_cglob, urls)
+        matches = _get_pool().map(_cglob, urls)
         
     #print matches
     #concatenate lists
@@ -822,51 +830,101 @@ def get_file(filename, serverfilter=local_serverfilter, numRetries=3, use_file_c
 
 _last_access_time = {}
 _lastwritespeed = {}
-#_diskfreespace = {}
+_virtual_time = {}
+_diskfreespace = {}
+_diskfreespace_expiry = 0
+
+#speed to assume for servers we haven't written to yet (bytes/s)
+DEFAULT_WRITE_SPEED = 100e6
+#only writes larger than this are used to estimate write speeds
+MIN_SPEED_SAMPLE_BYTES = 1e6
+#how far (in s of writing) a server which has not been used for a while can fall behind the others in our write schedule
+MAX_SCHEDULE_LAG = 1.0
+#how often to refresh our knowledge of free space on the servers (s)
+FREE_SPACE_UPDATE_INTERVAL = 10
+#don't write to servers with less than this much space free (unless they all are)
+MIN_FREE_SPACE = float(config.get('clusterIO-min_free_space_gb', 1))*1e9
 
 
 def _netloc(info):
     return ('%s:%s' % (socket.inet_ntoa(info.address), info.port))
 
 
+def _update_write_speed(name, nbytes, dt):
+    """Record the measured write speed for a server (as an exponential moving average)"""
+    if nbytes < MIN_SPEED_SAMPLE_BYTES:
+        #the time taken to write small files is dominated by latency and tells us little about the speed
+        return
+    
+    speed = nbytes/(dt + .001)
+    _lastwritespeed[name] = 0.5*(_lastwritespeed.get(name, speed) + speed)
+    
+
+def _update_free_space(serverfilter):
+    try:
+        for st in get_status(serverfilter):
+            if st.get('Responsive', False) and ('Disk' in st):
+                _diskfreespace['%s:%s' % (st['IPAddress'], st['Port'])] = st['Disk']['free']
+    except Exception:
+        logger.exception('Error getting server free space')
+        
+
 _choose_server_lock = threading.Lock()
-def _chooseServer(serverfilter=local_serverfilter, exclude_netlocs=[]):
+def _chooseServer(serverfilter=local_serverfilter, exclude_netlocs=[], nbytes=0):
     """chose a server to save to by minimizing a cost function
 
-    currently takes the server which has been waiting longest
-
-    TODO: add free disk space and improve metrics/weightings
+    Writes are scheduled on each server in "virtual time" (the time it would have taken each server to write everything
+    we have sent it at its measured write speed) and we take the server which would finish writing `nbytes` soonest.
+    This stripes data across the servers in proportion to their write speeds (e.g. when streaming data with
+    `PYME.Acquire.HTTPSpooler`), and reduces to taking the server which has been waiting longest when speeds are equal
+    or unknown. Servers which are low on disk space (see `clusterIO-min_free_space_gb`) are only used if there is no
+    alternative.
 
     """
+    global _diskfreespace_expiry
+    
     serv_candidates = [((k), (v)) for k, v in get_ns().get_advertised_services() if
                        (serverfilter in (k)) and not (_netloc(v) in exclude_netlocs)]
+    
+    if (len(serv_candidates) == 0) and (len(exclude_netlocs) > 0):
+        #nowhere else to go - fall back to the excluded servers
+        return _chooseServer(serverfilter, [], nbytes)
 
     with _choose_server_lock:
         t = time.time()
+        
+        if t > _diskfreespace_expiry:
+            #refresh free space in the background so as not to hold up the write
+            _diskfreespace_expiry = t + FREE_SPACE_UPDATE_INTERVAL
+            ft = threading.Thread(target=_update_free_space, args=(serverfilter,))
+            ft.daemon = True
+            ft.start()
+            
+        known_speeds = list(_lastwritespeed.values())
+        default_speed = np.median(known_speeds) if len(known_speeds) > 0 else DEFAULT_WRITE_SPEED
+        
+        #new servers start level with the least busy of the others, and those we haven't used for a while are not
+        #allowed to fall too far behind (otherwise they would get all the data until they caught up)
+        vts = [_virtual_time[k] for k, v in serv_candidates if k in _virtual_time]
+        vt_new = min(vts) if len(vts) > 0 else 0
+        for k, v in serv_candidates:
+            _virtual_time.setdefault(k, vt_new)
+        
+        vt_min = max([_virtual_time[k] for k, v in serv_candidates]) - MAX_SCHEDULE_LAG
     
         costs = []
         for k, v in serv_candidates:
-            try:
-                cost = _last_access_time[k] - t
-            except KeyError:
-                cost = -100
+            finish_time = max(_virtual_time[k], vt_min) + nbytes/_lastwritespeed.get(k, default_speed)
+            low_space = _diskfreespace.get(_netloc(v), np.inf) < (MIN_FREE_SPACE + nbytes)
                 
-    #        try:
-    #            cost -= 0*_lastwritespeed[k]/1e3
-    #        except KeyError:
-    #            pass
-            
-            #try:
-            #    cost -= _lastwritespeed[k]
-            #except KeyError:
-            #    pass
-    
-            costs.append(cost)  # + .1*np.random.normal())
+            #break ties on the time since we last used the server (round robin when idle)
+            costs.append((low_space, finish_time, _last_access_time.get(k, t - 100)))
             
-        name, info = serv_candidates[np.argmin(costs)]
+        i = min(range(len(costs)), key=lambda i: costs[i])
+        name, info = serv_candidates[i]
     
-        #t = time.time()
         _last_access_time[name] = t
+        _virtual_time[name] = costs[i][1]
     
         return name, info
 
@@ -941,7 +999,7 @@ def put_file(filename, data, serverfilter=local_serverfilter):
     
     while not success and nAttempts < 3:
         nAttempts +=1
-        name, info = _chooseServer(serverfilter)
+        name, info = _chooseServer(serverfilter, nbytes=len(data))
     
         url = 'http://%s:%d/%s' % (socket.inet_ntoa(info.address), info.port, filename)
         print(repr(url))
@@ -957,7 +1015,7 @@ def put_file(filename, data, serverfilter=local_serverfilter):
             if not r.status_code == 200:
                 raise RuntimeError('Put failed with %d: %s' % (r.status_code, r.content))
 
-            _lastwritespeed[name] = len(data) / (dt + .001)
+            _update_write_speed(name, len(data), dt)
             
             success = True
 
@@ -1099,9 +1157,11 @@ if USE_RAW_SOCKETS:
         
         nRetries = 0
         nChunksRemaining = len(files)
+        failed_netlocs = []
         
         while nRetries < 3 and nChunksRemaining > 0:
-            name, info = _chooseServer(serverfilter)
+            name, info = _chooseServer(serverfilter, exclude_netlocs=failed_netlocs,
+                                       nbytes=sum([len(d) for f, d in files[-nChunksRemaining:]]))
             #logger.debug('Chose server: %s:%d' % (name, info.port))
             try:
                 t = time.time()
@@ -1163,10 +1223,11 @@ if USE_RAW_SOCKETS:
                     fp.close()
 
                 dt = time.time() - t
-                _lastwritespeed[name] = datalen / (dt + .001)
+                _update_write_speed(name, datalen, dt)
                     
             
             except socket.timeout:
+                failed_netlocs.append(_netloc(info))
                 if nRetries < 2:
                     nRetries += 1
                     logger.error('Timeout writing to %s, trying another server for %d remaining files' % (socket.inet_ntoa(info.address), nChunksRemaining))
@@ -1175,6 +1236,7 @@ if USE_RAW_SOCKETS:
                     raise
                 
             except socket.error:
+                failed_netlocs.append(_netloc(info))
                 if nRetries < 2:
                     nRetries += 1
                     logger.exception('Error writing to %s, trying another server for %d remaining files' % (socket.inet_ntoa(info.address), nChunksRemaining))
@@ -1226,7 +1288,7 @@ else:
         files = [(f) for f in files]
         serverfilter = (serverfilter)
         
-        name, info = _chooseServer(serverfilter)
+        name, info = _chooseServer(serverfilter, nbytes=sum([len(d) for f, d in files]))
 
         for filename, data in files:
             unifiedIO.assert_name_ok(filename)
@@ -1242,7 +1304,7 @@ else:
             if not r.status_code == 200:
                 raise RuntimeError('Put failed with %d: %s' % (r.status_code, r.content))
 
-            _lastwritespeed[name] = len(data) / (dt + .001)
+            _update_write_speed(name, len(data), dt)
 
             r.close()
 
@@ -94,6 +94,7 @@ def aggregate_dirlisting(dir_list, single_dir):
 import threading
 import time
 import os
+from PYME import config
 
 class DirCache(object):
     def __init__(self, cache_size = 1000, lifetime_s=(0.5*60)):
@@ -147,6 +148,8 @@ class DirCache(object):
                 p_dir[dn] = FileInfo(dir_info[0], dir_info[1] + 1)
                 
             dir[fname] = FileInfo(FILETYPE_NORMAL, fs + filesize)
+            
+        location_index.add(filename)
         
     
     def _add_entry(self, dirname, listing):
@@ -195,6 +198,121 @@ class DirCache(object):
     
             
 dir_cache = DirCache()
+
+
+class LocationIndex(object):
+    def __init__(self, max_directories=100, lifetime_s=30):
+        """
+        An index of the files held by a data server, used to answer "do you have file X" and "which files start with Y"
+        queries (see `PYME.IO.clusterIO.locate_file` and `PYME.IO.clusterIO.cglob`) without the client having to
+        download, and the server having to generate, complete directory listings.
+
+        Directories are indexed (by name only, without the `stat` calls needed for a full listing) the first time they
+        are queried, and the index is then kept up to date as files are written through the data server (see
+        `DirCache.update_cache`). Entries are re-read after `lifetime_s` to pick up files which were added to the data
+        root by other means.
+
+        Parameters
+        ----------
+        max_directories : int
+            the maximum number of directories to keep indexed. The least recently used are discarded first.
+        lifetime_s : float
+            how long to keep directory entries before re-reading them.
+        """
+        from collections import OrderedDict
+        
+        self._max_directories = max_directories
+        self._lifetime_s = lifetime_s
+        self._dirs = OrderedDict() # {dirname : (set of names, expiry)}
+        
+        self._lock = threading.Lock()
+        
+    def _names(self, dirname):
+        """The (indexed) names in a directory. Returns an empty set if the directory doesn't exist"""
+        dirname = os.path.abspath(dirname)
+        with self._lock:
+            try:
+                names, expiry = self._dirs.pop(dirname)
+                if expiry >= time.time():
+                    #move to the end (most recently used)
+                    self._dirs[dirname] = (names, expiry)
+                    return names
+            except KeyError:
+                pass
+        
+        try:
+            names = set(os.listdir(dirname))
+        except OSError:
+            #no such directory - nothing to index
+            return set()
+        
+        with self._lock:
+            self._dirs[dirname] = (names, time.time() + self._lifetime_s)
+            while len(self._dirs) > self._max_directories:
+                self._dirs.popitem(last=False)
+                
+        return names
+    
+    def add(self, filename):
+        """Record that a file has been written (only needed for directories we have already indexed)"""
+        dirname, fname = os.path.split(os.path.abspath(filename))
+        with self._lock:
+            try:
+                self._dirs[dirname][0].add(fname)
+            except KeyError:
+                #not indexed (yet), we'll find it when we list the directory
+                pass
+            
+            #the directory itself might be new
+            parent, dn = os.path.split(dirname)
+            try:
+                self._dirs[parent][0].add(dn)
+            except KeyError:
+                pass
+    
+    def has_file(self, filename):
+        """Do we have a given file (or directory)?"""
+        dirname, fname = os.path.split(os.path.abspath(filename))
+        with self._lock:
+            try:
+                if fname in self._dirs[dirname][0]:
+                    return True
+            except KeyError:
+                pass
+        
+        #if the directory is not indexed, a stat is cheaper than indexing it. If it is, the file might have been added
+        #since we indexed it.
+        if os.path.exists(filename):
+            self.add(filename)
+            return True
+        
+        return False
+    
+    def find_prefix(self, dirname, prefix=''):
+        """Sorted names of the entries in a directory which start with `prefix`"""
+        return sorted([n for n in self._names(dirname) if n.startswith(prefix)])
+    
+    def glob(self, pattern):
+        """
+        An equivalent to `glob.glob`, which uses the index if only the last path component contains wildcards (the
+        common case, e.g. `series/frame*.pzf`).
+        """
+        import glob
+        import fnmatch
+        
+        dirname, fpattern = os.path.split(pattern)
+        if glob.has_magic(dirname) or not glob.has_magic(fpattern):
+            return glob.glob(pattern)
+        
+        names = self._names(dirname if dirname else os.curdir)
+        if not fpattern.startswith('.'):
+            #as for glob, hidden files are only matched by patterns which start with a '.'
+            names = [n for n in names if not n.startswith('.')]
+        
+        return [os.path.join(dirname, n) for n in sorted(fnmatch.filter(names, fpattern))]
+        
+
+location_index = LocationIndex(lifetime_s=float(config.get('dataserver-location_index_lifetime', 30)))
         
 
 
@@ -2,6 +2,7 @@ from . import clusterIO
 from . import image
 #from . import PZFFormat
 from . import MetaDataHandler
+from . import recordFormat
 import requests
 import numpy as np
 #import cStringIO
@@ -115,6 +116,14 @@ def pickResultsServer(filename, serverfilter=clusterIO.local_serverfilter):
 def fileResults(URI, data_raw):
     # translate data into wire format
     output_format = None
+    
+    if URI.endswith('.h5r') and hasattr(data_raw, 'results') and hasattr(data_raw, 'driftResults'):
+        # legacy fitResult object destined for the top level of an h5r file. Rather than pickling it (which the data
+        # server will not accept by default), send the results and drift results to their respective tables.
+        for tablename, data in [('FitResults', data_raw.results), ('DriftResults', data_raw.driftResults)]:
+            if len(data) > 0:
+                fileResults(URI + '/' + tablename, np.asarray(data))
+        return
 
     if URI.endswith('.csv') or URI.endswith('.txt') or URI.endswith('.log'):
         output_format = 'text/csv'
@@ -152,8 +161,8 @@ def fileResults(URI, data_raw):
         data = data.getvalue()
 
     elif isinstance(data_raw, np.ndarray):
-        #very reluctantly use pickle to serialize numpy arrays rather than the better .npy format as reading .npy is really slow.
-        data = data_raw.dumps()
+        #use our binary record stream format (fast to decode, and unlike pickle, safe to decode on the server)
+        data = recordFormat.dumps(data_raw)
 
     elif isinstance(data_raw, MetaDataHandler.MDHandlerBase):
         output_format = 'text/json'
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+A compact binary format for acquisition events, which (unlike a single json file written at the end of the acquisition)
+can be written incrementally by appending to a file as events occur. Used by :class:`PYME.Acquire.HTTPSpooler.Spooler`
+to write `events.bin` alongside the frames of a series, and read by
+:class:`PYME.IO.DataSources.ClusterPZFDataSource.DataSource`.
+
+An event log is a concatenation of blocks, each of which is self-contained (so blocks can be appended using the
+`__aggregate_txt` endpoint of the data server without any co-ordination). Each block consists of:
+
+======  ==================  ============================================================================
+offset  type                description
+======  ==================  ============================================================================
+0       2 bytes             block ID - `b'EV'`
+2       uint8               format version
+3       uint8               reserved
+4       uint32              number of events in the block (`N`)
+8       uint64              length of the description heap in bytes (`L`)
+16      N*`record_dtype`    fixed width event records - name, time, and the offset and length of the
+                            description in the heap
+...     L bytes             description heap (utf-8 encoded descriptions, concatenated)
+======  ==================  ============================================================================
+
+All integers are little endian, and description offsets are relative to the start of the heap of the block they are in.
+Most users will just want the :func:`dumps` and :func:`loads` functions.
+"""
+import numpy as np
+import six
+
+import logging
+logger = logging.getLogger(__name__)
+
+BLOCK_ID = b'EV'
+FORMAT_VERSION = 1
+
+header_dtype = np.dtype([('ID', 'S2'), ('Version', 'u1'), ('Reserved', 'u1'), ('NumEvents', '<u4'),
+                         ('DescrLength', '<u8')])
+
+record_dtype = np.dtype([('EventName', 'S32'), ('Time', '<f8'), ('DescrOffset', '<u4'), ('DescrLength', '<u4')])
+
+HEADER_LENGTH = header_dtype.itemsize
+
+#the record array returned by loads (matches what the data sources return from getEvents)
+EVENTS_DTYPE = np.dtype([('EventName', 'S32'), ('Time', 'f8'), ('EventDescr', 'S256')])
+
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return six.text_type(s).encode('utf8')
+
+
+def is_event_log(data):
+    """Test whether data (bytes-like) looks like it is in event log format"""
+    return bytes(data[:2]) == BLOCK_ID
+
+
+def dumps(events):
+    """
+    Encode events as a single event log block.
+
+    Parameters
+    ----------
+    events : list or ndarray
+        either a list of (name, description, time) tuples (as recorded by the spooler event loggers), or a record array
+        with 'EventName', 'EventDescr', and 'Time' fields
+
+    Returns
+    -------
+    bytes
+    """
+    if isinstance(events, np.ndarray):
+        names, descrs, times = events['EventName'], events['EventDescr'], events['Time']
+    elif len(events) > 0:
+        names, descrs, times = zip(*events)
+    else:
+        names, descrs, times = [], [], []
+
+    descrs = [_to_bytes(d) for d in descrs]
+    lengths = np.array([len(d) for d in descrs], dtype='u8')
+    offsets = np.cumsum(lengths) - lengths
+
+    records = np.zeros(len(descrs), dtype=record_dtype)
+    records['EventName'] = [_to_bytes(n) for n in names]
+    records['Time'] = times
+    records['DescrOffset'] = offsets
+    records['DescrLength'] = lengths
+
+    header = np.zeros(1, dtype=header_dtype)
+    header['ID'] = BLOCK_ID
+    header['Version'] = FORMAT_VERSION
+    header['NumEvents'] = len(records)
+    header['DescrLength'] = int(lengths.sum())
+
+    return header.tobytes() + records.tobytes() + b''.join(descrs)
+
+
+def _blocks(data):
+    """Iterate over the (records, heap) of each complete block in data"""
+    data = memoryview(data)
+    pos = 0
+    while (len(data) - pos) >= HEADER_LENGTH:
+        header = np.frombuffer(data, dtype=header_dtype, count=1, offset=pos)[0]
+        if header['ID'] != BLOCK_ID:
+            raise ValueError('Invalid event log block at offset %d' % pos)
+
+        n_events = int(header['NumEvents'])
+        records_start = pos + HEADER_LENGTH
+        heap_start = records_start + n_events*record_dtype.itemsize
+        block_end = heap_start + int(header['DescrLength'])
+
+        if block_end > len(data):
+            #a block which is still being written (we can read a log while it is being appended to)
+            logger.debug('Ignoring incomplete event log block at offset %d' % pos)
+            return
+
+        yield np.frombuffer(data, dtype=record_dtype, count=n_events, offset=records_start), data[heap_start:block_end]
+        pos = block_end
+
+
+def loads(data):
+    """
+    Decode an event log (one or more blocks).
+
+    Parameters
+    ----------
+    data : bytes-like
+        the contents of an event log file. An incomplete final block (as can be seen when reading a log which is still
+        being written) is ignored.
+
+    Returns
+    -------
+    ndarray with dtype `EVENTS_DTYPE` (fields 'EventName', 'Time', and 'EventDescr')
+    """
+    blocks = list(_blocks(data))
+    n_events = sum([len(records) for records, heap in blocks])
+
+    events = np.empty(n_events, dtype=EVENTS_DTYPE)
+    i = 0
+    for records, heap in blocks:
+        n = len(records)
+        heap = heap.tobytes()
+
+        events['EventName'][i:(i + n)] = records['EventName']
+        events['Time'][i:(i + n)] = records['Time']
+        events['EventDescr'][i:(i + n)] = [heap[o:(o + l)] for o, l in zip(records['DescrOffset'].tolist(),
+                                                                           records['DescrLength'].tolist())]
+        i += n
+
+    return events
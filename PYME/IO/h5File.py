@@ -20,14 +20,22 @@ def openH5(filename, mode='r'):
     else:
         key2 = None
     
-    with h5rFile.openLock:
-        if key in h5rFile.file_cache and h5rFile.file_cache[key].is_alive:
-            return h5rFile.file_cache[key]
-        elif key2 in h5rFile.file_cache and h5rFile.file_cache[key2].is_alive:
-            return h5rFile.file_cache[key2]
-        else:
-            h5rFile.file_cache[key] = H5File(filename, mode)
-            return h5rFile.file_cache[key]
+    while True:
+        with h5rFile.openLock:
+            closing = [f for f in [h5rFile.file_cache.get(k, None) for k in (key, key2)] if f is not None and not f.is_alive]
+            
+            if len(closing) == 0:
+                if key in h5rFile.file_cache:
+                    return h5rFile.file_cache[key]
+                elif key2 in h5rFile.file_cache:
+                    return h5rFile.file_cache[key2]
+                else:
+                    h5rFile.file_cache[key] = H5File(filename, mode)
+                    return h5rFile.file_cache[key]
+                
+        #a cached file is in the process of closing - wait for it to finish before we re-open (see h5rFile.openH5R)
+        for f in closing:
+            f._pollThread.join()
 
 
 
@@ -35,6 +43,9 @@ class H5File(h5rFile.H5RFile):
     PZFCompression = PZFFormat.DATA_COMP_HUFFCODE
     KEEP_ALIVE_TIMEOUT = 120
     
+    def _reopen(self, mode):
+        return openH5(self.filename, mode)
+    
     @property
     def image_data(self):
         try:
@@ -113,6 +124,13 @@ class H5File(h5rFile.H5RFile):
             except AttributeError:
                 raise IOError('File has no events')
             #raise NotImplementedError('reading events not yet implemented')
+        elif filename == 'events.bin':
+            #binary event log (see PYME.IO.eventFormat)
+            from PYME.IO import eventFormat
+            try:
+                return eventFormat.dumps(self._h5file.root.Events[:])
+            except AttributeError:
+                raise IOError('File has no events')
         else:
             #names have the form "frameXXXXX.pzf, get frame num
             if not filename.startswith('frame'):
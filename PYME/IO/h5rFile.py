@@ -17,24 +17,48 @@ file_cache = {}
 
 openLock = threading.Lock()
 
+def close_all(timeout=None):
+    """
+    Close all open files once any pending appends have been written (used on clean server shutdown).
+
+    Parameters
+    ----------
+    timeout : float
+        maximum time to wait for each file to close (None = wait indefinitely)
+    """
+    with openLock:
+        open_files = list(file_cache.values())
+    
+    for f in open_files:
+        f.close_when_idle()
+    
+    for f in open_files:
+        f._pollThread.join(timeout)
+        
+
 def openH5R(filename, mode='r'):
     key = filename
     
-    with openLock:
-        if key in file_cache and file_cache[key].is_alive:
-            f = file_cache[key]
-            if f.mode == 'r' and not mode == 'r':
-                raise IOError('File already open in read-only mode, mode %s requested' % mode)
-            else:
-                return f
-        else:
-            file_cache[key] = H5RFile(filename, mode)
-            return file_cache[key]
+    while True:
+        with openLock:
+            f = file_cache.get(key, None)
+            if f is None:
+                file_cache[key] = H5RFile(filename, mode)
+                return file_cache[key]
+            elif f.is_alive:
+                if f.mode == 'r' and not mode == 'r':
+                    raise IOError('File already open in read-only mode, mode %s requested' % mode)
+                else:
+                    return f
+        
+        #the cached file is in the process of closing - wait for it to finish before we re-open
+        f._pollThread.join()
 
 
 class H5RFile(object):
-    KEEP_ALIVE_TIMEOUT = 20 #keep the file open for 20s after the last time it was used
+    KEEP_ALIVE_TIMEOUT = config.get('h5r-keep_alive_timeout', 20) #keep the file open for 20s after the last time it was used
     FLUSH_INTERVAL = config.get('h5r-flush_interval', 1)
+    FLUSH_BYTES = config.get('h5r-flush_bytes', 50e6) #write and flush early if we accumulate this much data
     
     def __init__(self, filename, mode='r'):
         self.filename = filename
@@ -53,6 +77,9 @@ class H5RFile(object):
         # and our local thread
         self.appendQueueLock = threading.Lock()
         self.appendQueues = {}
+        self._pendingBytes = 0
+        self._unflushedBytes = 0
+        self._dataWaiting = threading.Event()
         #self.appendVLQueues = {}
 
         self.keepAliveTimeout = time.time() + self.KEEP_ALIVE_TIMEOUT
@@ -148,9 +175,55 @@ class H5RFile(object):
     def appendToTable(self, tablename, data):
         #logging.debug('h5rfile - append to table: %s' % tablename)
         with self.appendQueueLock:
-            if not tablename in self.appendQueues.keys():
-                self.appendQueues[tablename] = collections.deque()
-            self.appendQueues[tablename].append(data)
+            if self.is_alive:
+                if not tablename in self.appendQueues.keys():
+                    self.appendQueues[tablename] = collections.deque()
+                self.appendQueues[tablename].append(data)
+                
+                self._pendingBytes += getattr(data, 'nbytes', len(data))
+                if self._pendingBytes > self.FLUSH_BYTES:
+                    #wake up the poll thread rather than waiting for the next poll
+                    self._dataWaiting.set()
+                    
+                return
+        
+        # our poll thread has stopped and nothing we queue now would be written (we can be handed out from the file
+        # cache just as the poll thread decides to close). Re-open the file and append there instead, taking care not
+        # to truncate it.
+        logging.debug('H5RFile - append after close, re-opening %s' % self.filename)
+        self._reopen('a' if self.mode == 'w' else self.mode).appendToTable(tablename, data)
+        
+    def _reopen(self, mode):
+        """Get an open file object for the same file (overridden in subclasses which use a different open function)"""
+        return openH5R(self.filename, mode)
+                
+    def close_when_idle(self):
+        """Close the file as soon as all pending data has been written and there are no active users"""
+        with self.appendQueueLock:
+            self.keepAliveTimeout = 0
+        
+        self._dataWaiting.set()
+        
+    def _coalesced(self, entries):
+        """
+        Merge runs of record arrays with the same dtype so that we can write them to the table with a single append call
+        (much cheaper than lots of small appends for pytables). Strings (e.g. PZF frames) are passed through unchanged.
+        """
+        run = []
+        for e in entries:
+            if isinstance(e, np.ndarray) and e.dtype.names is not None:
+                if len(run) > 0 and not e.dtype == run[0].dtype:
+                    yield np.hstack(run)
+                    run = []
+                run.append(e)
+            else:
+                if len(run) > 0:
+                    yield np.hstack(run)
+                    run = []
+                yield e
+                
+        if len(run) > 0:
+            yield np.hstack(run)
 
     def getTableData(self, tablename, _slice):
         with tablesLock:
@@ -162,19 +235,41 @@ class H5RFile(object):
 
         return res
 
-    def _pollQueues(self):
-        queuesWithData = False
+    def _writeQueues(self, tablenames):
+        """Write everything waiting in the append queues for the given tables (called from the poll thread)"""
+        for tablename in tablenames:
+            waiting = self.appendQueues[tablename]
+            entries = []
+            try:
+                while len(waiting) > 0:
+                    entries.append(waiting.popleft())
+            except IndexError:
+                pass
+            
+            nbytes = 0
+            for data in self._coalesced(entries):
+                self._appendToTable(tablename, data)
+                nbytes += getattr(data, 'nbytes', len(data))
+                
+            with self.appendQueueLock:
+                self._pendingBytes -= nbytes
+            self._unflushedBytes += nbytes
 
+    def _pollQueues(self):
         # logging.debug('h5rfile - poll')
 
         try:
-            while self.useCount > 0 or queuesWithData or time.time() < self.keepAliveTimeout:
+            while True:
                 #logging.debug('poll - %s' % time.time())
                 with self.appendQueueLock:
                     #find queues with stuff to save
                     tablenames = [k for k, v in self.appendQueues.items() if len(v) > 0]
-
-                queuesWithData = len(tablenames) > 0
+                    
+                    if not (self.useCount > 0 or len(tablenames) > 0 or time.time() < self.keepAliveTimeout):
+                        # decide to close under the queue lock, so that appendToTable either queues its data before
+                        # this point (and it gets written below), or sees that we are no longer alive.
+                        self.is_alive = False
+                        break
 
                 #iterate over the queues
                 # for tablename in tablenames:
@@ -186,22 +281,17 @@ class H5RFile(object):
                 #     rows = np.hstack(entries)
                 #     self._appendToTable(tablename, rows)
 
-                #iterate over the queues (in a threadsafe manner)
-                for tablename in tablenames:
-                    waiting = self.appendQueues[tablename]
-                    try:
-                        while len(waiting) > 0:
-                            self._appendToTable(tablename, waiting.popleft())
-                    except IndexError:
-                        pass
+                self._writeQueues(tablenames)
 
                 curTime = time.time()
-                if (curTime - self._lastFlushTime) > self.FLUSH_INTERVAL:
+                if ((curTime - self._lastFlushTime) > self.FLUSH_INTERVAL) or (self._unflushedBytes > self.FLUSH_BYTES):
                     with tablesLock:
                         self._h5file.flush()
                     self._lastFlushTime = curTime
+                    self._unflushedBytes = 0
 
-                time.sleep(0.1)
+                self._dataWaiting.wait(0.1)
+                self._dataWaiting.clear()
 
         except:
             traceback.print_exc()
@@ -210,12 +300,21 @@ class H5RFile(object):
             logging.debug('H5RFile - closing: %s' % self.filename)
             #remove ourselves from the cache
             with openLock:
-                try:
-                    file_cache.pop((self.filename, self.mode))
-                except KeyError:
-                    pass
+                #file_cache keys differ between h5rFile and h5File - find the one(s) pointing to us
+                for k in [k for k, v in file_cache.items() if v is self]:
+                    file_cache.pop(k)
     
-                self.is_alive = False
+                with self.appendQueueLock:
+                    self.is_alive = False
+                
+                #write anything which was queued after our last poll
+                try:
+                    with self.appendQueueLock:
+                        tablenames = list(self.appendQueues.keys())
+                    self._writeQueues(tablenames)
+                except:
+                    logging.exception('Error writing queued data to %s' % self.filename)
+                    
                 #finally, close the file
                 with tablesLock:
                     self._h5file.close()
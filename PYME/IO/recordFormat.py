@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Defines a simple 'wire' format for transmitting numpy record arrays (e.g. localization results) between cluster nodes,
+as used by :func:`PYME.IO.clusterResults.fileResults` and the aggregation endpoints of the data server.
+
+Unlike pickle, decoding this format does not execute arbitrary code, and (for uncompressed streams) the decoded array is
+a zero-copy view onto the received data. Unlike the .npy format, the header is binary and fixed-size so decoding is
+cheap.
+
+The format is:
+
+======  =============  ==================================================================================
+offset  type           description
+======  =============  ==================================================================================
+0       2 bytes        format ID - `b'RS'`
+2       uint8          format version
+3       uint8          compression (one of `COMPRESSION_NONE` or `COMPRESSION_ZLIB`)
+4       uint32         length of the dtype description in bytes (`L`)
+8       uint64         number of rows
+16      uint64         length of the (possibly compressed) row data in bytes
+24      L bytes        dtype description as utf-8 encoded JSON, as given by `numpy.lib.format.dtype_to_descr`
+...     ...            padding (spaces) so that the row data starts at a multiple of 8 bytes
+...     ...            the row data, in native numpy (C) order
+======  =============  ==================================================================================
+
+All integers are little endian. Most users will just want the :func:`dumps` and :func:`loads` functions.
+"""
+import numpy as np
+import json
+import zlib
+
+FILE_FORMAT_ID = b'RS'
+FORMAT_VERSION = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+
+header_dtype = np.dtype([('ID', 'S2'), ('Version', 'u1'), ('Compression', 'u1'), ('DescrLength', '<u4'),
+                         ('NumRows', '<u8'), ('DataLength', '<u8')])
+
+HEADER_LENGTH = header_dtype.itemsize
+
+DATA_ALIGNMENT = 8
+
+
+def _tuples(descr):
+    """json turns the tuples in a dtype description into lists - turn them back"""
+    if isinstance(descr, list):
+        return [tuple(_tuples(d) for d in field) if isinstance(field, list) else field for field in descr]
+    else:
+        return descr
+
+
+def _descr_to_dtype(descr):
+    try:
+        return np.lib.format.descr_to_dtype(descr)
+    except AttributeError:
+        #numpy < 1.17
+        return np.dtype(descr)
+
+
+def is_record_stream(data):
+    """Test whether data (bytes-like) looks like it is in record stream format"""
+    return bytes(data[:2]) == FILE_FORMAT_ID
+
+
+def dumps(data, compression=COMPRESSION_NONE, level=1):
+    """
+    Encode an array in record stream format.
+
+    Parameters
+    ----------
+    data : ndarray
+        array to encode (typically a 1D record array). Multi-dimensional arrays are flattened.
+    compression : int
+        one of `COMPRESSION_NONE` or `COMPRESSION_ZLIB`. Compression is usually unnecessary when sending over HTTP as
+        the transport already gzips.
+    level : int
+        zlib compression level
+
+    Returns
+    -------
+    bytes
+    """
+    data = np.ascontiguousarray(data).ravel()
+
+    descr = json.dumps(np.lib.format.dtype_to_descr(data.dtype)).encode('utf-8')
+    pad = (DATA_ALIGNMENT - (HEADER_LENGTH + len(descr)) % DATA_ALIGNMENT) % DATA_ALIGNMENT
+    descr += b' '*pad
+
+    if compression == COMPRESSION_ZLIB:
+        rows = zlib.compress(data.tobytes(), level)
+    elif compression == COMPRESSION_NONE:
+        rows = data.view('u1')
+    else:
+        raise RuntimeError('Unknown compression: %s' % compression)
+
+    header = np.zeros(1, header_dtype)
+    header['ID'] = FILE_FORMAT_ID
+    header['Version'] = FORMAT_VERSION
+    header['Compression'] = compression
+    header['DescrLength'] = len(descr)
+    header['NumRows'] = len(data)
+    header['DataLength'] = len(rows)
+
+    return b''.join([header.tobytes(), descr, rows.tobytes() if isinstance(rows, np.ndarray) else rows])
+
+
+def loads(data):
+    """
+    Decode an array from record stream format.
+
+    Parameters
+    ----------
+    data : bytes-like
+        the encoded data
+
+    Returns
+    -------
+    ndarray
+        a 1D array. For uncompressed streams this is a read-only view into `data` (call `.copy()` if you need to modify
+        it).
+    """
+    header = np.frombuffer(data, header_dtype, count=1)[0]
+
+    if not header['ID'] == FILE_FORMAT_ID:
+        raise RuntimeError("Invalid format: This doesn't appear to be a record stream")
+
+    if header['Version'] > FORMAT_VERSION:
+        raise RuntimeError('Record stream version %d not supported' % header['Version'])
+
+    descr_length = int(header['DescrLength'])
+    dtype = _descr_to_dtype(_tuples(json.loads(bytes(data[HEADER_LENGTH:(HEADER_LENGTH + descr_length)]).decode('utf-8'))))
+
+    data_offset = HEADER_LENGTH + descr_length
+    n_rows = int(header['NumRows'])
+
+    if header['Compression'] == COMPRESSION_NONE:
+        return np.frombuffer(data, dtype, count=n_rows, offset=data_offset)
+    elif header['Compression'] == COMPRESSION_ZLIB:
+        rows = zlib.decompress(bytes(data[data_offset:(data_offset + int(header['DataLength']))]))
+        return np.frombuffer(rows, dtype, count=n_rows)
+    else:
+        raise RuntimeError('Compression type not understood')
+
+
+def decode_results(data, allow_pickle=False):
+    """
+    Decode table data sent for results aggregation. Record streams are preferred, but for compatibility we also accept
+    .npy formatted data, json, and (only if `allow_pickle` is True as it is unsafe on an open network) pickles.
+
+    Parameters
+    ----------
+    data : bytes
+    allow_pickle : bool
+
+    Returns
+    -------
+    ndarray
+    """
+    if is_record_stream(data):
+        return loads(data)
+
+    if data[:6] == b'\x93NUMPY':
+        from io import BytesIO
+        return np.load(BytesIO(data), allow_pickle=False)
+
+    if allow_pickle:
+        from six.moves import cPickle
+        try:
+            return cPickle.loads(data)
+        except cPickle.UnpicklingError:
+            pass
+
+    #it's not numpy formatted - try json
+    import pandas as pd
+    #FIXME!! - this will work, but will likely be really slow!
+    return pd.read_json(data).to_records(False)
@@ -35,10 +35,22 @@ from numpy import * #to allow the use of sin cos etc in mappings
 from PYME.Analysis.piecewise import * #allow piecewise linear mappings
 
 import tables
+import threading
+import collections
 import logging
 
 logger = logging.getLogger(__name__)
 
+def _unshared(col):
+    """
+    Columns cached by the filters below are marked read-only so that they can't be modified through a view. Hand
+    callers a copy instead of a view onto the cache, so that they can still modify the column they get back.
+    """
+    if isinstance(col, np.ndarray) and not col.flags.writeable:
+        return col.copy()
+    
+    return col
+
 #helper function for renaming classes
 
 def deprecated_name(name):
@@ -399,6 +411,255 @@ class HDFSource(H5RSource):
     def getInfo(self):
         return 'PYME hdf Data Source\n\n %d points' % self.fitResults.shape[0]
 
+
+class StreamingH5RSource(TabularBase):
+    _name = "h5r Streaming Source"
+
+    # class level defaults so that these are always defined (and never fall through to TabularBase.__getattr__)
+    _h5file = None
+    _rows = None
+    _order = None
+    _columns = None
+
+    def __init__(self, h5fFile, tablename='FitResults', filters=None, chunk_size=None, sort=True):
+        """
+        Data source for h5r (and other pytables) files which, unlike `H5RSource`, does not load the whole table. Columns
+        are only read when they are first accessed (and then cached), and are read in chunks so that the temporary
+        memory needed is bounded.
+
+        Simple range filters can be pushed down to the reader with the `filters` argument, in which case they are
+        evaluated chunk by chunk (reading only the filtered columns) and only the matching rows are ever loaded. Memory
+        use is then proportional to the number of matching rows and the number of columns accessed, rather than the
+        size of the file. Range filters applied with `ResultsFilter` are also evaluated in chunks (without caching the
+        full columns).
+
+        Parameters
+        ----------
+        h5fFile : str, `PYME.IO.h5rFile.H5RFile`, or `tables.File`
+            the file to read from
+        tablename : str
+            the table to read
+        filters : dict
+            ranges to select, as for `ResultsFilter`, e.g. `{'tIndex': [1000, 2000], 'error_x': [0, 20]}`. Keys can be
+            any column name or alias (`x`, `y`, `t`, `error_x` etc ...). Ranges are exclusive.
+        chunk_size : int
+            number of rows to read at a time, defaults to the `h5r-read_chunk_rows` config option.
+        sort : bool
+            return data sorted by `tIndex` (if present) for consistency with `H5RSource`
+        """
+        from PYME.IO import h5rFile
+        from PYME import config
+
+        self.tablename = tablename
+        self._sort = sort
+        self._columns = {}
+        self._columns_lock = threading.Lock()
+
+        if chunk_size is None:
+            chunk_size = config.get('h5r-read_chunk_rows', 1e6)
+        self.chunk_size = int(chunk_size)
+
+        if isinstance(h5fFile, tables.file.File):
+            self._h5file = h5fFile
+            self._filename = None
+        elif isinstance(h5fFile, h5rFile.H5RFile):
+            #don't hold on to the H5RFile object, as it will close itself if idle - go through openH5R each time instead
+            self._filename = h5fFile.filename
+        else:
+            self._filename = h5fFile
+
+        def _describe(table):
+            return table.nrows, list(table.colpathnames)
+
+        try:
+            self._nrows, paths = self._with_table(_describe)
+        except (AttributeError, tables.NoSuchNodeError):
+            logger.exception('Was expecting to find a "%s" table' % tablename)
+            raise
+
+        #allow access using unnested original names
+        self._paths = collections.OrderedDict([(p.replace('/', '_'), p) for p in paths])
+        self._keys = list(self._paths.keys())
+
+        #or shorter aliases
+        self.transkeys = {'A' : 'fitResults_A', 'x' : 'fitResults_x0',
+                          'y' : 'fitResults_y0', 'sig' : 'fitResults_sigma',
+                          'error_x' : 'fitError_x0', 'error_y' : 'fitError_y0', 't':'tIndex'}
+
+        for k in list(self.transkeys.keys()):
+            if not self.transkeys[k] in self._keys:
+                self.transkeys.pop(k)
+
+        if filters:
+            self._rows = self._select(filters)
+
+    def _with_table(self, func):
+        """Call func(table) on our table, holding the global pytables lock"""
+        from PYME.IO import h5rFile
+
+        if self._h5file is not None:
+            with h5rFile.tablesLock:
+                return func(getattr(self._h5file.root, self.tablename))
+        else:
+            with h5rFile.openH5R(self._filename) as h5f:
+                with h5rFile.tablesLock:
+                    return func(getattr(h5f._h5file.root, self.tablename))
+
+    def _resolve(self, key):
+        #if we're using an alias replace with actual key
+        key = self.transkeys.get(key, key)
+
+        if not key in self._paths:
+            raise KeyError('Key  (%s) not found' % key)
+
+        return key
+
+    def _iter_chunks(self, paths, rows=None):
+        """
+        Read the given columns, chunk by chunk, for either all rows (`rows=None`) or the given (sorted) row numbers.
+        The lock is released between chunks so that other readers and writers are not held up.
+
+        Yields (offset, columns) where offset is the position of the first row of the chunk within `rows`.
+        """
+        n = self._nrows if rows is None else len(rows)
+        for start in range(0, n, self.chunk_size):
+            stop = min(start + self.chunk_size, n)
+
+            if rows is None:
+                _read = lambda table: [table.read(start, stop, field=p) for p in paths]
+            else:
+                _read = lambda table: [table.read_coordinates(rows[start:stop], field=p) for p in paths]
+
+            yield start, self._with_table(_read)
+
+    def _select(self, filters, rows=None):
+        """
+        Positions (within `rows`, or within the whole table if `rows` is None) which fall within the given ranges,
+        evaluated in chunks.
+        """
+        keys = [self._resolve(k) for k in filters.keys()]
+        ranges = list(filters.values())
+        for r in ranges:
+            if not len(r) == 2:
+                raise RuntimeError('Expected an iterable of length 2')
+
+        selected = []
+        for offset, cols in self._iter_chunks([self._paths[k] for k in keys], rows):
+            mask = np.ones(len(cols[0]), dtype=bool)
+            for c, r in zip(cols, ranges):
+                mask &= (c > r[0])*(c < r[1])
+
+            selected.append(np.flatnonzero(mask) + offset)
+
+        if len(selected) == 0:
+            return np.zeros(0, dtype='i8')
+
+        if rows is None:
+            return np.hstack(selected)
+        else:
+            return rows[np.hstack(selected)]
+
+    def _read_column(self, key):
+        out = None
+        for offset, cols in self._iter_chunks([self._paths[key]], self._rows):
+            c = cols[0]
+            if out is None:
+                #allocate the output once rather than concatenating chunks (which would need twice the memory)
+                out = np.empty((len(self),) + c.shape[1:], dtype=c.dtype)
+            out[offset:(offset + len(c))] = c
+
+        if out is None:
+            #no rows - get the dtype from an empty read
+            out = self._with_table(lambda table: table.read(0, 0, field=self._paths[key]))
+
+        return out
+
+    def _get_order(self):
+        """the permutation of our (file ordered) rows which sorts them by tIndex, or None if they are already sorted"""
+        if self._order is None:
+            order = False
+            if self._sort and ('tIndex' in self._paths):
+                t = self._read_column('tIndex')
+                if np.any(np.diff(t) < 0):
+                    order = np.argsort(t, kind='mergesort')
+                    self._columns['tIndex'] = t[order]
+                else:
+                    self._columns['tIndex'] = t
+
+            self._order = order
+
+        return self._order if (self._order is not False) else None
+
+    def keys(self):
+        return self._keys + list(self.transkeys.keys())
+
+    def __len__(self):
+        return self._nrows if self._rows is None else len(self._rows)
+
+    def __getitem__(self, keys):
+        key, sl = self._getKeySlice(keys)
+        key = self._resolve(key)
+
+        with self._columns_lock:
+            try:
+                col = self._columns[key]
+            except KeyError:
+                order = self._get_order()
+                try:
+                    #ordering may have cached tIndex
+                    col = self._columns[key]
+                except KeyError:
+                    col = self._read_column(key)
+                    if order is not None:
+                        col = col[order]
+                    self._columns[key] = col
+
+        return col[sl]
+
+    def select_ranges(self, **ranges):
+        """
+        Evaluate range filters (as used by `ResultsFilter`) in chunks, without reading (or caching) the full columns.
+
+        Returns
+        -------
+        mask : ndarray of bool
+            a mask of length `len(self)`, in the same order as the data returned by `__getitem__`
+        """
+        positions = self._select(ranges, self._rows)
+        if self._rows is not None:
+            #convert row numbers back to positions in our selection
+            positions = np.searchsorted(self._rows, positions)
+
+        mask = np.zeros(len(self), dtype=bool)
+        mask[positions] = True
+
+        with self._columns_lock:
+            order = self._get_order()
+        if order is not None:
+            mask = mask[order]
+
+        return mask
+
+    def iterchunks(self, keys=None):
+        """
+        Iterate over the (selected) data in chunks of at most `chunk_size` rows, without caching it, e.g. to process or
+        convert a file which is too large to load at once. Chunks are in file order (i.e. not sorted by tIndex).
+
+        Yields dictionaries of {key : column values}.
+        """
+        if keys is None:
+            keys = self._keys
+
+        resolved = [self._resolve(k) for k in keys]
+        for offset, cols in self._iter_chunks([self._paths[k] for k in resolved], self._rows):
+            yield dict(zip(keys, cols))
+
+    def close(self):
+        pass
+
+    def getInfo(self):
+        return 'PYME h5r Streaming Data Source\n\n %d points' % len(self)
+
 # class h5rDSource(inputFilter):
 #     _name = "h5r Drift Source"
 #     def __init__(self, h5fFile):
@@ -624,16 +885,45 @@ class ColumnSource(DictSource):
 class SelectionFilter(TabularBase):
     _name = "Selection Filter"
     
+    # class level defaults so that these are always defined (and never fall through to TabularBase.__getattr__)
+    _index = None
+    _column_cache = None
+    
     def __init__(self, resultsSource, index):
         """ A filter which relies on a supplied index (either integer or boolean)"""
         
         self.resultsSource = resultsSource
         
         self.Index = index
+        
+    @property
+    def Index(self):
+        return self._index
+    
+    @Index.setter
+    def Index(self, index):
+        self._index = index
+        #our index has changed, any cached columns are no longer valid
+        self._column_cache = {}
+        
+    def clear_cache(self):
+        """Discard cached columns. Only needed if the underlying data source has been modified in place."""
+        self._column_cache = {}
     
     def __getitem__(self, keys):
         key, sl = self._getKeySlice(keys)
-        return self.resultsSource[key][self.Index][sl]
+        
+        #apply our index to each column once, and keep the result
+        try:
+            col = self._column_cache[key]
+        except KeyError:
+            col = self.resultsSource[key][self.Index]
+            if isinstance(col, np.ndarray):
+                #guard the cached values against in-place modification
+                col.flags.writeable = False
+            self._column_cache[key] = col
+            
+        return _unshared(col[sl])
     
     def keys(self):
         return self.resultsSource.keys()
@@ -658,7 +948,7 @@ class ResultsFilter(SelectionFilter):
 
         #by default select everything
         #self.Index = np.ones(self.resultsSource[list(resultsSource.keys())[0]].shape[0]) >  0.5
-        self.Index = np.ones(len(self.resultsSource), dtype=np.bool)
+        self.Index = np.ones(len(self.resultsSource), dtype=bool)
 
         for k in kwargs.keys():
             if not k in self.resultsSource.keys():
@@ -668,7 +958,14 @@ class ResultsFilter(SelectionFilter):
             if not len(range) == 2:
                 raise RuntimeError('Expected an iterable of length 2')
 
-            self.Index *= (self.resultsSource[k] > range[0])*(self.resultsSource[k] < range[1])
+        if hasattr(self.resultsSource, 'select_ranges'):
+            #let the source evaluate the ranges (e.g. StreamingH5RSource, which does this in chunks without loading the
+            #full columns)
+            self.Index *= self.resultsSource.select_ranges(**kwargs)
+        else:
+            for k in kwargs.keys():
+                range = kwargs[k]
+                self.Index *= (self.resultsSource[k] > range[0])*(self.resultsSource[k] < range[1])
     
 
 @deprecated_name('randomSelectionFilter')
@@ -771,7 +1068,7 @@ class CachingResultsFilter(TabularBase):
         self.cache = {}
 
         #by default select everything
-        self.Index = np.ones(len(self.resultsSource), dtype=np.bool)
+        self.Index = np.ones(len(self.resultsSource), dtype=bool)
 
         for k in kwargs.keys():
             if not k in self.resultsSource.keys():
@@ -814,6 +1111,9 @@ class MappingFilter(TabularBase):
         if not isinstance(resultsSource, TabularBase):
             warnings.warn(VisibleDeprecationWarning('Mapping filter created with something that is not a tabular object. This will be unsupported in a future release. Consider DictSource or ColumnSource instead'))
 
+        #mapped columns are evaluated once and cached (see clear_cache)
+        self._column_cache = {}
+        
         self.resultsSource = resultsSource
 
         self.mappings = {}
@@ -829,7 +1129,7 @@ class MappingFilter(TabularBase):
     def __getitem__(self, keys):
         key, sl = self._getKeySlice(keys)
         if key in self.mappings.keys():
-            return self.getMappedResults(key, sl)
+            return _unshared(self._get_mapped_column(key)[sl])
         elif key in self.new_columns.keys():
             return self.new_columns[key][sl]
         else:
@@ -837,6 +1137,30 @@ class MappingFilter(TabularBase):
 
     def keys(self):
         return list(set(list(self.resultsSource.keys()) + list(self.mappings.keys()) + list(self.new_columns.keys())).difference(self.hidden_columns))
+    
+    def clear_cache(self):
+        """
+        Discard cached mapped columns. This happens automatically when mappings, variables, or columns are changed, but
+        needs to be called explicitly if the underlying data source is modified in place.
+        """
+        self._column_cache.clear()
+        
+    def _get_mapped_column(self, key):
+        try:
+            return self._column_cache[key]
+        except KeyError:
+            col = self.getMappedResults(key, slice(None))
+            
+            if np.ndim(col) == 0:
+                #a constant - nothing to cache (and can't be sliced)
+                return col
+            
+            # take a view so that marking the cached values read-only can't affect the data source (a mapping can
+            # evaluate to one of the source columns)
+            col = np.asarray(col).view()
+            col.flags.writeable = False
+            self._column_cache[key] = col
+            return col
 
     def addVariable(self, name, value):
         """
@@ -856,10 +1180,13 @@ class MappingFilter(TabularBase):
         #setattr(self, name, float(value))
 
         self.variables[name] = float(value)
+        self.clear_cache()
         
     def set_variables(self, **kwargs):
         for k, v in kwargs.items():
             self.variables[k] = float(v)
+            
+        self.clear_cache()
 
     def addColumn(self, name, values):
         """
@@ -884,16 +1211,24 @@ class MappingFilter(TabularBase):
         #setattr(self, name, values)
 
         self.new_columns[name] = values
+        self.clear_cache()
 
 
     def setMapping(self, key, mapping):
+        if isinstance(mapping, six.string_types):
+            mapping = compile(mapping, '/tmp/test1', 'eval')
+            
         if type(mapping) == types.CodeType:
+            if self.mappings.get(key, None) == mapping:
+                #unchanged - keep our cached values
+                return
+            
             self.mappings[key] = mapping
-        elif isinstance(mapping, six.string_types):
-            self.mappings[key] = compile(mapping, '/tmp/test1', 'eval')
         else:
             warnings.warn('setMapping should not be used to add a variable/data column', DeprecationWarning)
             self.__dict__[key] = mapping
+            
+        self.clear_cache()
 
     def getMappedResults(self, key, sl):
         map = self.mappings[key]
@@ -915,7 +1250,7 @@ class MappingFilter(TabularBase):
             elif vname in self.mappings.keys(): #finally try other mappings
                 #try to prevent infinite recursion here if mappings have circular references
                 if not vname == key and not key in self.mappings[vname].co_names:
-                    locals()[vname] = self.getMappedResults(vname, sl)
+                    locals()[vname] = self._get_mapped_column(vname)[sl]
                 else:
                     raise RuntimeError('Circular reference detected in mapping')
 
@@ -935,6 +1270,11 @@ class _ChannelFilter(TabularBase):
 @deprecated_name('colourFilter')
 class ColourFilter(TabularBase):
     _name = "Colour Filter"
+    
+    _resultsSource = None
+    _index_cache = None
+    _column_cache = None
+    
     def __init__(self, resultsSource, currentColour=None):
         """Class to permit filtering by colour
         """
@@ -949,12 +1289,38 @@ class ColourFilter(TabularBase):
         self.t_p_dye = 0.1
         self.t_p_other = 0.1
         self.t_p_background = .01
+        
+    @property
+    def resultsSource(self):
+        return self._resultsSource
+    
+    @resultsSource.setter
+    def resultsSource(self, source):
+        # NB - the pipeline re-uses the colour filter, replacing the source when it is rebuilt. This invalidates our
+        # cached channel indices and columns.
+        self._resultsSource = source
+        self.clear_cache()
+        
+    def clear_cache(self):
+        """Discard cached channel indices and columns."""
+        self._index_cache = {}
+        self._column_cache = {}
 
     @property
     def index(self):
         return self._index(self.currentColour)
-        
+    
     def _index(self, channel):
+        #cache the index for each channel (it depends on the thresholds, so include these in the key)
+        cache_key = (channel, self.t_p_dye, self.t_p_other, self.t_p_background)
+        try:
+            return self._index_cache[cache_key]
+        except KeyError:
+            index = self._calc_index(channel)
+            self._index_cache[cache_key] = index
+            return index
+        
+    def _calc_index(self, channel):
         colChans = self.getColourChans()
         if not channel in colChans:
             return np.ones(len(self.resultsSource[list(self.resultsSource.keys())[0]]), 'bool')
@@ -987,10 +1353,19 @@ class ColourFilter(TabularBase):
         else:
             #chromatic shift correction
             #print self.currentColour
+            cache_key = (chan, key, self.t_p_dye, self.t_p_other, self.t_p_background)
+            try:
+                col = self._column_cache[cache_key]
+            except KeyError:
+                col = self.resultsSource[key][self._index(chan)]
+                if isinstance(col, np.ndarray):
+                    col.flags.writeable = False
+                self._column_cache[cache_key] = col
+                
             if chan in self.chromaticShifts.keys() and key in self.chromaticShifts[chan].keys():
-                return self.resultsSource[key][self._index(chan)][sl] + self.chromaticShifts[chan][key]
+                return col[sl] + self.chromaticShifts[chan][key]
             else:
-                return self.resultsSource[key][self._index(chan)][sl]
+                return _unshared(col[sl])
             
     def get_channel_ds(self, chan):
         return _ChannelFilter(self, chan)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorised, multi-threaded splatting of Gaussians onto a regular grid (as used for Gaussian rendering of localizations
+in :func:`PYME.LMVis.visHelpers.rendGauss` and :func:`PYME.LMVis.visHelpers.rendGauss3D`).
+
+Each point is rendered over a ROI sized to its own sigma (rather than a single ROI size for all points). Points are
+binned into square tiles (in the first two dimensions) according to the pixel they fall in, and tiles are rendered in
+parallel threads. Within a tile, all points are rendered at once: the Gaussians are separable, so we evaluate a 1D
+profile along each axis for every point (masked to that point's ROI) and the tile is then the product of these profiles
+summed over points - i.e. a single matrix multiplication, which is done by BLAS (and releases the GIL).
+"""
+
+import numpy as np
+import threading
+from multiprocessing.pool import ThreadPool
+from multiprocessing import cpu_count
+
+from PYME import config
+
+NUM_THREADS = int(config.get('rendering-num_threads', cpu_count()))
+
+#minimum and maximum tile sizes (in pixels). Within these limits, tiles are sized to contain a reasonable number of points
+#(so that the per-tile overhead is amortised) and to be large compared to the ROIs of the points (see _tile_size)
+MIN_TILE_SIZE = 64
+MAX_TILE_SIZE = 512
+POINTS_PER_TILE = 64
+
+#maximum number of profile values (points x pixels) we compute in one go. Points in a tile are rendered in batches of
+#this size, which bounds the temporary memory used per thread when rendering dense (particularly 3D) tiles.
+BATCH_SIZE = 2**22
+
+#below this number of points, don't bother with threads
+MIN_POINTS_FOR_THREADING = 10000
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+def _get_pool(num_threads):
+    """Get a (lazily created and then re-used) thread pool with `num_threads` threads"""
+    with _pool_lock:
+        try:
+            return _pools[num_threads]
+        except KeyError:
+            pool = ThreadPool(num_threads)
+            _pools[num_threads] = pool
+            return pool
+
+
+def _render_tile(im, lock, grids, pos, sigmas, amps, idx, radii):
+    """
+    Render a group of points into the output image.
+
+    Parameters
+    ----------
+    im : ndarray
+        the output image
+    lock : threading.Lock
+        lock protecting writes to `im`
+    grids : list of ndarray
+        pixel centre coordinates along each axis of the output
+    pos : list of ndarray
+        point positions along each axis
+    sigmas : list of ndarray
+        point sigmas along each axis
+    amps : ndarray
+        point amplitudes
+    idx : ndarray
+        (n_points, n_dims) index of the pixel nearest to each point
+    radii : ndarray
+        (n_points, n_dims) ROI half size (in pixels) of each point along each axis.
+    """
+    n_dims = len(grids)
+
+    #the part of the image touched by these points
+    lo = np.maximum((idx - radii).min(axis=0), 0)
+    hi = np.minimum((idx + radii).max(axis=0) + 1, im.shape)
+
+    if np.any(hi <= lo):
+        return
+
+    #number of pixels in the (flattened) axes after the first
+    n_rest = int(np.prod(hi[1:] - lo[1:]))
+    
+    #render the points in batches. The profiles (and their outer product) for each batch are only computed when we get
+    #to that batch, so temporary memory use is bounded by BATCH_SIZE (and the tile itself) however many points there are.
+    batch_size = max(int(BATCH_SIZE//max(n_rest, hi[0] - lo[0])), 1)
+    tile = np.zeros((hi[0] - lo[0], n_rest), 'f')
+    for j in range(0, len(amps), batch_size):
+        b = slice(j, j + batch_size)
+        
+        #evaluate the 1D profiles along each axis, masked to the ROI of each point
+        profiles = []
+        for k in range(n_dims):
+            p = np.arange(lo[k], hi[k])
+            g = np.exp(-(grids[k][p][None, :] - pos[k][b][:, None])**2/(2*sigmas[k][b][:, None]**2))
+            g[abs(p[None, :] - idx[b, k][:, None]) > radii[b, k][:, None]] = 0
+            #single precision is plenty for rendering, and makes the matrix product ~2x faster
+            profiles.append(g.astype('f'))
+    
+        profiles[0] *= amps[b][:, None].astype('f')
+    
+        #sum over points of the outer product of the profiles. Treat the first axis separately, and combine the others
+        #into a single (n_points, n_pixels) matrix so that we can do this as a matrix product.
+        rest = profiles[1]
+        for g in profiles[2:]:
+            rest = (rest[:, :, None]*g[:, None, :]).reshape(len(rest), -1)
+            
+        tile += np.dot(profiles[0].T, rest)
+
+    region = tuple([slice(lo[k], hi[k]) for k in range(n_dims)])
+    with lock:
+        im[region] += tile.reshape(hi - lo)
+
+
+def _tile_size(radii, shape):
+    """
+    Choose a tile size so that there are enough points in a tile to make rendering them together worthwhile, and so
+    that the ROI padding around each tile is not much larger than the tile itself.
+    """
+    density_size = int(np.sqrt(POINTS_PER_TILE*float(shape[0])*shape[1]/len(radii)))
+    roi_size = 4*int(np.median(radii[:, :2].max(axis=1)))
+    
+    return max(min(density_size, MAX_TILE_SIZE), roi_size, MIN_TILE_SIZE)
+
+
+def _render_points(im, lock, grids, pos, sigmas, amps, idx, radii, num_threads):
+    n_points = len(amps)
+    shape = im.shape
+
+    tile_size = _tile_size(radii, shape)
+
+    #render points with ROIs larger than the tile separately (they would otherwise blow up the area of their tile)
+    large = radii[:, :2].max(axis=1) > tile_size
+    if np.any(large):
+        _render_points(im, lock, grids, [p[large] for p in pos], [s[large] for s in sigmas], amps[large], idx[large],
+                       radii[large], num_threads)
+
+        small = ~large
+        pos = [p[small] for p in pos]
+        sigmas = [s[small] for s in sigmas]
+        amps, idx, radii = amps[small], idx[small], radii[small]
+        n_points = len(amps)
+
+    if n_points == 0:
+        return
+
+    #bin points into tiles in the first two dimensions
+    n_tiles_y = (shape[1] + tile_size - 1)//tile_size
+    tile_id = np.clip(idx[:, 0], 0, shape[0] - 1)//tile_size*n_tiles_y + np.clip(idx[:, 1], 0, shape[1] - 1)//tile_size
+
+    order = np.argsort(tile_id, kind='mergesort')
+    bounds = np.hstack([0, np.flatnonzero(np.diff(tile_id[order])) + 1, n_points])
+
+    def _tile(i):
+        t = order[bounds[i]:bounds[i + 1]]
+        _render_tile(im, lock, grids, [p[t] for p in pos], [s[t] for s in sigmas], amps[t], idx[t], radii[t])
+
+    n_tiles = len(bounds) - 1
+    if (num_threads > 1) and (n_points >= MIN_POINTS_FOR_THREADING):
+        _get_pool(num_threads).map(_tile, range(n_tiles), chunksize=max(n_tiles//(4*num_threads), 1))
+    else:
+        for i in range(n_tiles):
+            _tile(i)
+
+
+def splat_gaussians(grids, pos, sigmas, amps, radii, num_threads=None, dtype='f'):
+    """
+    Render (sum) a set of Gaussians onto a regular grid
+
+    Parameters
+    ----------
+    grids : list of ndarray
+        pixel centre coordinates along each axis of the output (at least 2 axes). Must be regularly spaced.
+    pos : list of ndarray
+        point positions along each axis (same units as grids)
+    sigmas : list of ndarray
+        Gaussian sigma along each axis, per point
+    amps : ndarray
+        amplitude of each Gaussian
+    radii : list of ndarray
+        ROI half size (in pixels) along each axis, per point. Each Gaussian is truncated outside its ROI.
+    num_threads : int
+        number of threads to use (defaults to the `rendering-num_threads` config option)
+    dtype : dtype
+        data type of the returned image
+
+    Returns
+    -------
+    im : ndarray
+        the rendered image, with shape `[len(g) for g in grids]`
+    """
+    n_dims = len(grids)
+    shape = [len(g) for g in grids]
+    im = np.zeros(shape, dtype)
+
+    pos = [np.asarray(p, 'd').ravel() for p in pos]
+    sigmas = [np.asarray(s, 'd')*np.ones_like(pos[0]) for s in sigmas]
+    amps = np.asarray(amps, 'd')*np.ones_like(pos[0])
+
+    if len(amps) == 0 or min(shape) == 0:
+        return im
+
+    idx = np.zeros([len(amps), n_dims], 'i8')
+    r = np.zeros([len(amps), n_dims], 'i8')
+    for k, g in enumerate(grids):
+        delta = (g[1] - g[0]) if len(g) > 1 else 1
+        idx[:, k] = np.round((pos[k] - g[0])/delta).astype('i8')
+        #ROIs bigger than the image are pointless (and potentially very expensive)
+        r[:, k] = np.clip(radii[k], 0, shape[k])
+
+    #drop any points whose ROI doesn't overlap the image
+    visible = np.all((idx + r >= 0) & (idx - r < np.array(shape)[None, :]), axis=1)
+    if not np.all(visible):
+        pos = [p[visible] for p in pos]
+        sigmas = [s[visible] for s in sigmas]
+        amps, idx, r = amps[visible], idx[visible], r[visible]
+
+    if len(amps) == 0:
+        return im
+
+    if num_threads is None:
+        num_threads = NUM_THREADS
+
+    _render_points(im, threading.Lock(), grids, pos, sigmas, amps, idx, r, num_threads)
+
+    return im
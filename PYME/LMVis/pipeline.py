@@ -40,6 +40,7 @@ from PYME.recipes.base import ModuleCollection
 import numpy as np
 import scipy.special
 import os
+import itertools
 
 import dispatch
 
@@ -48,6 +49,8 @@ from PYME.Analysis.BleachProfile.kinModels import getPhotonNums
 import logging
 logger = logging.getLogger(__name__)
 
+_data_versions = itertools.count()
+
 def _processPriSplit(ds):
     """set mappings ascociated with the use of a splitter"""
 
@@ -297,6 +300,9 @@ class Pipeline:
 
         #define a signal which a GUI can hook if the pipeline is rebuilt (i.e. the output changes)
         self.onRebuild = dispatch.Signal()
+        
+        #a (globally unique) token which changes whenever our output might have changed. Used to key render caches.
+        self.data_version = next(_data_versions)
 
         #a cached list of our keys to be used to decide whether to fire a keys changed signal
         self._keys = None
@@ -586,6 +592,8 @@ class Pipeline:
         self.edb = None
         self.GeneratedMeasures = {}
         self.Quads = None
+        
+        self.data_version = next(_data_versions)
 
         self.onRebuild.send_robust(sender=self)
 
@@ -26,12 +26,94 @@ from PYME.LMVis import statusLog
 from PYME.IO import tabular
 
 from PYME.IO import MetaDataHandler
+from PYME import config
 
 #import pylab
 import numpy as np
+import threading
+import collections
 
 renderMetadataProviders = []
 
+#size (in pixels) of the tiles we cache
+RENDER_TILE_SIZE = 256
+
+#how much coarser than the requested pixel size the preview is when rendering progressively
+PREVIEW_FACTOR = 4
+
+
+def _freeze(value):
+    """Convert (nested) settings values to something hashable so that they can form part of a cache key"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    elif isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(_freeze(v) for v in value)
+    else:
+        return value
+
+
+class RenderCache(object):
+    """
+    A least recently used cache of rendered image tiles, limited by total size.
+
+    Tiles are keyed by (data version, renderer, channel, settings, tile index) - see `ColourRenderer._cache_key`. As the
+    data version changes whenever the pipeline is rebuilt, stale entries are never hit and simply age out of the cache.
+    Each tile can carry the rendering metadata recorded when it was rendered, which is evicted along with the tile.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        
+        self._tiles = collections.OrderedDict()
+        self._nbytes = 0
+        self._metadata = {}
+        self._lock = threading.Lock()
+        
+    def get(self, key):
+        with self._lock:
+            try:
+                tile = self._tiles.pop(key)
+            except KeyError:
+                return None
+            
+            #re-insert to mark as most recently used
+            self._tiles[key] = tile
+            return tile
+        
+    def put(self, key, tile, mdh=None):
+        with self._lock:
+            old = self._tiles.pop(key, None)
+            if old is not None:
+                self._nbytes -= old.nbytes
+                
+            self._tiles[key] = tile
+            self._nbytes += tile.nbytes
+            if mdh is not None:
+                self._metadata[key] = mdh
+            else:
+                self._metadata.pop(key, None)
+            
+            while self._nbytes > self.max_bytes and len(self._tiles) > 1:
+                k, t = self._tiles.popitem(last=False)
+                self._nbytes -= t.nbytes
+                self._metadata.pop(k, None)
+                
+    def get_metadata(self, key):
+        """Rendering metadata recorded (by `genIm`) when the tile with this key was rendered"""
+        with self._lock:
+            return self._metadata.get(key, None)
+                
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self._metadata.clear()
+            self._nbytes = 0
+            
+    @property
+    def nbytes(self):
+        return self._nbytes
+            
+render_cache = RenderCache(int(config.get('VisGUI-render_cache_mb', 512))*1024*1024)
+
 class CurrentRenderer:
     """Renders current view (in black and white). Only renderer not to take care
     of colour channels. Simplest renderer and as such also the base class for all 
@@ -41,8 +123,16 @@ class CurrentRenderer:
     mode = 'current'
     _defaultPixelSize = 5.0
     
+    #can the image be rendered in independent tiles (i.e. is rendering a region equivalent to cropping the rendering of
+    #a larger region)? If so, tiles are cached and re-used (see `ColourRenderer._genIm_tiled`).
+    tileable = False
+    
     def __init__(self, visFr, pipeline, mainWind = None):
         self.visFr = visFr
+        
+        #per-thread state - allows us to render a given colour channel without changing the colour filter (which might
+        #be in use elsewhere, e.g. when refining an image in a background thread)
+        self._thread_state = threading.local()
 
         if mainWind is None:
             #menu handlers must be bound to the top level window
@@ -57,6 +147,14 @@ class CurrentRenderer:
 
     @property
     def colourFilter(self):
+        channel_filter = getattr(self._thread_state, 'channel_filter', None)
+        if channel_filter is not None:
+            return channel_filter
+        
+        return self._pipeline_colour_filter
+    
+    @property
+    def _pipeline_colour_filter(self):
         if isinstance(self.pipeline, tabular.ColourFilter):
             return self.pipeline
         else:
@@ -260,17 +358,174 @@ class ColourRenderer(CurrentRenderer):
         mdh['Origin.z'] = oz
 
         colours = settings['colours']
-        oldC = self.colourFilter.currentColour
 
         ims = []
 
         for c in colours:
-            self.colourFilter.setColour(c)
-            ims.append(np.atleast_3d(self.genIm(settings, imb, mdh)))
-
-        self.colourFilter.setColour(oldC)
+            ims.append(np.atleast_3d(self._render_channel(c, settings, imb, mdh)))
 
         return GeneratedImage(ims, imb, pixelSize, sliceThickness, colours, mdh=mdh)
+    
+    def _render_channel(self, colour, settings, imb, mdh):
+        """Render a single colour channel, leaving the colour filter untouched"""
+        self._thread_state.channel_filter = self._pipeline_colour_filter.get_channel_ds(colour)
+        try:
+            return self._genIm_tiled(settings, imb, mdh)
+        finally:
+            self._thread_state.channel_filter = None
+            
+    def _is_tileable(self, settings):
+        return self.tileable
+    
+    def _get_image_bounds(self, pixel_size, slice_size=None, zmin=None, zmax=None):
+        imb = CurrentRenderer._get_image_bounds(self, pixel_size, slice_size, zmin, zmax)
+        
+        if self.tileable and (getattr(self.pipeline, 'data_version', None) is not None):
+            # align to the pixel grid so that cached tiles can be re-used when the view is panned
+            x0 = np.floor(imb.x0/pixel_size)*pixel_size
+            y0 = np.floor(imb.y0/pixel_size)*pixel_size
+            x1 = x0 + np.ceil((imb.x1 - x0)/pixel_size)*pixel_size
+            y1 = y0 + np.ceil((imb.y1 - y0)/pixel_size)*pixel_size
+            imb = ImageBounds(x0, y0, x1, y1, imb.z0, imb.z1)
+            
+        return imb
+    
+    def _cache_key(self, settings):
+        """
+        A key identifying the rendered image (other than its bounds) - the data, renderer, colour channel and settings.
+        Returns None if we can't identify the data (i.e. we are not attached to a pipeline), in which case we don't cache.
+        """
+        #background rendering threads pin the version they started with (see `GenerateProgressive`)
+        version = getattr(self._thread_state, 'data_version', None)
+        if version is None:
+            version = getattr(self.pipeline, 'data_version', None)
+        if version is None:
+            return None
+        
+        cf = self._pipeline_colour_filter
+        chan = getattr(self._thread_state, 'channel_filter', None)
+        chan = chan.channel if chan is not None else cf.currentColour
+        
+        return (version, self.name, chan, cf.t_p_dye, cf.t_p_other, cf.t_p_background, _freeze(cf.chromaticShifts),
+                _freeze({k: v for k, v in settings.items() if not k == 'colours'}))
+        
+    def _genIm_tiled(self, settings, imb, mdh):
+        """
+        Render an image via the tile cache. Tiles are aligned to a global grid (at the requested pixel size) so that
+        panning or zooming the view re-uses tiles which have already been rendered. Any missing tiles are rendered with
+        a single call to `genIm` covering their bounding box.
+        """
+        key = self._cache_key(settings)
+        if (key is None) or not self._is_tileable(settings):
+            return self.genIm(settings, imb, mdh)
+        
+        pixelSize = settings['pixelSize']
+        ts = RENDER_TILE_SIZE
+        tile_nm = ts*pixelSize
+        
+        #pixel offsets of our image in the global grid
+        px0, py0 = int(round(imb.x0/pixelSize)), int(round(imb.y0/pixelSize))
+        nx, ny = int(round((imb.x1 - imb.x0)/pixelSize)), int(round((imb.y1 - imb.y0)/pixelSize))
+        
+        tiles_x = range(px0//ts, (px0 + nx + ts - 1)//ts)
+        tiles_y = range(py0//ts, (py0 + ny + ts - 1)//ts)
+        
+        tiles = {}
+        missing = []
+        tile_mdh = None
+        for i in tiles_x:
+            for j in tiles_y:
+                tile = render_cache.get(key + (i, j))
+                if tile is None:
+                    missing.append((i, j))
+                else:
+                    tiles[(i, j)] = tile
+                    if tile_mdh is None:
+                        tile_mdh = render_cache.get_metadata(key + (i, j))
+                    
+        if len(missing) > 0:
+            mi = [m[0] for m in missing]
+            mj = [m[1] for m in missing]
+            i0, i1, j0, j1 = min(mi), max(mi) + 1, min(mj), max(mj) + 1
+            
+            rimb = ImageBounds(i0*tile_nm, j0*tile_nm, i1*tile_nm, j1*tile_nm, imb.z0, imb.z1)
+            
+            tile_mdh = MetaDataHandler.NestedClassMDHandler()
+            im = np.atleast_3d(self.genIm(settings, rimb, tile_mdh))
+            
+            for i, j in missing:
+                tile = im[((i - i0)*ts):((i - i0 + 1)*ts), ((j - j0)*ts):((j - j0 + 1)*ts)].copy()
+                render_cache.put(key + (i, j), tile, tile_mdh)
+                tiles[(i, j)] = tile
+                
+        if tile_mdh is not None:
+            mdh.copyEntriesFrom(tile_mdh)
+            
+        #assemble the tiles and crop to the requested bounds
+        nz = list(tiles.values())[0].shape[2]
+        im = np.zeros((len(tiles_x)*ts, len(tiles_y)*ts, nz), list(tiles.values())[0].dtype)
+        for (i, j), tile in tiles.items():
+            im[((i - tiles_x[0])*ts):((i - tiles_x[0] + 1)*ts), ((j - tiles_y[0])*ts):((j - tiles_y[0] + 1)*ts)] = tile
+            
+        ox, oy = px0 - tiles_x[0]*ts, py0 - tiles_y[0]*ts
+        return im[ox:(ox + nx), oy:(oy + ny)]
+    
+    def GenerateProgressive(self, settings, callback, preview_factor=PREVIEW_FACTOR):
+        """
+        Generate a quick, low resolution, preview of the image and then refine it in a background thread.
+
+        Parameters
+        ----------
+        settings : dict
+            rendering settings, as for `Generate`
+        callback : function
+            called as `callback(image, final)`, first with the preview (`final=False`, from the calling thread) and then
+            with the full resolution image (`final=True`, from the background thread). The full resolution image is
+            None if rendering failed, or if the pipeline was rebuilt (changing its `data_version`) while rendering.
+        preview_factor : float
+            how much coarser the preview pixel size is
+
+        Returns
+        -------
+        threading.Thread
+            the thread doing the full resolution rendering
+        """
+        import logging
+        
+        preview_settings = dict(settings)
+        preview_settings['pixelSize'] = settings['pixelSize']*preview_factor
+        if preview_settings.get('zSliceThickness', None):
+            preview_settings['zSliceThickness'] = settings['zSliceThickness']*preview_factor
+        
+        callback(self.Generate(preview_settings), False)
+        
+        version = getattr(self.pipeline, 'data_version', None)
+        
+        def _refine():
+            #render against the data version we started with, so that if the pipeline is rebuilt under us we don't cache
+            #tiles rendered from the old data (or a mixture of old and new) under the new version
+            self._thread_state.data_version = version
+            try:
+                im = self.Generate(settings)
+            except:
+                if getattr(self.pipeline, 'data_version', None) == version:
+                    logging.exception('Error generating %s image' % self.name)
+                im = None
+            finally:
+                self._thread_state.data_version = None
+                
+            if getattr(self.pipeline, 'data_version', None) != version:
+                #the pipeline was rebuilt while we were rendering - the result is stale (or inconsistent)
+                logging.debug('Discarding %s image as the pipeline changed while rendering' % self.name)
+                im = None
+                
+            callback(im, True)
+        
+        t = threading.Thread(target=_refine)
+        t.daemon = True
+        t.start()
+        
+        return t
 
     def GenerateGUI(self, event=None):
         import wx
@@ -301,14 +556,50 @@ class ColourRenderer(CurrentRenderer):
         #bCurr = wx.BusyCursor()
 
         if ret == wx.ID_OK:
-            im = self.Generate(dlg.get_settings())
-            imfc = ViewIm3D(im, mode='visGUI', title='Generated %s - %3.1fnm bins' % (self.name, im.pixelSize),
-                            glCanvas=self.visFr.glCanvas, parent=self.mainWind)
+            settings = dlg.get_settings()
+            if self._is_tileable(settings) and config.get('VisGUI-progressive_rendering', True):
+                imfc = self._generate_progressive_gui(settings)
+            else:
+                im = self.Generate(settings)
+                imfc = ViewIm3D(im, mode='visGUI', title='Generated %s - %3.1fnm bins' % (self.name, im.pixelSize),
+                                glCanvas=self.visFr.glCanvas, parent=self.mainWind)
         else:
             imfc = None
 
         dlg.Destroy()
         return imfc
+    
+    def _generate_progressive_gui(self, settings):
+        """Show a low resolution preview straight away, and replace it with the full image once that has rendered"""
+        import wx
+        from PYME.DSView import ViewIm3D
+        
+        views = {}
+        
+        def _show(im, final):
+            if im is not None:
+                title = 'Generated %s - %3.1fnm bins' % (self.name, im.pixelSize)
+                if not final:
+                    title += ' [preview]'
+                views[final] = ViewIm3D(im, mode='visGUI', title=title, glCanvas=self.visFr.glCanvas,
+                                        parent=self.mainWind)
+            
+            if final and (views.get(False, None) is not None):
+                try:
+                    views[False].Close()
+                except RuntimeError:
+                    #preview window already closed by the user
+                    pass
+                
+        def _callback(im, final):
+            if final:
+                wx.CallAfter(_show, im, final)
+            else:
+                _show(im, final)
+                
+        self.GenerateProgressive(settings, _callback)
+        
+        return views.get(False, None)
 
 
 class HistogramRenderer(ColourRenderer):
@@ -316,6 +607,7 @@ class HistogramRenderer(ColourRenderer):
 
     name = 'Histogram'
     mode = 'histogram'
+    tileable = True
 
     def genIm(self, settings, imb, mdh):
         return visHelpers.rendHist(self.colourFilter['x'],self.colourFilter['y'], imb, settings['pixelSize'])
@@ -345,6 +637,7 @@ class GaussianRenderer(ColourRenderer):
 
     name = 'Gaussian'
     mode = 'gaussian'
+    tileable = True
 
     def _getDefaultJitVar(self, jitVars):
         if 'error_x' in jitVars:
@@ -429,6 +722,11 @@ class TriangleRenderer(ColourRenderer):
     name = 'Jittered Triangulation'
     mode = 'triangles'
     _defaultPixelSize = 5.0
+    tileable = True
+    
+    def _is_tileable(self, settings):
+        #only software rendering respects the image bounds (OpenGL rendering renders the current view)
+        return settings.get('softRender', False)
 
     def genIm(self, settings, imb, mdh):
         pixelSize = settings['pixelSize']
@@ -456,6 +754,11 @@ class TriangleRendererW(ColourRenderer):
     name = 'Jittered Triangulation - weighted'
     mode = 'trianglesw'
     _defaultPixelSize = 5.0
+    tileable = True
+    
+    def _is_tileable(self, settings):
+        #only software rendering respects the image bounds (OpenGL rendering renders the current view)
+        return settings.get('softRender', False)
 
     def genIm(self, settings, imb, mdh):
         pixelSize = settings['pixelSize']
@@ -484,6 +787,9 @@ class Triangle3DRenderer(TriangleRenderer):
     mode = '3Dtriangles'
     _defaultPixelSize = 20.0
 
+    def _is_tileable(self, settings):
+        return True
+
     def genIm(self, settings, imb, mdh):
         pixelSize = settings['pixelSize']
         jitParamName = settings['jitterVariable']
@@ -624,7 +624,13 @@ class VisGUICore(object):
 
 
     def SetStatus(self, statusText):
-        self.statusbar.SetStatusText(statusText, 0)
+        import threading
+        if threading.current_thread().name == 'MainThread':
+            self.statusbar.SetStatusText(statusText, 0)
+        else:
+            #status updates can come from background rendering threads (see renderers.ColourRenderer.GenerateProgressive)
+            import wx
+            wx.CallAfter(self.statusbar.SetStatusText, statusText, 0)
         
     def SaveMetadata(self, mdh):
         mdh['Filter.Keys'] = self.pipeline.filterKeys
@@ -27,6 +27,7 @@ import scipy
 import numpy
 import numpy as np
 import numpy.ctypeslib
+import threading
 
 from PYME.Analysis.points.SoftRend import RenderTetrahedra
 from math import floor
@@ -124,7 +125,7 @@ def Gauss2D(Xv,Yv, A,x0,y0,s):
     r = genGauss(Xv,Yv,A,x0,y0,s,0,0,0)
     return r
 
-def rendGauss(x, y, sx, imageBounds, pixelSize):
+def rendGauss(x, y, sx, imageBounds, pixelSize, roiSigmas=3, num_threads=None):
     """
 
     Parameters
@@ -140,48 +141,34 @@ def rendGauss(x, y, sx, imageBounds, pixelSize):
         and (x1, y1) correspond to the inside edge of the outer pixels.
     pixelSize : float
         size of pixels to be rendered [nm]
+    roiSigmas : float
+        size of the ROI each point is rendered over, in multiples of that point's sigma. The parts of the Gaussian which
+        extend past the ROI are dropped.
+    num_threads : int
+        number of threads to render with (default is given by the `rendering-num_threads` config option).
 
     Returns
     -------
     im : ndarray
         2D Gaussian rendering. Note that im[0, 0] is centered at 0.5 * [pixelSize, pixelSize] (FIXME)
-
-    TODOS:
-    
-    - speed improvements? Parallelisation?
-    - variable ROI size? We currently base our ROI size on the median localization/jitter error, with the parts of the
-    Gaussians which extend past the ROI being dropped. This is usually not an issue, but could become one if we have a
-    large range of localization precisions (or if we are using something else - e.g. neighbour distances - as sigma).
+        
+    Notes
+    -----
+    The ROI size is chosen per point, so a large range of localization precisions (or using something else - e.g.
+    neighbour distances - as sigma) no longer results in truncated Gaussians. The rendering itself is done by
+    :func:`PYME.LMVis.gaussSplat.splat_gaussians`.
     
     """
+    from PYME.LMVis import gaussSplat
     
-    # choose a ROI size that is appropriate, and generate a padded image to render into
     sx = numpy.maximum(sx, pixelSize)
-    fuzz = 3*scipy.median(sx)
-    roiSize = int(fuzz/pixelSize)
-    fuzz = pixelSize*roiSize
+    roiSizes = numpy.ceil(roiSigmas*sx/pixelSize + 0.5).astype('i') #+0.5 as points can be up to half a pixel off centre
 
     # FIXME - do we need the half pixel offset
-    X = numpy.arange(imageBounds.x0 - fuzz,imageBounds.x1 + fuzz, pixelSize) + 0.5*pixelSize
-    Y = numpy.arange(imageBounds.y0 - fuzz,imageBounds.y1 + fuzz, pixelSize) + 0.5*pixelSize
+    X = numpy.arange(imageBounds.x0,imageBounds.x1, pixelSize) + 0.5*pixelSize
+    Y = numpy.arange(imageBounds.y0,imageBounds.y1, pixelSize) + 0.5*pixelSize
     
-    im = scipy.zeros((len(X), len(Y)), 'f')
-    
-    for i in range(len(x)):
-        # FIXME - argmin() involves a search (expensive) - we should be able to get the nearest pixel as something like
-        # ix = int(np.round((x[i] - X[0])/pixelSize))
-        ix = scipy.absolute(X - x[i]).argmin()
-        iy = scipy.absolute(Y - y[i]).argmin()
-
-        sxi = sx[i]
-        
-        imp = Gauss2D(X[(ix - roiSize):(ix + roiSize + 1)], Y[(iy - roiSize):(iy + roiSize + 1)],1/sxi, x[i],y[i],sxi)
-        im[(ix - roiSize):(ix + roiSize + 1), (iy - roiSize):(iy + roiSize + 1)] += imp
-
-    # clip to final image size
-    im = im[roiSize:-roiSize, roiSize:-roiSize]
-
-    return im
+    return gaussSplat.splat_gaussians([X, Y], [x, y], [sx, sx], 1.0/sx, [roiSizes, roiSizes], num_threads=num_threads)
 
 
 def rend_density_estimate(x, y, imageBounds, pixelSize, N=10):
@@ -356,54 +343,12 @@ def rendTri(T, imageBounds, pixelSize, c=None, im=None, geometric_mean=False):
 
 
 def rendJitTri(im, x, y, jsig, mcp, imageBounds, pixelSize, n=1, seed=None):
-    from matplotlib import tri
-    np.random.seed(seed)
-    
-    for i in range(int(n)):
-        Imc = scipy.rand(len(x)) < mcp
-        
-        if isinstance(jsig, numpy.ndarray):
-            print((jsig.shape, Imc.shape))
-            jsig2 = jsig[Imc]
-        else:
-            jsig2 = float(jsig)
-        T = tri.Triangulation(x[Imc] +  jsig2*scipy.randn(Imc.sum()), y[Imc] +  jsig2*scipy.randn(Imc.sum()))
-
-        rendTri(T, imageBounds, pixelSize, im=im, geometric_mean=False)
-        
-    im [:20, 0] += scipy.rand(20) #Create signature for ImageID - TODO - fix fileID code so that this is not necessary
-        
-    #reseed the random number generator so that anything subsequent does not become deterministic (if we specified seeds)
-    np.random.seed(None)
-
+    """Add n jittered triangulation renderings (see `rendJitTriang`) to im, in the calling thread"""
+    im_r = _jit_tri_task(im.shape, numpy.asarray(x, 'd'), numpy.asarray(y, 'd'), jsig, mcp, imageBounds, pixelSize, n,
+                         seed, False, None)
+    im += im_r
+    _release_scratch_image(im_r)
 
-def _rend_jit_tri_geometric(im, x, y, jsig, mcp, imageBounds, pixelSize, n=1, seed=None):
-    from matplotlib import tri
-    np.random.seed(seed)
-
-    #im_ = numpy.zeros(im.shape, 'f')
-    
-    for i in range(int(n)):
-        #im_ *= 0
-        #im_ = numpy.zeros(im.shape, 'f')
-        Imc = scipy.rand(len(x)) < mcp
-        
-        if isinstance(jsig, numpy.ndarray):
-            print((jsig.shape, Imc.shape))
-            jsig2 = jsig[Imc]
-        else:
-            jsig2 = float(jsig)
-        T = tri.Triangulation(x[Imc] + jsig2 * scipy.randn(Imc.sum()), y[Imc] + jsig2 * scipy.randn(Imc.sum()))
-        
-        rendTri(T, imageBounds, pixelSize, im=im, geometric_mean=True)
-        
-        #im[:] = (im + (im_))# + 1e9*(im_ <=0)))[:]
-    
-    im[:20, 0] += scipy.rand(20) #Create signature/watermark for ImageID - TODO - fix fileID code so that this is no longer necessary
-    
-    #reseed the random number generator so that anything subsequent does not become deterministic (if we specified seeds)
-    np.random.seed(None)
-    
 def _generate_subprocess_seeds(preferred_n_tasks = 1, mdh=None, seeds=None):
     """
     Generate seeds for each rendering task, or pass through a given array of seeds for deterministically recreating a
@@ -453,7 +398,218 @@ def _iterations_per_task(n, nTasks):
     return tasks
     
 
-def rendJitTriang(x,y,n,jsig, mcp, imageBounds, pixelSize, seeds=None, geometric_mean=True, mdh=None):
+class _Triangulation(object):
+    """Minimal stand-in for matplotlib.tri.Triangulation (as consumed by rendTri)"""
+    def __init__(self, x, y, triangles):
+        self.x = x
+        self.y = y
+        self.triangles = triangles
+
+
+def _delaunay(x, y):
+    # NB - use scipy rather than matplotlib for the triangulation as it releases the GIL while running qhull, letting
+    # us triangulate in parallel threads
+    from scipy.spatial import Delaunay
+    return _Triangulation(x, y, Delaunay(numpy.vstack([x, y]).T).simplices)
+
+
+def _signed_area(x, y, triangles):
+    xs, ys = x[triangles], y[triangles]
+    return 0.5*((xs[:, 1] - xs[:, 0])*(ys[:, 2] - ys[:, 0]) - (xs[:, 2] - xs[:, 0])*(ys[:, 1] - ys[:, 0]))
+
+
+class _BaseTriangulation(object):
+    """
+    Triangulation of the un-jittered points, which is re-used (and repaired) for each jitter iteration when rendering
+    incrementally (see `_repair_jittered`).
+    """
+    def __init__(self, x, y):
+        triangles = _delaunay(x, y).triangles
+        #orient all the triangles anti-clockwise, so that we can detect folding from the sign of the area
+        flip = _signed_area(x, y, triangles) < 0
+        triangles[flip] = triangles[flip][:, ::-1]
+        self.triangles = triangles
+        
+#the base triangulation for the last dataset we rendered incrementally, keyed by a hash of the point positions
+_base_triangulation = (None, None)
+_base_triangulation_lock = threading.Lock()
+
+def _get_base_triangulation(x, y):
+    global _base_triangulation
+    import hashlib
+    
+    key = hashlib.md5(numpy.ascontiguousarray(x).view('u1')).hexdigest() + hashlib.md5(numpy.ascontiguousarray(y).view('u1')).hexdigest()
+    
+    with _base_triangulation_lock:
+        if not _base_triangulation[0] == key:
+            _base_triangulation = (key, _BaseTriangulation(x, y))
+            
+        return _base_triangulation[1]
+    
+#if more than this fraction of triangles fold when jittered, it's faster just to re-triangulate from scratch
+MAX_REPAIR_FRACTION = 0.02
+#maximum (relative) discrepancy between the area of a repaired triangulation and that of the convex hull of the points
+HULL_AREA_TOLERANCE = 1e-3
+
+def _hull_area(x, y):
+    from scipy.spatial import ConvexHull
+    return ConvexHull(numpy.vstack([x, y]).T).volume #NB - 'volume' is area in 2D
+
+def _repair_jittered(base, x, y):
+    """
+    Re-use the topology of the base (un-jittered) triangulation for jittered points, repairing it where the jitter has
+    folded triangles over. The vertices of folded triangles are re-triangulated locally (together with their
+    neighbours), the rest of the triangulation is kept as is.
+    
+    Notes
+    -----
+    The result is a valid (non-overlapping) triangulation of the jittered points (to within `HULL_AREA_TOLERANCE`), but
+    is not in general a Delaunay triangulation. It is only faster than re-triangulating when the jitter is small compared to the
+    point spacing (so that few triangles need repairing) - with jitter comparable to the nearest neighbour distance
+    most of the triangulation needs rebuilding and we fall back to a full triangulation.
+    """
+    tri = base.triangles
+    
+    folded = _signed_area(x, y, tri) <= 0
+    n_folded = folded.sum()
+    
+    if n_folded == 0:
+        return _Triangulation(x, y, tri)
+    elif n_folded > MAX_REPAIR_FRACTION*len(tri):
+        return _delaunay(x, y)
+    
+    # the vertices we re-triangulate - those of the folded triangles
+    in_S = numpy.zeros(len(x), bool)
+    in_S[tri[folded].ravel()] = True
+    
+    # remove all triangles touching these vertices, leaving a hole bounded by the remaining vertices of those triangles
+    removed = in_S[tri].any(1)
+    region = numpy.unique(tri[removed].ravel())
+    
+    try:
+        local = _delaunay(x[region], y[region]).triangles
+    except Exception:
+        #e.g. too few / degenerate points - just do the whole lot
+        return _delaunay(x, y)
+    
+    local = region[local]
+    kept = tri[~removed]
+    #the local triangulation covers the convex hull of the region, which can extend beyond the hole - only keep those
+    # triangles which are inside the hole
+    inside, shares_edge = _inside_hole(local, kept, x, y)
+    local = local[inside & (in_S[local].any(1) | shares_edge)]
+    triangles = numpy.vstack([kept, local])
+    
+    # The above is a heuristic, and can leave small gaps or overlaps (e.g. if a re-triangulated vertex was jittered
+    # into a kept triangle). Check that the triangles tile the convex hull, and re-triangulate from scratch if not.
+    area = abs(_signed_area(x, y, triangles)).sum()
+    if abs(area - _hull_area(x, y)) > HULL_AREA_TOLERANCE*area:
+        return _delaunay(x, y)
+    
+    return _Triangulation(x, y, triangles)
+
+def _edges(triangles, n_points):
+    """Keys for each edge of each triangle, together with the vertex opposite that edge"""
+    a = triangles.ravel()
+    b = numpy.roll(triangles, -1, axis=1).ravel()
+    opposite = numpy.roll(triangles, -2, axis=1).ravel()
+    return numpy.minimum(a, b).astype('i8')*n_points + numpy.maximum(a, b), a, b, opposite
+
+def _inside_hole(candidates, kept, x, y):
+    """
+    Find which of a set of candidate triangles (covering a hole in a triangulation) lie within the hole. A candidate is
+    outside the hole if it shares an edge with a kept triangle and lies on the same side of that edge as the kept
+    triangle, or if it shares an edge which is already shared by two kept triangles.
+    """
+    n_points = len(x)
+    kept_keys, _, _, kept_opp = _edges(kept, n_points)
+    order = numpy.argsort(kept_keys)
+    kept_keys, kept_opp = kept_keys[order], kept_opp[order]
+    
+    keys, a, b, opp = _edges(candidates, n_points)
+    lo = numpy.searchsorted(kept_keys, keys, 'left')
+    hi = numpy.searchsorted(kept_keys, keys, 'right')
+    
+    other = kept_opp[numpy.minimum(lo, len(kept_opp) - 1)]
+    
+    def side(v):
+        return numpy.sign((x[b] - x[a])*(y[v] - y[a]) - (y[b] - y[a])*(x[v] - x[a]))
+    
+    shared = (hi - lo) == 1
+    overlaps = ((hi - lo) > 1) | (shared & (side(opp) == side(other)))
+    
+    return ~overlaps.reshape(-1, 3).any(1), shared.reshape(-1, 3).any(1)
+
+_tri_render_pool = None
+_tri_render_pool_lock = threading.Lock()
+
+def _get_tri_render_pool():
+    """
+    A persistent pool of threads for jittered triangulation rendering. This has one thread per core, unless we are
+    running in a daemon process (e.g. a cluster compute process), where other processes are already using the remaining
+    cores, in which case we use a single thread.
+    """
+    global _tri_render_pool
+    from multiprocessing.pool import ThreadPool
+    
+    with _tri_render_pool_lock:
+        if _tri_render_pool is None:
+            if multiprocessing.current_process().daemon:
+                _tri_render_pool = ThreadPool(1)
+            else:
+                _tri_render_pool = ThreadPool(multiprocessing.cpu_count())
+        
+        return _tri_render_pool
+    
+# scratch images for the render tasks, re-used across renders of the same size
+_scratch_images = {}
+_scratch_lock = threading.Lock()
+
+def _get_scratch_image(shape):
+    with _scratch_lock:
+        free = _scratch_images.get(shape, [])
+        if len(free) > 0:
+            im = free.pop()
+            im[:] = 0
+            return im
+        
+    return numpy.zeros(shape)
+
+def _release_scratch_image(im):
+    with _scratch_lock:
+        if not im.shape in _scratch_images:
+            #only keep scratch images for the most recent image size (bounds memory use)
+            _scratch_images.clear()
+        _scratch_images.setdefault(im.shape, []).append(im)
+
+
+def _jit_tri_task(shape, x, y, jsig, mcp, imageBounds, pixelSize, n, seed, geometric_mean, base):
+    """Render n jittered triangulations into a scratch image (run in the render pool)"""
+    rs = numpy.random.RandomState(seed)
+    im = _get_scratch_image(shape)
+    
+    for i in range(int(n)):
+        if base is not None:
+            # incremental - keep all the points, and repair the base triangulation
+            T = _repair_jittered(base, x + jsig*rs.randn(len(x)), y + jsig*rs.randn(len(y)))
+        else:
+            Imc = rs.rand(len(x)) < mcp
+            
+            if isinstance(jsig, numpy.ndarray):
+                jsig2 = jsig[Imc]
+            else:
+                jsig2 = float(jsig)
+            
+            T = _delaunay(x[Imc] + jsig2*rs.randn(Imc.sum()), y[Imc] + jsig2*rs.randn(Imc.sum()))
+        
+        rendTri(T, imageBounds, pixelSize, im=im, geometric_mean=geometric_mean)
+    
+    im[:20, 0] += rs.rand(20) #Create signature/watermark for ImageID - TODO - fix fileID code so that this is no longer necessary
+    
+    return im
+
+
+def rendJitTriang(x,y,n,jsig, mcp, imageBounds, pixelSize, seeds=None, geometric_mean=True, mdh=None, incremental=None):
     """
 
     Parameters
@@ -477,6 +633,11 @@ def rendJitTriang(x,y,n,jsig, mcp, imageBounds, pixelSize, seeds=None, geometric
         [optional] Flag to scale intensity by geometric mean (True) or [localizations / um^2] (False)
     mdh: PYME.IO.MetaDataHandler.MDHandlerBase or subclass
         [optional] metadata handler to store seeds to
+    incremental : bool
+        [optional] rather than re-triangulating for each jitter iteration, triangulate the un-jittered points once (this
+        triangulation is cached and re-used for repeated renders of the same points) and repair it after jittering.
+        Faster, but approximate (see `_repair_jittered`). Only used when mcp == 1. Defaults to the
+        `rendering-incremental_triangulation` config option.
 
     Returns
     -------
@@ -486,48 +647,42 @@ def rendJitTriang(x,y,n,jsig, mcp, imageBounds, pixelSize, seeds=None, geometric
     Notes
     -----
     Triangles which reach outside of the image bounds are dropped and not included in the rendering.
+    
+    Rendering is performed by a persistent pool of threads (one per CPU core, see `_get_tri_render_pool`). Each task
+    renders its share of the jitter iterations into a scratch image (scratch images are re-used between renders), and
+    these are summed.
     """
+    from PYME import config
+    
     sizeX = int((imageBounds.x1 - imageBounds.x0) / pixelSize)
     sizeY = int((imageBounds.y1 - imageBounds.y0) / pixelSize)
     
-    if geometric_mean:
-        fcn = _rend_jit_tri_geometric
-    else:
-        fcn = rendJitTri
+    if incremental is None:
+        incremental = config.get('rendering-incremental_triangulation', False)
+        
+    x = numpy.asarray(x, 'd')
+    y = numpy.asarray(y, 'd')
     
-    if multiProc and not multiprocessing.current_process().daemon:
-        im = shmarray.zeros((sizeX, sizeY))
-
-        x = shmarray.create_copy(x)
-        y = shmarray.create_copy(y)
-        if type(jsig) == numpy.ndarray:
-            jsig = shmarray.create_copy(jsig)
-
-        # We will generate 1 process for each seed, defaulting to generating a seed for each CPU core if seeds are not
-        # passed explicitly. Rendering with explicitly passed seeds will be deterministic, but performance will not be
-        # optimal unless n_seeds = n_CPUs
-        seeds = _generate_subprocess_seeds(multiprocessing.cpu_count(), mdh, seeds)
-        iterations = _iterations_per_task(n, len(seeds))
-
-        processes = [multiprocessing.Process(target = fcn, args=(im, x, y, jsig, mcp, imageBounds, pixelSize, nIt, s)) for nIt, s in zip(iterations, seeds)]
-
-        for p in processes:
-            p.start()
-
-        for p in processes:
-            p.join()
-
+    if incremental and (mcp >= 1):
+        base = _get_base_triangulation(x, y)
     else:
-        im = numpy.zeros((sizeX, sizeY))
-
-        # Technically we could just call fcn( ....,n), but we replicate the logic above and divide into groups of tasks
-        # so that we can reproduce a previously generated image
-        seeds = _generate_subprocess_seeds(1, mdh, seeds)
-        iterations = _iterations_per_task(n, len(seeds))
-        
-        for nIt, s in zip(iterations, seeds):
-            # NB - in normal usage, this loop only evaluates once, with nIt=n
-            fcn(im, x, y, jsig, mcp, imageBounds, pixelSize, nIt, seed=s)
+        base = None
+    
+    # We generate 1 task for each seed, defaulting to generating a seed for each CPU core if seeds are not
+    # passed explicitly. Rendering with explicitly passed seeds will be deterministic, but performance will not be
+    # optimal unless n_seeds = n_CPUs
+    seeds = _generate_subprocess_seeds(multiprocessing.cpu_count(), mdh, seeds)
+    iterations = _iterations_per_task(n, len(seeds))
+    
+    pool = _get_tri_render_pool()
+    results = [pool.apply_async(_jit_tri_task, ((sizeX, sizeY), x, y, jsig, mcp, imageBounds, pixelSize, nIt, s,
+                                                geometric_mean, base)) for nIt, s in zip(iterations, seeds)]
+    
+    im = numpy.zeros((sizeX, sizeY))
+    for r in results:
+        im_r = r.get()
+        im += im_r
+        _release_scratch_image(im_r)
     
     if geometric_mean:
         return (1.e6/(im/n + 1))*(im > n)
@@ -743,48 +898,49 @@ def Gauss3d(X, Y, Z, x0, y0, z0, wxy, wz):
 
     return scipy.exp(-((X[:,None]-x0)**2 + (Y[None,:] - y0)**2)/(2*wxy**2) - ((Z-z0)**2)/(2*wz**2))/((2*scipy.pi*wxy**2)*scipy.sqrt(2*scipy.pi*wz**2))
 
-def rendGauss3D(x,y, z, sx, sz, imageBounds, pixelSize, zb, sliceSize=100):
-    from PYME.localization.cModels.gauss_app import genGauss3D
-    sx = numpy.maximum(sx, pixelSize)
-    fuzz = 3*scipy.median(sx)
-    roiSize = int(fuzz/pixelSize)
-    fuzz = pixelSize*roiSize
-
-    #print imageBounds.x0
-    #print imageBounds.x1
-    #print fuzz
+def rendGauss3D(x,y, z, sx, sz, imageBounds, pixelSize, zb, sliceSize=100, roiSigmas=3, num_threads=None):
+    """
+    3D counterpart of :func:`rendGauss`. Each point is rendered as a Gaussian with a lateral sigma of `sx` and an axial
+    sigma of `sz` (or the slice thickness, whichever is larger), over a lateral ROI of `roiSigmas*sx` and an axial
+    extent of 2*sz.
+    
+    Parameters
+    ----------
+    x, y, z : ndarray
+        positions [nm]
+    sx, sz : ndarray
+        lateral and axial (gaussian) widths (sigmas) [nm]
+    imageBounds : PYME.IO.ImageBounds
+    pixelSize : float
+        lateral pixel size [nm]
+    zb : tuple
+        (zmin, zmax) bounds of the rendered volume [nm]
+    sliceSize : float
+        axial pixel size [nm]
+    roiSigmas : float
+        lateral size of the ROI each point is rendered over, in multiples of that point's sigma
+    num_threads : int
+        number of threads to render with (default is given by the `rendering-num_threads` config option).
 
-    #print pixelSize
+    Returns
+    -------
+    im : ndarray
+        3D Gaussian rendering
+    """
+    from PYME.LMVis import gaussSplat
+    
+    sx = numpy.maximum(sx, pixelSize)
+    sz = numpy.asarray(sz)*numpy.ones_like(sx)
+    roiSizes = numpy.ceil(roiSigmas*sx/pixelSize + 0.5).astype('i') #+0.5 as points can be up to half a pixel off centre
+    zRoiSizes = numpy.round(2*sz/sliceSize).astype('i')
+    szr = numpy.maximum(sz, sliceSize)
 
-    X = numpy.arange(imageBounds.x0 - fuzz,imageBounds.x1 + fuzz, pixelSize)
-    Y = numpy.arange(imageBounds.y0 - fuzz,imageBounds.y1 + fuzz, pixelSize)
+    X = numpy.arange(imageBounds.x0,imageBounds.x1, pixelSize)
+    Y = numpy.arange(imageBounds.y0,imageBounds.y1, pixelSize)
     Z = numpy.arange(zb[0], zb[1], sliceSize)
+    
+    #same normalisation as the genGauss3D model function
+    A = 1.0e3/(sx*sx*szr*15.75)
 
-    #print X
-
-    im = scipy.zeros((len(X), len(Y), len(Z)), 'f')
-
-    #record our image resolution so we can plot pts with a minimum size equal to res (to avoid missing small pts)
-    delX = scipy.absolute(X[1] - X[0])
-    delZ = scipy.absolute(Z[1] - Z[0])
-
-    #for zn in range(len(Z)):
-    for i in range(len(x)):
-        ix = scipy.absolute(X - x[i]).argmin()
-        iy = scipy.absolute(Y - y[i]).argmin()
-        iz = scipy.absolute(Z - z[i]).argmin()
-        
-        dz = int(round(2*sz[i]/delZ))
-
-        iz_min = max(iz - dz, 0)
-        iz_max = min(iz + dz + 1, len(Z))
-
-
-        imp = genGauss3D(X[(ix - roiSize):(ix + roiSize + 1)], Y[(iy - roiSize):(iy + roiSize + 1)],Z[iz_min:iz_max], 1.0e3,x[i],y[i],z[i], sx[i],max(sz[i], sliceSize))
-        #print imp.shape
-        #print im[(ix - roiSize):(ix + roiSize + 1), (iy - roiSize):(iy + roiSize + 1), zn].shape
-        im[(ix - roiSize):(ix + roiSize + 1), (iy - roiSize):(iy + roiSize + 1), iz_min:iz_max] += imp
-
-    im = im[roiSize:-roiSize, roiSize:-roiSize, :]
-
-    return im
+    return gaussSplat.splat_gaussians([X, Y, Z], [x, y, z], [sx, sx, szr], A, [roiSizes, roiSizes, zRoiSizes],
+                                      num_threads=num_threads)
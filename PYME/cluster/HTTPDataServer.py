@@ -82,6 +82,7 @@ from socketserver import ThreadingMixIn
 
 from io import StringIO, BytesIO
 import shutil
+import tempfile
 #import urllib
 import sys
 import ujson as json
@@ -101,6 +102,8 @@ import socket
 import threading
 import datetime
 import time
+import zlib
+import queue as Queue
 
 #GPU status functions
 try:
@@ -115,6 +118,8 @@ procName = compName + ' - PID:%d' % os.getpid()
 
 LOG_REQUESTS = False#True
 USE_DIR_CACHE = True
+#unpickling data from the network is unsafe - only allow it if explicitly enabled (for legacy clients)
+ALLOW_PICKLE = config.get('dataserver-allow_pickle', False)
 
 startTime = datetime.datetime.now()
 #global_status = {}
@@ -179,13 +184,105 @@ class statusPoller(threading.Thread):
     def stop(self):
         self.poll = False
 
-textfile_locks = {}
-def getTextFileLock(filename):
-    try:
-        return textfile_locks[filename]
-    except KeyError:
-        textfile_locks[filename] = threading.Lock()
-        return textfile_locks[filename]
+class AppendFileCache(object):
+    """
+    A registry of files which are held open for appending (used for `__aggregate_txt`). This avoids re-opening the file
+    for every PUT when a whole cluster is aggregating results into the same file.
+
+    Writes are buffered (so many small appends are coalesced into larger disk writes once the buffer fills), and a
+    background thread flushes dirty files every `flush_interval` seconds and closes files which have not been written
+    to for `idle_timeout` seconds. :meth:`close_all` should be called on shutdown to flush and close everything.
+    """
+    def __init__(self, idle_timeout=30, flush_interval=1, buffer_size=2**20):
+        self.idle_timeout = idle_timeout
+        self.flush_interval = flush_interval
+        self.buffer_size = int(buffer_size)
+        
+        self._files = {}
+        self._lock = threading.Lock()
+        
+        self._poll_thread = None
+        self._alive = True
+        
+    def _ensure_poll_thread(self):
+        if self._poll_thread is None:
+            self._poll_thread = threading.Thread(target=self._poll)
+            self._poll_thread.daemon = True
+            self._poll_thread.start()
+    
+    def append(self, path, data):
+        """Append data to the file at path, opening it if needed. Safe to call from multiple threads."""
+        while True:
+            with self._lock:
+                self._ensure_poll_thread()
+                
+                try:
+                    entry = self._files[path]
+                except KeyError:
+                    entry = {'file': open(path, 'ab', self.buffer_size), 'lock': threading.Lock(), 'last_access': 0,
+                             'dirty': False}
+                    self._files[path] = entry
+        
+            with entry['lock']:
+                if entry['file'] is None:
+                    # we raced with the poll thread closing the file - try again
+                    continue
+                
+                entry['file'].write(data)
+                entry['last_access'] = time.time()
+                entry['dirty'] = True
+                return
+            
+    def flush(self, path):
+        """Flush any buffered data for path to disk (no-op if we don't have it open)"""
+        with self._lock:
+            entry = self._files.get(path, None)
+            
+        if entry is not None:
+            self._flush_entry(entry)
+            
+    def _flush_entry(self, entry, close=False):
+        with entry['lock']:
+            if entry['file'] is None:
+                return
+            
+            if entry['dirty']:
+                entry['file'].flush()
+                entry['dirty'] = False
+            
+            if close:
+                entry['file'].close()
+                entry['file'] = None
+    
+    def _poll(self):
+        while self._alive:
+            time.sleep(self.flush_interval)
+            
+            t = time.time()
+            with self._lock:
+                idle = [p for p, e in self._files.items() if (t - e['last_access']) > self.idle_timeout]
+                entries = list(self._files.values())
+                idle_entries = [self._files.pop(p) for p in idle]
+                
+            for entry in entries:
+                try:
+                    self._flush_entry(entry, close=(entry in idle_entries))
+                except:
+                    logger.exception('Error flushing aggregation file')
+    
+    def close_all(self):
+        """Flush and close all open files"""
+        self._alive = False
+        with self._lock:
+            entries = list(self._files.values())
+            self._files.clear()
+            
+        for entry in entries:
+            self._flush_entry(entry, close=True)
+
+_append_file_cache = AppendFileCache(idle_timeout=config.get('dataserver-aggregate_idle_timeout', 30),
+                                     flush_interval=config.get('dataserver-aggregate_flush_interval', 1),
+                                     buffer_size=config.get('dataserver-aggregate_buffer_size', 2**20))
 
 
 from collections import OrderedDict
@@ -243,12 +340,9 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         #    os.makedirs(dirname)
         makedirs_safe(dirname)
 
-        #append the contents of the put request
-        with getTextFileLock(path):
-            #lock so that we don't corrupt the data by writing from two different threads
-            #TODO ?? - keep a cache of open files
-            with open(path, 'ab') as f:
-                f.write(data)
+        #append the contents of the put request. The file is held open (and locked so that we don't corrupt the data
+        #by writing from two different threads) by the append cache, and flushed periodically.
+        _append_file_cache.append(path, data)
 
         if USE_DIR_CACHE:
             cl.dir_cache.update_cache(path, int(len(data)))
@@ -267,6 +361,53 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     
         return out
     
+    def _stream_data_to_file(self, f, chunk_size=2**20):
+        """
+        Copy the body of the request into the file object `f` in chunks (decompressing on the fly if needed), rather than
+        reading it all into memory first.
+
+        Returns
+        -------
+        the number of (uncompressed) bytes written
+        """
+        remaining = int(self.headers['Content-Length'])
+        
+        if self.headers.get('Content-Encoding') == 'gzip':
+            decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            decomp = None
+            
+        nbytes = 0
+        while remaining > 0:
+            chunk = self.rfile.read(min(chunk_size, remaining))
+            if not chunk:
+                raise IOError('Connection closed with %d bytes of request body outstanding' % remaining)
+            
+            remaining -= len(chunk)
+            
+            if decomp is not None:
+                chunk = decomp.decompress(chunk)
+            
+            f.write(chunk)
+            nbytes += len(chunk)
+            
+        if decomp is not None:
+            chunk = decomp.flush()
+            f.write(chunk)
+            nbytes += len(chunk)
+            
+        return nbytes
+    
+    def _discard_data(self, chunk_size=2**20):
+        """Read and discard the request body (so that we can re-use the connection if we are not using the data)"""
+        remaining = int(self.headers.get('Content-Length', 0))
+        
+        while remaining > 0:
+            chunk = self.rfile.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+    
     def _get_data(self):
         data = self.rfile.read(int(self.headers['Content-Length']))
     
@@ -290,6 +431,7 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         from six.moves import cPickle
         from PYME.IO import MetaDataHandler
         from PYME.IO import h5rFile
+        from PYME.IO import recordFormat
 
         # path = self.translate_path(self.path.lstrip('/')[len('__aggregate_h5r'):])
         # filename, tablename = path.split('.h5r')
@@ -299,6 +441,10 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         filename = self.translate_path(filename + '.h5r')
 
         data = self._get_data()
+        
+        if tablename == '' and not ALLOW_PICKLE:
+            self.send_error(400, 'Pickled fitResults are not accepted (see the dataserver-allow_pickle config option)')
+            return
 
         dirname = os.path.dirname(filename)
         #if not os.path.exists(dirname):
@@ -315,19 +461,9 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 fitResults = cPickle.loads(data)
                 h5f.fileFitResult(fitResults)
             else:
-                try:
-                    #pickle is much faster than numpy array format (despite the array format being simpler)
-                    #reluctanltly use pickles
-                    data = np.loads(data)
-                except cPickle.UnpicklingError:
-                    try:
-                        #try to read data as if it was numpy binary formatted
-                        data = np.load(BytesIO(data))
-                    except IOError:
-                        #it's not numpy formatted - try json
-                        import pandas as pd
-                        #FIXME!! - this will work, but will likely be really slow!
-                        data = pd.read_json(data).to_records(False)
+                # decode - normally this is in our binary record stream format (see PYME.IO.recordFormat), but we also
+                # accept .npy, json, and (optionally) pickles.
+                data = recordFormat.decode_results(data, allow_pickle=ALLOW_PICKLE)
 
                 #logging.debug('adding data to table')
                 h5f.appendToTable(tablename.lstrip('/'), data)
@@ -406,7 +542,7 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
             
         if self.bandwidthTesting:
             #just read file and dump contents
-            r = self.rfile.read(int(self.headers['Content-Length']))
+            self._discard_data()
             self.send_response(200)
             self.send_header("Content-Length", "0")
             self.end_headers()
@@ -424,6 +560,8 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
 
         if os.path.exists(path):
             #Do not overwrite - we use write-once semantics
+            #read the data we are not going to use so that the connection can be re-used (HTTP/1.1 keep-alive)
+            self._discard_data()
             self.send_error(405, "File already exists %s" % path)
 
             #self.end_headers()
@@ -456,17 +594,28 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                     cl.dir_cache.update_cache(path, len(r.content))
 
             else:
-                #the standard case - use the contents of the put request
-                with open(path, 'wb') as f:
-                    #shutil.copyfileobj(self.rfile, f, int(self.headers['Content-Length']))
-                    data = self._get_data()
-                    f.write(data)
-
-                    #set the file to read-only (reflecting our write-once semantics
-                    os.chmod(path, 0o440)
+                #the standard case - use the contents of the put request, streaming it to disk so that we don't need
+                #to hold large files in memory. We stream to a temporary file in the same directory and rename it into
+                #place once complete so that readers never see a partial file, and so that a failed upload doesn't
+                #leave a partial file behind (which would block a retry given our write-once semantics).
+                fd, tmp_path = tempfile.mkstemp(dir=dir, prefix='.%s.' % file, suffix='.part')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        nbytes = self._stream_data_to_file(f)
                     
-                    if USE_DIR_CACHE:
-                        cl.dir_cache.update_cache(path, len(data))
+                    #set the file to read-only (reflecting our write-once semantics
+                    os.chmod(tmp_path, 0o440)
+                    os.rename(tmp_path, path)
+                except:
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        #make sure the original error propagates
+                        logger.exception('Error removing temporary file %s' % tmp_path)
+                    raise
+                
+                if USE_DIR_CACHE:
+                    cl.dir_cache.update_cache(path, nbytes)
 
             self.send_response(200)
             self.send_header("Content-Length", "0")
@@ -505,10 +654,10 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         pattern = query['pattern'][0]
         
         logger.debug('glob: pattern = %s' % pattern)
-        matches = glob.glob(pattern)
+        matches = cl.location_index.glob(pattern)
 
         f = BytesIO()
-        f.write(json.dumps(matches))
+        f.write(json.dumps(matches).encode())
         length = f.tell()
         f.seek(0)
         self.send_response(200)
@@ -517,6 +666,31 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         self.send_header("Content-Length", str(length))
         self.end_headers()
         return f
+    
+    def get_locate(self):
+        """
+        Answer location queries from `clusterIO.locate_file` using our location index. The query string can contain
+        any number of `path` entries (files we should check for), and `prefix` entries (e.g. `series/frame0001`, find
+        any files in `series/` which start with `frame0001`). Returns a json list of the matching paths.
+        """
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        #query values have already been unquoted, translate_path expects them to be quoted
+        _local_path = lambda p: self.translate_path('/' + urlparse.quote(p.lstrip('/')))
+        
+        found = [p for p in query.get('path', []) if cl.location_index.has_file(_local_path(p))]
+        
+        for prefix in query.get('prefix', []):
+            dirname, fn_prefix = prefix.lstrip('/').rpartition('/')[::2]
+            matches = cl.location_index.find_prefix(_local_path(dirname), fn_prefix)
+            found.extend([(dirname + '/' + n) if dirname else n for n in matches])
+        
+        f, length = self._string_to_file(json.dumps(found))
+        self.send_response(200)
+        encoding = sys.getfilesystemencoding()
+        self.send_header("Content-type", "application/json; charset=%s" % encoding)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+        return f
 
     def send_head(self):
         """Common code for GET and HEAD commands.
@@ -538,6 +712,9 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
         if self.path.lstrip('/').startswith('__glob'):
             return self.get_glob()
         
+        if self.path.lstrip('/').startswith('__locate'):
+            return self.get_locate()
+        
         if os.path.isdir(path):
             parts = urlparse.urlsplit(self.path)
             if not parts.path.endswith('/'):
@@ -568,6 +745,10 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
                 return self.get_h5_part(path)
 
         ctype = self.guess_type(path)
+        
+        # make sure anything we have aggregated into this file, but not yet flushed, is on disk
+        _append_file_cache.flush(path)
+        
         try:
             # Always read in binary mode. Opening files in text mode may cause
             # newline translations, making the actual size of the content
@@ -782,6 +963,180 @@ class PYMEHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
 
 class ThreadedHTTPServer(ThreadingMixIn, http.server.HTTPServer):
     """Handle requests in a separate thread."""
+    
+
+class _PooledConnection(object):
+    """A client connection served by `ThreadPoolHTTPServer`, along with the handler which reads / writes it"""
+    def __init__(self, request, client_address):
+        self.request = request
+        self.client_address = client_address
+        self.handler = None
+        self.last_active = time.time()
+        
+
+class ThreadPoolHTTPServer(http.server.HTTPServer):
+    """
+    Handle connections using a fixed size pool of worker threads, rather than creating a new thread for each
+    connection.
+    
+    Workers are not tied to a connection. Idle (keep-alive) connections are watched by a single selector thread, and a
+    connection is only handed to a worker once it has a request waiting to be read. The worker serves that one request
+    and returns the connection to the selector, so clients holding persistent sessions open (as the cluster clients do)
+    don't tie up workers, however many of them there are. Connections which are idle for more than `keepalive_timeout`
+    seconds are closed.
+    
+    NB - HTTP pipelining is not supported, i.e. clients should wait for a response before sending the next request.
+    """
+    def __init__(self, server_address, RequestHandlerClass, num_threads=32, keepalive_timeout=30,
+                 bind_and_activate=True):
+        import selectors
+        http.server.HTTPServer.__init__(self, server_address, RequestHandlerClass, bind_and_activate)
+        
+        self.keepalive_timeout = keepalive_timeout
+        
+        #handlers are constructed (running any initialisation in the handler class) when a connection is first served,
+        #but don't serve the connection themselves - we call handle_one_request for each request as it arrives
+        self._pooled_handler_class = type('Pooled' + RequestHandlerClass.__name__, (RequestHandlerClass,),
+                                          {'handle': lambda self: None, 'finish': lambda self: None})
+        
+        #connections with a request waiting to be served
+        self._ready = Queue.Queue()
+        
+        #connections to (re-)register with the selector. Registration is done from the selector thread, which we wake by
+        #writing to a socket pair
+        self._to_watch = Queue.Queue()
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._alive = True
+        
+        self._watch_thread = threading.Thread(target=self._watch_loop)
+        self._watch_thread.daemon = True
+        self._watch_thread.start()
+        
+        self._workers = []
+        for i in range(num_threads):
+            t = threading.Thread(target=self._worker_loop)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+            
+    def _watch(self, conn):
+        """Hand a connection to the selector thread to wait for its next request"""
+        conn.last_active = time.time()
+        self._to_watch.put(conn)
+        try:
+            self._wake_w.send(b'x')
+        except OSError:
+            #we are shutting down
+            pass
+            
+    def _watch_loop(self):
+        import selectors
+        watched = {}
+        
+        while self._alive:
+            for key, events in self._selector.select(timeout=1):
+                if key.data is None:
+                    #wake up call - new connections to watch
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                else:
+                    conn = key.data
+                    self._selector.unregister(conn.request)
+                    del watched[conn.request]
+                    self._ready.put(conn)
+                    
+            while True:
+                try:
+                    conn = self._to_watch.get_nowait()
+                except Queue.Empty:
+                    break
+                
+                try:
+                    self._selector.register(conn.request, selectors.EVENT_READ, conn)
+                    watched[conn.request] = conn
+                except (ValueError, OSError):
+                    #socket has been closed under us
+                    self._close(conn)
+                
+            #close connections which have been idle for too long
+            expired = time.time() - self.keepalive_timeout
+            for sock, conn in list(watched.items()):
+                if conn.last_active < expired:
+                    self._selector.unregister(sock)
+                    del watched[sock]
+                    self._close(conn)
+                    
+        for conn in watched.values():
+            self._close(conn)
+            
+    def _close(self, conn):
+        try:
+            if conn.handler is not None:
+                self.RequestHandlerClass.finish(conn.handler)
+        except Exception:
+            pass
+        
+        self.shutdown_request(conn.request)
+        
+    def _has_buffered_request(self, conn):
+        """Check (without blocking) whether the start of another request has already been read into our buffer"""
+        sock = conn.request
+        timeout = sock.gettimeout()
+        try:
+            sock.settimeout(0)
+            return len(conn.handler.rfile.peek(1)) > 0
+        except (OSError, ValueError):
+            return False
+        finally:
+            try:
+                sock.settimeout(timeout)
+            except OSError:
+                pass
+            
+    def _worker_loop(self):
+        while True:
+            conn = self._ready.get()
+            if conn is None:
+                #sentinel - we are shutting down
+                return
+            
+            try:
+                if conn.handler is None:
+                    conn.handler = self._pooled_handler_class(conn.request, conn.client_address, self)
+                
+                #serve a single request
+                conn.handler.close_connection = True
+                conn.handler.handle_one_request()
+                
+                if conn.handler.close_connection:
+                    self._close(conn)
+                elif self._has_buffered_request(conn):
+                    self._ready.put(conn)
+                else:
+                    self._watch(conn)
+            except Exception:
+                self.handle_error(conn.request, conn.client_address)
+                self._close(conn)
+    
+    def process_request(self, request, client_address):
+        #wait for the client to send a request before tying up a worker
+        self._watch(_PooledConnection(request, client_address))
+        
+    def server_close(self):
+        http.server.HTTPServer.server_close(self)
+        
+        self._alive = False
+        self._wake_w.close()
+        self._watch_thread.join(2)
+        
+        for t in self._workers:
+            self._ready.put(None)
 
 
 def main(protocol="HTTP/1.0"):
@@ -807,6 +1162,8 @@ def main(protocol="HTTP/1.0"):
     default_server_filter = config.get('dataserver-filter', compName)
     op.add_option('-f', '--server-filter', dest='server_filter', help='Add a serverfilter for distinguishing between different clusters', default=default_server_filter)
     op.add_option('--timeout-test', dest='timeout_test', help='deliberately make requests timeout for testing error handling in calling modules', default=0)
+    op.add_option('-n', '--num-threads', dest='num_threads', type='int', default=config.get('dataserver-num_threads', 0),
+                  help="Serve requests using a fixed pool of this many threads, rather than a thread per connection (default 0 = thread per connection, see also 'dataserver-num_threads' config entry)")
 
 
     options, args = op.parse_args()
@@ -830,9 +1187,15 @@ def main(protocol="HTTP/1.0"):
     PYMEHTTPRequestHandler.timeoutTesting = options.timeout_test
     PYMEHTTPRequestHandler.logrequests = options.log_requests
 
-    httpd = ThreadedHTTPServer(server_address, PYMEHTTPRequestHandler)
-    #httpd = http.server.HTTPServer(server_address, PYMEHTTPRequestHandler)
-    httpd.daemon_threads = True
+    if options.num_threads > 0:
+        #don't let a stalled client tie up a pool thread part way through a request
+        PYMEHTTPRequestHandler.timeout = config.get('dataserver-keepalive_timeout', 30)
+        httpd = ThreadPoolHTTPServer(server_address, PYMEHTTPRequestHandler, num_threads=options.num_threads,
+                                     keepalive_timeout=config.get('dataserver-keepalive_timeout', 30))
+    else:
+        httpd = ThreadedHTTPServer(server_address, PYMEHTTPRequestHandler)
+        #httpd = http.server.HTTPServer(server_address, PYMEHTTPRequestHandler)
+        httpd.daemon_threads = True
 
     sa = httpd.socket.getsockname()
 
@@ -849,6 +1212,7 @@ def main(protocol="HTTP/1.0"):
     status['BindAddress'] = server_address
     status['Port'] = sa[1]
     status['Protocol'] = options.protocol
+    status['NumThreads'] = options.num_threads
     status['TestMode'] = options.test
     status['ComputerName'] = GetComputerName()
 
@@ -869,6 +1233,11 @@ def main(protocol="HTTP/1.0"):
         logger.info('Shutting down ...')
         httpd.shutdown()
         httpd.server_close()
+        
+        #make sure any results we are aggregating make it to disk
+        from PYME.IO import h5rFile
+        _append_file_cache.close_all()
+        h5rFile.close_all()
 
         if options.profile:
             mProfile.report(display=False, profiledir=profileOutDir)
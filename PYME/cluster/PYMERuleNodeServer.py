@@ -96,13 +96,18 @@ def main():
     logger.debug('Launching worker processors')
     numWorkers = config.get('nodeserver-num_workers', cpu_count())
 
-    workerProcs = [subprocess.Popen('python -m PYME.cluster.taskWorkerHTTP', shell=True, stdin=subprocess.PIPE)
-                   for i in range(numWorkers -1)]
-
-    #last worker has profiling enabled
-    profiledir = os.path.join(nodeserver_log_dir, 'mProf')      
-    workerProcs.append(subprocess.Popen('python -m PYME.cluster.taskWorkerHTTP -p %s' % profiledir, shell=True,
-                                        stdin=subprocess.PIPE))
+    if config.get('nodeserver-worker_pool', False):
+        #launch a single worker which runs tasks on a pool of numWorkers compute processes
+        workerProcs = [subprocess.Popen('python -m PYME.cluster.taskWorkerHTTP -n %d' % numWorkers, shell=True,
+                                        stdin=subprocess.PIPE)]
+    else:
+        workerProcs = [subprocess.Popen('python -m PYME.cluster.taskWorkerHTTP', shell=True, stdin=subprocess.PIPE)
+                       for i in range(numWorkers -1)]
+    
+        #last worker has profiling enabled
+        profiledir = os.path.join(nodeserver_log_dir, 'mProf')
+        workerProcs.append(subprocess.Popen('python -m PYME.cluster.taskWorkerHTTP -p %s' % profiledir, shell=True,
+                                            stdin=subprocess.PIPE))
 
     try:
         while proc.is_alive():
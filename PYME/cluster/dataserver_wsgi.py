@@ -73,6 +73,8 @@ compName = GetComputerName()
 procName = compName + ' - PID:%d' % os.getpid()
 
 LOG_REQUESTS = False#True
+#unpickling data from the network is unsafe - only allow it if explicitly enabled (for legacy clients)
+ALLOW_PICKLE = config.get('dataserver-allow_pickle', False)
 
 startTime = datetime.datetime.now()
 global_status = {}
@@ -182,10 +184,14 @@ class dataserver(object):
         from six.moves import cPickle
         from PYME.IO import MetaDataHandler
         from PYME.IO import h5rFile
+        from PYME.IO import recordFormat
 
         path = self.translate_path(path.lstrip('/')[len('__aggregate_h5r'):])
         filename, tablename = path.split('.h5r')
         filename += '.h5r'
+        
+        if tablename == '' and not ALLOW_PICKLE:
+            return ResponseNotAllowed('Pickled fitResults are not accepted (see the dataserver-allow_pickle config option)')
 
         #logging.debug('opening h5r file')
         with h5rFile.openH5R(filename, 'a') as h5f:
@@ -197,14 +203,9 @@ class dataserver(object):
                 fitResults = cPickle.loads(data)
                 h5f.fileFitResult(fitResults)
             else:
-                try:
-                    #try to read data as if it was numpy binary formatted
-                    data = np.load(BytesIO(data))
-                except IOError:
-                    #it's not numpy formatted - try json
-                    import pandas as pd
-                    #FIXME!! - this will work, but will likely be really slow!
-                    data = pd.read_json(data).to_records(False)
+                # decode - normally this is in our binary record stream format (see PYME.IO.recordFormat), but we also
+                # accept .npy, json, and (optionally) pickles.
+                data = recordFormat.decode_results(data, allow_pickle=ALLOW_PICKLE)
 
                 #logging.debug('adding data to table')
                 h5f.appendToTable(tablename.lstrip('/'), data)
@@ -362,8 +362,21 @@ class NodeServer(object):
 
 
     @webframework.register_endpoint('/node/handin')
-    def _handin(self, taskID, status):
-        self._handins.put({'id': taskID, 'status':status})
+    def _handin(self, taskID=None, status=None, body=None):
+        """
+        Hand in one or more completed tasks.
+
+        A single task can be handed in using the `taskID` and `status` query parameters. Multiple tasks can be handed in
+        at once by POSTing a json formatted list of the form ``[{'id' : taskID, 'status' : status}, ...]`` as the request
+        body. The batched form is preferred, as it avoids one HTTP round trip per task.
+        """
+        if not taskID is None:
+            self._handins.put({'id': taskID, 'status':status})
+
+        if body:
+            for handin in json.loads(body):
+                self._handins.put({'id': handin['id'], 'status': handin['status']})
+
         return json.dumps({'ok' : True})
 
     @webframework.register_endpoint('/node/status')
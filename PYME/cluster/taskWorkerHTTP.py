@@ -34,6 +34,11 @@ matplotlib.use('SVG')
 
 import queue as Queue
 import threading
+import collections
+import json
+import zlib
+import hashlib
+import numpy as np
 
 #import PYME.misc.pyme_zeroconf as pzc
 from PYME import config
@@ -81,6 +86,15 @@ from PYME.IO import clusterResults
 #time.sleep(3)
 
 
+#how long (in s) to accumulate results before filing them and handing the tasks back to the nodeserver
+HANDIN_INTERVAL = config.get('httpworker-handin_interval', 1.0)
+#the maximum number of completed tasks to accumulate before forcing a hand-in
+HANDIN_MAX_TASKS = config.get('httpworker-handin_max_tasks', 500)
+#the number of consecutive frames of a series which should be processed by the same compute process in pool mode
+SERIES_CHUNK_SIZE = config.get('nodeserver-chunksize', 50)
+#the number of parsed recipes to keep for re-use by subsequent recipe tasks
+RECIPE_CACHE_SIZE = config.get('httpworker-recipe_cache_size', 10)
+
 LOCAL = False
 if 'PYME_LOCAL_ONLY' in os.environ.keys():
     LOCAL = os.environ['PYME_LOCAL_ONLY'] == '1'
@@ -115,18 +129,39 @@ Traceback:
         
 
 class taskWorker(object):
-    def __init__(self):
+    def __init__(self, num_compute_processes=1):
+        """
+        
+        Parameters
+        ----------
+        num_compute_processes : int
+            The number of processes to run tasks in. If 1 (the default), tasks are run in a thread within this process.
+            If > 1, a single io loop fetches tasks from the nodeserver and hands them out to a pool of compute
+            processes (pool mode). This replaces running one worker process per core, each polling the nodeserver and
+            reading data independently.
+        """
         self.inputQueue = Queue.Queue()
         self.resultsQueue = Queue.Queue()
 
         self.procName = '%s_%d' % (compName, os.getpid())
+        
+        self.num_compute_processes = num_compute_processes
 
         self._loop_alive = True
 
+        self._pending_results = []
+        self._last_handin_time = time.time()
+        
+        #tasks which have been handed to a compute process (pool mode only), keyed by task id
+        self._in_flight = {}
+
     def loop_forever(self):
-        self.tCompute = threading.Thread(target=self.computeLoop)
-        self.tCompute.daemon = True
-        self.tCompute.start()
+        if self.num_compute_processes > 1:
+            self._start_compute_pool()
+        else:
+            self.tCompute = threading.Thread(target=self.computeLoop)
+            self.tCompute.daemon = True
+            self.tCompute.start()
 
         self.tIO = threading.Thread(target=self.ioLoop)
         self.tIO.daemon = True
@@ -137,71 +172,217 @@ class taskWorker(object):
                 time.sleep(1)
         finally:
             self._loop_alive = False
+            
+            if self.num_compute_processes > 1:
+                self._stop_compute_pool()
+                
+    def _start_compute_pool(self):
+        import multiprocessing
+        
+        cache_size = config.get('httpworker-shared_frame_cache_mb', 512)
+        if (cache_size > 0) and (multiprocessing.get_start_method() != 'fork'):
+            logger.warning('Shared frame cache is only supported when forking compute processes, not using it')
+        elif cache_size > 0:
+            # create a frame cache in shared memory which will be inherited by the compute processes, so that frames
+            # used by several processes (e.g. for background estimation) only need to be read and decompressed once
+            from PYME.IO import buffers
+            remFitBuf.bufferManager.sharedFrameCache = buffers.SharedFrameCache(cache_size)
+        
+        self._compute_results = multiprocessing.Queue()
+        self._compute_queues = [None]*self.num_compute_processes
+        self._compute_procs = [None]*self.num_compute_processes
+        for i in range(self.num_compute_processes):
+            self._launch_compute_process(i)
+
+        # allow enough tasks in flight for each process to be working on a full chunk
+        self._slots = threading.Semaphore(self.num_compute_processes*SERIES_CHUNK_SIZE)
+        # protects _in_flight and the process / queue lists (which are modified when a dead process is replaced)
+        self._pool_lock = threading.Lock()
+        self._last_liveness_check = time.time()
+        
+        self.tCompute = threading.Thread(target=self._dispatch_loop)
+        self.tCompute.daemon = True
+        self.tCompute.start()
 
-    def _return_task_results(self):
+        self.tCollect = threading.Thread(target=self._collect_loop)
+        self.tCollect.daemon = True
+        self.tCollect.start()
+        
+    def _launch_compute_process(self, proc_num):
+        import multiprocessing
+        
+        q = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_compute_process_loop, args=(q, self._compute_results))
+        p.daemon = True
+        p.start()
+        
+        self._compute_queues[proc_num] = q
+        self._compute_procs[proc_num] = p
+        
+    def _check_compute_processes(self):
+        """
+        Detect compute processes which have died (e.g. segfaulted or were killed by the OOM killer), hand in the tasks
+        they were working on as failures (freeing their slots), and replace them with new processes.
+        """
+        dead = [proc_num for proc_num, p in enumerate(self._compute_procs) if not p.is_alive()]
+        if len(dead) == 0:
+            return
+        
+        # collect any results the processes managed to return before dying
+        while True:
+            try:
+                self._handle_result(*self._compute_results.get_nowait())
+            except Queue.Empty:
+                break
+        
+        with self._pool_lock:
+            for proc_num in dead:
+                p = self._compute_procs[proc_num]
+                lost = [(task_id, queueURL, taskDescr) for task_id, (queueURL, taskDescr, n) in self._in_flight.items()
+                        if n == proc_num]
+                logger.error('Compute process %d (pid %s) died with exit code %s, failing %d in-flight tasks' %
+                             (proc_num, p.pid, p.exitcode, len(lost)))
+                
+                for task_id, queueURL, taskDescr in lost:
+                    del self._in_flight[task_id]
+                    self.resultsQueue.put((queueURL, taskDescr,
+                                           TaskError(taskDescr, 'Compute process died with exit code %s' % p.exitcode)))
+                    self._slots.release()
+                
+                # don't block on exit trying to flush tasks which will never be read
+                self._compute_queues[proc_num].cancel_join_thread()
+                self._compute_queues[proc_num].close()
+                
+                self._launch_compute_process(proc_num)
+                
+    def _stop_compute_pool(self):
+        for q in self._compute_queues:
+            q.put(None)
+            
+        for p in self._compute_procs:
+            p.join(2)
+            if p.is_alive():
+                p.terminate()
+
+    def _return_task_results(self, force=False):
         """
 
         File all results that this worker has completed
 
+        Results are accumulated for up to `HANDIN_INTERVAL` seconds (or until `HANDIN_MAX_TASKS` tasks are waiting) and
+        then filed together. Fit and drift results which are destined for the same table are concatenated and sent with
+        a single PUT, and all the tasks for a given node server are handed in with a single POST. This avoids the
+        2+ HTTP round trips per frame which otherwise limits throughput on localization analysis.
+
+        Parameters
+        ----------
+        force : bool
+            file any accumulated results immediately, regardless of how long they have been waiting
+
         Returns
         -------
 
         """
         while True:  # loop over results queue until it's empty
-            # print 'getting results'
             try:
-                queueURL, taskDescr, res = self.resultsQueue.get_nowait()
-                outputs = taskDescr.get('outputs', {})
+                self._pending_results.append(self.resultsQueue.get_nowait())
             except Queue.Empty:
                 # queue is empty
-                return
+                break
+
+        if len(self._pending_results) == 0:
+            return
+
+        if ((time.time() - self._last_handin_time) < HANDIN_INTERVAL) and (len(self._pending_results) < HANDIN_MAX_TASKS)\
+                and self._loop_alive and not force:
+            # wait for more results to accumulate
+            return
+
+        pending, self._pending_results = self._pending_results, []
+        self._last_handin_time = time.time()
+
+        handins = {}
+        aggregated = {}
+
+        def _handin(queueURL, taskDescr, status):
+            handins.setdefault(queueURL, collections.OrderedDict())[taskDescr['id']] = status
+
+        for queueURL, taskDescr, res in pending:
+            outputs = taskDescr.get('outputs', {})
 
             if isinstance(res, TaskError):
                 # failure
-                clusterResults.fileResults(res.log_url, res.to_string())
-                
-                s = clusterIO._getSession(queueURL)
-                r = s.post(queueURL + 'node/handin?taskID=%s&status=failure' % taskDescr['id'])
-                if not r.status_code == 200:
-                    logger.error('Returning task failed with error: %s' % r.status_code)
+                try:
+                    clusterResults.fileResults(res.log_url, res.to_string())
+                except:
+                    logger.exception('Error filing task error log')
+
+                _handin(queueURL, taskDescr, 'failure')
+
             elif res is None:
                 # failure
-                s = clusterIO._getSession(queueURL)
-                r = s.post(queueURL + 'node/handin?taskID=%s&status=failure' % taskDescr['id'])
-                if not r.status_code == 200:
-                    logger.error('Returning task failed with error: %s' % r.status_code)
-            
+                _handin(queueURL, taskDescr, 'failure')
+
             elif res == True:  # isinstance(res, ModuleCollection): #recipe output
                 # res.save(outputs) #abuse outputs dictionary as context
+                _handin(queueURL, taskDescr, 'success')
 
-                s = clusterIO._getSession(queueURL)
-                r = s.post(queueURL + 'node/handin?taskID=%s&status=success' % taskDescr['id'])
-                if not r.status_code == 200:
-                    logger.error('Returning task failed with error: %s' % r.status_code)
+            elif 'results' in outputs.keys():
+                # old style pickled results - these can't be aggregated, file individually
+                try:
+                    clusterResults.fileResults(outputs['results'], res)
+                except Exception:
+                    logger.exception('Filing results failed.')
+                    _handin(queueURL, taskDescr, 'failure')
+                else:
+                    _handin(queueURL, taskDescr, 'success')
 
             else:
-                # success
+                # success - group the results by destination so we can file them together
                 try:
-                    if 'results' in outputs.keys():
-                        # old style pickled results
-                        clusterResults.fileResults(outputs['results'], res)
-                    else:
-                        if len(res.results) > 0:
-                            clusterResults.fileResults(outputs['fitResults'], res.results)
-
-                        if len(res.driftResults) > 0:
-                            clusterResults.fileResults(outputs['driftResults'], res.driftResults)
-                except requests.Timeout:
-                    logger.exception('Filing results failed on timeout.')
-                    s = clusterIO._getSession(queueURL)
-                    r = s.post(queueURL + 'node/handin?taskID=%s&status=failure' % taskDescr['id'])
-                    if not r.status_code == 200:
-                        logger.error('Returning task failed with error: %s' % r.status_code)
+                    groups = []
+                    for key, data in [('fitResults', res.results), ('driftResults', res.driftResults)]:
+                        if len(data) > 0:
+                            # non-array results (e.g. lists of legacy fit result objects) can't be concatenated, and end
+                            # up in a group of their own
+                            groups.append(((outputs[key], getattr(data, 'dtype', id(data))), data))
+                except Exception:
+                    logger.exception('Error grouping results for task %s' % taskDescr['id'])
+                    _handin(queueURL, taskDescr, 'failure')
+                    continue
+                
+                _handin(queueURL, taskDescr, 'success')
+                
+                for group_key, data in groups:
+                    agg = aggregated.setdefault(group_key, ([], []))
+                    agg[0].append(data)
+                    agg[1].append((queueURL, taskDescr))
+
+        for (URI, dtype), (data, tasks) in aggregated.items():
+            try:
+                if len(data) == 1:
+                    clusterResults.fileResults(URI, data[0])
                 else:
-                    s = clusterIO._getSession(queueURL)
-                    r = s.post(queueURL + 'node/handin?taskID=%s&status=success' % taskDescr['id'])
-                    if not r.status_code == 200:
-                        logger.error('Returning task failed with error: %s' % r.status_code)
+                    clusterResults.fileResults(URI, np.hstack(data))
+            except Exception:
+                # as we have already taken these results off the pending list, make sure that the tasks are marked as
+                # failed (rather than losing them) and that other groups still get filed
+                logger.exception('Filing results to %s failed.' % URI)
+                for queueURL, taskDescr in tasks:
+                    _handin(queueURL, taskDescr, 'failure')
+
+        for queueURL, task_statuses in handins.items():
+            # a failure to reach one node server shouldn't stop us handing in tasks to the others. Tasks which we fail
+            # to hand in will eventually time out on the node server and be re-assigned.
+            try:
+                s = clusterIO._getSession(queueURL)
+                r = s.post(queueURL + 'node/handin',
+                           data=json.dumps([{'id': taskID, 'status': status} for taskID, status in task_statuses.items()]),
+                           headers={'Content-Type': 'application/json'})
+                if not r.status_code == 200:
+                    logger.error('Returning tasks failed with error: %s' % r.status_code)
+            except Exception:
+                logger.exception('Error returning %d tasks to %s' % (len(task_statuses), queueURL))
 
     def _get_tasks(self, local_queue_name):
         """
@@ -275,9 +456,11 @@ class taskWorker(object):
         """
         localQueueName = 'PYMENodeServer: ' + compName
         while True:
-            # turn in completed tasks
+            # turn in completed tasks. If we have run out of tasks, don't wait for the hand-in interval to expire, as
+            # we could potentially block for a long time in _get_tasks below. In pool mode the dispatch loop empties
+            # the input queue as soon as there are free slots, so we also need to wait for the in-flight tasks.
             try:
-                self._return_task_results()
+                self._return_task_results(force=(self.inputQueue.empty() and (len(self._in_flight) == 0)))
             except:
                 import traceback
                 logger.exception(traceback.format_exc())
@@ -299,104 +482,281 @@ class taskWorker(object):
             #to keep memory usage down
 
             queueURL, taskDescr = self.inputQueue.get()
-            if taskDescr['type'] == 'localization':
+            self.resultsQueue.put((queueURL, taskDescr, compute_task(taskDescr)))
+
+    def _dispatch_loop(self):
+        """
+        Pool mode equivalent of computeLoop. Hands tasks from the input queue to the compute processes, routing tasks
+        from the same chunk of a series to the same process so that its data and background buffers stay warm.
+        """
+        while self._loop_alive:
+            # wait for a free slot before taking the next task off the input queue. This keeps tasks in the input queue
+            # (and hence stops the io loop from requesting more) while the compute processes are busy
+            self._slots.acquire()
+            queueURL, taskDescr = self.inputQueue.get()
+
+            proc_num = self._pick_process(taskDescr)
+            with self._pool_lock:
+                self._in_flight[taskDescr['id']] = (queueURL, taskDescr, proc_num)
+                self._compute_queues[proc_num].put(taskDescr)
+
+    def _collect_loop(self):
+        """
+        Move results from the compute processes to our results queue so that they can be filed by the io loop. Also
+        periodically checks that the compute processes are still alive (see `_check_compute_processes`).
+        """
+        while self._loop_alive:
+            if (time.time() - self._last_liveness_check) > 1:
+                self._last_liveness_check = time.time()
                 try:
-                    task = remFitBuf.createFitTaskFromTaskDef(taskDescr)
-                    res = task()
+                    self._check_compute_processes()
+                except Exception:
+                    logger.exception('Error checking compute processes')
+                
+            try:
+                self._handle_result(*self._compute_results.get(timeout=1))
+            except Queue.Empty:
+                pass
 
-                    self.resultsQueue.put((queueURL, taskDescr, res))
+    def _handle_result(self, taskDescr, res):
+        with self._pool_lock:
+            in_flight = self._in_flight.pop(taskDescr['id'], None)
+            
+        if in_flight is None:
+            # we've already failed this task as its process died (after putting the result in the queue)
+            return
+            
+        self.resultsQueue.put((in_flight[0], taskDescr, res))
+        self._slots.release()
 
-                except:
-                    import traceback
-                    traceback.print_exc()
-                    tb = traceback.format_exc()
-                    logger.exception(tb)
-                    self.resultsQueue.put((queueURL, taskDescr, TaskError(taskDescr, tb)))
-                    #self.resultsQueue.put((queueURL, taskDescr, None))
+    def _pick_process(self, taskDescr):
+        """
+        Choose which compute process a task should run in. Localization tasks from the same series are grouped into
+        chunks of `nodeserver-chunksize` consecutive frames, with each chunk going to a single process (and consecutive
+        chunks going to different processes). Other tasks are distributed based on their ID.
+        """
+        try:
+            series = taskDescr['inputs']['frames']
+            chunk = int(taskDescr['taskdef']['frameIndex']) // SERIES_CHUNK_SIZE
+        except (KeyError, TypeError, ValueError):
+            series = taskDescr['id']
+            chunk = 0
+
+        return (zlib.crc32(series.encode()) + chunk) % self.num_compute_processes
+
+
+class RecipeCache(object):
+    """
+    A cache of parsed recipes, so that batch runs which apply the same recipe to many inputs only parse the recipe (and
+    instantiate its modules) once per compute process. Recipes are keyed on a hash of their text, and each call to
+    :meth:`get` returns a recipe with a fresh, empty, namespace (`compute_task` also empties the namespace once the
+    task has finished, so that cached recipes don't keep task data alive). Module instances (and any precomputation they cache in
+    private traits) are shared between tasks.
+
+    Files referenced by `taskdefRef` are write-once on the cluster, so we also cache the recipe text by reference.
+    """
+    def __init__(self, size=RECIPE_CACHE_SIZE):
+        self.size = size
+        self._recipes = collections.OrderedDict()
+        self._recipe_text = collections.OrderedDict()
+        
+    def _put(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self.size:
+            cache.popitem(last=False)
+            
+    def get_recipe_text(self, taskdefRef):
+        try:
+            return self._recipe_text[taskdefRef]
+        except KeyError:
+            recipe_yaml = unifiedIO.read(taskdefRef)
+            self._put(self._recipe_text, taskdefRef, recipe_yaml)
+            return recipe_yaml
+    
+    def get(self, recipe_yaml):
+        from PYME.recipes.modules import ModuleCollection
+        
+        if not isinstance(recipe_yaml, bytes):
+            key = hashlib.md5(recipe_yaml.encode('utf-8')).hexdigest()
+        else:
+            key = hashlib.md5(recipe_yaml).hexdigest()
+        
+        try:
+            recipe = self._recipes.pop(key)
+            #start with a clean namespace. NB - we create a new dictionary rather than clearing the old one in case
+            #anything from the previous task is still holding a reference to it.
+            recipe.namespace = {}
+        except KeyError:
+            recipe = ModuleCollection.fromYAML(recipe_yaml)
+        
+        # (re-)insert at the most recently used end
+        self._put(self._recipes, key, recipe)
+        return recipe
+    
+_recipe_cache = RecipeCache()
 
-            elif taskDescr['type'] == 'recipe':
-                from PYME.recipes.modules import ModuleCollection
+        
+def compute_task(taskDescr):
+    """
+    Run a single task.
+
+    Parameters
+    ----------
+    taskDescr : dict
+        the task description, as handed out by the nodeserver
+
+    Returns
+    -------
+    The task result (for localization tasks), True (for recipe tasks, which save their own outputs), or a TaskError if
+    the task failed.
+
+    """
+    if taskDescr['type'] == 'localization':
+        try:
+            task = remFitBuf.createFitTaskFromTaskDef(taskDescr)
+            return task()
 
-                try:
-                    taskdefRef = taskDescr.get('taskdefRef', None)
-                    if taskdefRef: #recipe is defined in a file - go find it
-                        recipe_yaml = unifiedIO.read(taskdefRef)
-                        
-                    else: #recipe is defined in the task
-                        recipe_yaml = taskDescr['taskdef']['recipe']
-
-                    recipe = ModuleCollection.fromYAML(recipe_yaml)
-
-                    #load recipe inputs
-                    logging.debug(taskDescr)
-                    for key, url in taskDescr['inputs'].items():
-                        logging.debug('RECIPE: loading %s as %s' % (url, key))
-                        recipe.loadInput(url, key)
-
-                    #print recipe.namespace
-                    recipe.execute()
-
-                    #save results
-                    context = {'data_root' : clusterIO.local_dataroot,
-                               'task_id' : taskDescr['id'].split('~')[0]}
-
-                    #update context with file stub and input directory
-                    try:
-                        principle_input = taskDescr['inputs']['input'] #default input
-                        context['file_stub'] = os.path.splitext(os.path.basename(principle_input))[0]
-                        context['input_dir'] = unifiedIO.dirname(principle_input)
-                    except KeyError:
-                        pass
-
-                    try:
-                        context['output_dir'] = unifiedIO.dirname(taskDescr['output_dir'])
-                    except KeyError:
-                        pass
-
-                    #print taskDescr['inputs']
-                    #print context
-
-                    #abuse outputs as context
-                    outputs = taskDescr.get('outputs', None)
-                    if not outputs is None:
-                        context.update(outputs)
-                    #print context, context['input_dir']
-                    recipe.save(context)
-
-                    self.resultsQueue.put((queueURL, taskDescr, True))
+        except:
+            import traceback
+            traceback.print_exc()
+            tb = traceback.format_exc()
+            logger.exception(tb)
+            return TaskError(taskDescr, tb)
+
+    elif taskDescr['type'] == 'recipe':
+        recipe = None
+        context = {}
+        try:
+            taskdefRef = taskDescr.get('taskdefRef', None)
+            if taskdefRef: #recipe is defined in a file - go find it
+                recipe_yaml = _recipe_cache.get_recipe_text(taskdefRef)
+                
+            else: #recipe is defined in the task
+                recipe_yaml = taskDescr['taskdef']['recipe']
 
-                except Exception:
-                    import traceback
-                    traceback.print_exc()
-                    tb = traceback.format_exc()
-                    logger.exception(tb)
-                    self.resultsQueue.put((queueURL, taskDescr, TaskError(taskDescr, tb)))
+            recipe = _recipe_cache.get(recipe_yaml)
+            
+            if config.get('recipes-profile', False):
+                from PYME.recipes.profiling import RecipeProfiler
+                recipe.profiler = RecipeProfiler()
+
+            #load recipe inputs
+            logging.debug(taskDescr)
+            for key, url in taskDescr['inputs'].items():
+                logging.debug('RECIPE: loading %s as %s' % (url, key))
+                recipe.loadInput(url, key)
+
+            #print recipe.namespace
+            recipe.execute()
+
+            #save results
+            context = {'data_root' : clusterIO.local_dataroot,
+                       'task_id' : taskDescr['id'].split('~')[0]}
+
+            #update context with file stub and input directory
+            try:
+                principle_input = taskDescr['inputs']['input'] #default input
+                context['file_stub'] = os.path.splitext(os.path.basename(principle_input))[0]
+                context['input_dir'] = unifiedIO.dirname(principle_input)
+            except KeyError:
+                pass
+
+            try:
+                context['output_dir'] = unifiedIO.dirname(taskDescr['output_dir'])
+            except KeyError:
+                pass
+
+            #print taskDescr['inputs']
+            #print context
+
+            #abuse outputs as context
+            outputs = taskDescr.get('outputs', None)
+            if not outputs is None:
+                context.update(outputs)
+            #print context, context['input_dir']
+            recipe.save(context)
+            
+            if recipe.profiler is not None:
+                _save_recipe_profile(recipe, context)
 
+            return True
+
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            tb = traceback.format_exc()
+            logger.exception(tb)
+            
+            if (recipe is not None) and (recipe.profiler is not None):
+                _save_recipe_profile(recipe, context)
+                
+            return TaskError(taskDescr, tb)
         
+        finally:
+            if recipe is not None:
+                #don't keep the data for this task (successful or not) alive in the cache
+                recipe.namespace = {}
+                recipe.clear_output_cache()
+
+
+def _save_recipe_profile(recipe, context):
+    """Save a recipe profile next to the task outputs (in the local part of the cluster), see `recipes-profile`"""
+    from PYME.recipes.runRecipe import save_profile
+    
+    context = dict(context)
+    try:
+        context['output_dir'] = os.path.join(clusterIO.local_dataroot, context['output_dir'].lstrip('/'))
+        if not os.path.exists(context['output_dir']):
+            os.makedirs(context['output_dir'])
+    except KeyError:
+        pass
+    
+    save_profile(recipe, context)
+    
+
+def _compute_process_loop(input_queue, results_queue):
+    """
+    Main loop for the compute processes used in pool mode. Runs tasks until we receive None.
+    """
+    while True:
+        taskDescr = input_queue.get()
+        if taskDescr is None:
+            return
+
+        results_queue.put((taskDescr, compute_task(taskDescr)))
+        
+
 def on_SIGHUP(signum, frame):
     raise RuntimeError('Recieved SIGHUP')
     
 
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        if sys.argv[1] == '-p':
+    args = sys.argv[1:]
+    num_compute_processes = config.get('httpworker-num_compute_processes', 1)
+    if '-n' in args:
+        #run in pool mode with the given number of compute processes
+        i = args.index('-n')
+        num_compute_processes = int(args[i + 1])
+        args = args[:i] + args[(i+2):]
+    
+    profile = False
+    if len(args) > 0:
+        if args[0] == '-p':
             profile = True
             from PYME.util import mProfile
             mProfile.profileOn(['taskWorkerHTTP.py', 'remFitBuf.py'])
             
-            if len(sys.argv) == 3:
-                profileOutDir = sys.argv[2]
+            if len(args) == 2:
+                profileOutDir = args[1]
             else:
                 profileOutDir = None
-    else: 
-        profile = False
         
     if not platform.platform().startswith('Windows'):
         signal.signal(signal.SIGHUP, on_SIGHUP)
     
     try:
         #main()
-        tW = taskWorker()
+        tW = taskWorker(num_compute_processes=num_compute_processes)
         tW.loop_forever()
     except KeyboardInterrupt:
         #supress error message here -  we only want to know if something bad happened
@@ -103,6 +103,13 @@ SplitterRatioDatabase : default=None, path to a .json formatted file containing
 VisGUI-console-startup-file : default=None, path to a script to run within the VisGUI interactive console on startup,
     used to populate the console namespace with additional functions. Note that this script should not manipulate the
     pipeline as this cannot be assumed to be loaded when the script runs.
+
+VisGUI-render_cache_mb : default=512, the maximum size (in MB) of the cache of rendered image tiles kept by VisGUI. Tiles
+    are re-used when generating images of the same data at the same settings (e.g. after panning or zooming, or changing
+    the colour channel back).
+
+VisGUI-progressive_rendering : default=True, when generating images in VisGUI, show a quick low resolution preview first
+    and replace it with the full resolution image once that has been rendered in the background.
     
 dh5View-console-startup-file : default=None,   path to a script to run within the dh5View interactive console on startup,
     used to populate the console namespace with additional functions. Note that this script should not manipulate the
@@ -124,14 +131,117 @@ dataserver-filter : default = '', multi-cluster support. Specifies a cluster nam
 
 dataserver-port : default=8080, what port to run the PYMEDataServer on. Overridden by the --port command line option (e.g. if you want to run multiple servers on one machine).
 
+dataserver-num_threads : default=0, if > 0, PYMEDataServer handles connections with a fixed pool of this many threads
+    rather than starting a new thread for each connection. Overridden by the --num-threads command line option.
+
+dataserver-keepalive_timeout : default=30, when using a thread pool (see `dataserver-num_threads`), the time (in s) after
+    which idle keep-alive connections are closed. Idle connections don't occupy a pool thread (only connections with a
+    request waiting are handed to the pool), but this is also used as the socket timeout while serving a request.
+
+dataserver-aggregate_idle_timeout : default=30, how long (in s) PYMEDataServer keeps a text file which is being aggregated
+    into (using `__aggregate_txt`) open after the last append.
+
+dataserver-aggregate_flush_interval : default=1, how often (in s) PYMEDataServer flushes text files which are being
+    aggregated into to disk.
+
+dataserver-aggregate_buffer_size : default=1MB, the write buffer size (in bytes) for text files which are being aggregated
+    into. Appends are written to disk when the buffer fills, or on the next flush.
+
+dataserver-allow_pickle : default=False, whether PYMEDataServer should accept pickled data for h5r results aggregation.
+    Unpickling data received over the network is a security risk, and current clients send results in the binary record
+    stream format defined in `PYME.IO.recordFormat`. Only enable this if you need to support old clients.
+
+dataserver-location_index_lifetime : default=30, how long (in s) PYMEDataServer keeps the names of files in a directory in
+    its location index (used to answer `clusterIO.locate_file` and `clusterIO.cglob` queries) before re-reading the
+    directory. Files written through the server are added to the index immediately, so this only affects how quickly
+    files which are added to the data root by other means show up in globs.
+
+clusterIO-min_free_space_gb : default=1, data servers with less than this much free disk space (in GB) are only chosen
+    for new files (e.g. when spooling) if no other server is available.
+
+httpspooler-max_queue_mb : default=2000, the maximum size (in MB) of frames which the HTTP spooler will hold in memory
+    waiting to be sent to the cluster. If the cluster can't keep up, the acquisition thread blocks once this is reached
+    (see `HTTPSpooler.Spooler.queue_status` and the `onBackPressure` signal) rather than exhausting memory.
+
+httpspooler-batch_interval : default=0.25, the HTTP spooler sizes its batches of frames so that a batch is sent
+    roughly this often (in s) at the current frame rate, which keeps per-request overheads low at high frame rates
+    without adding latency at low frame rates.
+
+httpspooler-num_encode_threads : default=CPU count, the number of threads used to compress frames before sending them
+    to the cluster.
+
+httpspooler-event_flush_interval : default=1, how often (in s) the HTTP spooler appends newly logged acquisition events
+    to the binary event log of the series (`events.bin`, see `PYME.IO.eventFormat`), making them available for
+    analysis while the acquisition is still running.
+
 cluster-listing-no-countdir : default=False, hack to disable the loading of the low-level countdir module which allows rapid
     directory statistics on posix systems. Needed on OSX if `dataserver-root` is a mapped network drive rather than a
     physical disk
 
 h5r-flush_interval : default=1, how often (in s) should we call the .flush() method and write records from the HDF/pytables
     caches to disk when writing h5r files.
+
+h5r-flush_bytes : default=50e6, write and flush h5r files early (i.e. before `h5r-flush_interval` has elapsed) if more than
+    this many bytes are waiting to be written.
+
+h5r-keep_alive_timeout : default=20, how long (in s) to keep an h5r file open after it was last used. Appends to a file
+    which is still open re-use the open file handle (important for results aggregation in PYMEDataServer).
+
+h5r-read_chunk_rows : default=1e6, the number of table rows read at a time by `PYME.IO.tabular.StreamingH5RSource` when
+    reading columns and evaluating range filters. Bounds the temporary memory used when reading large results files.
+
+pzf-num_comp_threads : default=2, the default number of chunks / threads used when encoding or decoding PZF frames with
+    chunked Huffman compression. Can also be changed at runtime with `PYME.IO.PZFFormat.set_num_threads()`, or per call.
+
+rendering-num_threads : default=CPU count, the number of threads used for Gaussian rendering of localizations in VisGUI
+    (see `PYME.LMVis.gaussSplat`).
+
+rendering-incremental_triangulation : default=False, when rendering jittered triangulations with no Monte Carlo
+    subsampling, triangulate the un-jittered points once and locally repair this triangulation after each jitter
+    iteration rather than re-triangulating from scratch. Faster, but the triangulations used are only approximately
+    Delaunay (see `PYME.LMVis.visHelpers.rendJitTriang`).
     
 
+recipes-num_threads : default=1, the number of threads used to execute recipe modules. If > 1, modules which do not
+    depend on each other (i.e. independent branches of a recipe) are executed concurrently.
+
+recipes-memoise_outputs : default=False, keep the outputs of recipe modules (keyed by module parameters and the identity
+    of the module inputs) so that modules don't need to be re-run if the recipe is re-executed with the same
+    parameters and inputs (e.g. after a parameter is changed and then changed back). Note that this keeps up to
+    `PYME.recipes.base.MEMO_ENTRIES_PER_MODULE` sets of outputs for each module alive, in addition to those in the
+    recipe namespace, and can substantially increase memory usage.
+
+recipes-profile : default=False, record the wall time, memory use, I/O, and output sizes of each module (and of input
+    loading and output saving) when running recipes in batch mode or on the cluster, and save a report next to the
+    outputs as `{file_stub}_profile.json` (see `PYME.recipes.profiling`).
+
+recipes-profile_summary : default=True, when profiling recipes (see `recipes-profile`), also save a human readable
+    summary table as `{file_stub}_profile.txt`.
+
+recipes-filter_num_threads : default=CPU count, the number of threads used by filter modules (those derived from
+    `PYME.recipes.base.Filter` or `PYME.recipes.base.ArithmaticFilter`) to filter frames (or channels) in parallel.
+    Only filters which declare themselves thread safe (``thread_safe = True``) are run in parallel, others are run
+    serially.
+
+recipes-filter_memmap_threshold_mb : default=0, if > 0, filter modules write outputs larger than this size (in MB) to a
+    temporary memory-mapped file rather than holding them in memory. The file is created in `recipes-memmap_dir`
+    (default = the system temporary directory) and is deleted once the output is no longer used.
+
+recipes-lazy_filters : default=False, if True, frame-wise filter modules (those derived from `PYME.recipes.base.Filter`
+    or `PYME.recipes.base.ArithmaticFilter` with processFramesIndividually set) don't filter the whole stack when
+    executed, but output an image which computes frames on demand (see `PYME.IO.DataSources.TransformDataSource`).
+    Chains of such filters are then evaluated in a single pass with bounded memory use.
+
+datasource-transform_cache_mb : default=256, the maximum size (in MB) of computed frames each lazily evaluated image
+    keeps in its cache (see `recipes-lazy_filters`).
+
+datasource-cluster_prefetch : default=0, when > 0, series stored on the cluster (`ClusterPZFDataSource`) fetch and decode
+    up to this many frames ahead in the background once they detect that frames are being read sequentially. Makes
+    sequential reads bandwidth rather than latency bound.
+
+datasource-cluster_prefetch_threads : default=4, the number of threads (shared between all cluster data sources) used for
+    prefetching.
+
 nodeserver-chunksize : default=50, how many frames should we give a worker process at once (larger numbers = better
     background cache performance, but potentially not distributing as widely). Should be larger than the number of
     background frames when doing running average / percentile background subtraction [new style distribution].
@@ -144,6 +254,28 @@ nodeserver-worker-get-timeout : default=60, a timeout (in s). When the worker as
 
 nodeserver-num_workers : default= CPU count. Number of workers to launch on an individual node.
 
+nodeserver-worker_pool : default=False, if True, launch a single worker process on each node which fetches tasks and
+    dispatches them to a pool of `nodeserver-num_workers` compute processes, rather than `nodeserver-num_workers`
+    independent workers. Tasks from the same chunk of a series are always sent to the same compute process.
+
+httpworker-num_compute_processes : default=1, the number of compute processes used by a worker when launched without
+    the `-n` command line option. Values > 1 enable the pool mode described above.
+
+httpworker-shared_frame_cache_mb : default=512, the size (in MB) of the shared memory frame cache used by the compute
+    processes of a worker running in pool mode. Set to 0 to disable the shared cache. The cache is inherited by the
+    compute processes when they are forked, so is only used where multiprocessing uses the 'fork' start method (the
+    default on linux) - with other start methods (e.g. on Windows or macOS) each process reads frames independently.
+
+httpworker-handin_interval : default=1.0, how long (in s) a worker should accumulate completed tasks before filing
+    their results and handing them back to the nodeserver. Results for the same output table are concatenated and sent
+    in a single request [new-style distribution].
+
+httpworker-handin_max_tasks : default=500, the maximum number of completed tasks a worker will accumulate before
+    forcing a hand-in, regardless of `httpworker-handin_interval` [new-style distribution].
+
+httpworker-recipe_cache_size : default=10, the number of parsed recipes each worker (compute process) keeps for re-use
+    when running recipe tasks. Recipes are identified by their content [new-style distribution].
+
 ruleserver-retries : default = 3. [new-style task distribution]. The number of times to retry a given task before it is deemed to have failed.
 
 
@@ -28,6 +28,9 @@ from scipy import ndimage
 from PYME.IO.MetaDataHandler import get_camera_roi_origin
 
 class FFBase(object):
+    #does this fit factory provide a vectorised implementation of FromPoints
+    supports_batch_fitting = False
+    
     def __init__(self, data, metadata, fitfcn=None, background=None, noiseSigma=None, roi_offset=[0,0]):
         """Create a fit factory which will operate on image data (data), potentially using voxel sizes etc contained in
         metadata. """
@@ -330,20 +333,27 @@ class FFBase(object):
         
         raise NotImplementedError('This function should be over-ridden in derived class')
         
-    def FromPoints(self, ofd):
-        """Fit at a number of points."""
+    def FromPoints(self, ofd, roiHalfSize=5, axialHalfSize=15):
+        """Fit at a number of points.
         
-        res = np.empty(len(self.ofd), self.FitResultsDType)
-        if 'Analysis.ROISize' in self.metadata.getEntryNames():
-            rs = self.metadata.getEntry('Analysis.ROISize')
-            for i in range(len(self.ofd)):
-                p = self.ofd[i]
-                res[i] = self.FromPoint(p.x, p.y, roiHalfSize=rs)
-        else:
-            for i in range(len(self.ofd)):
-                p = self.ofd[i]
-                res[i] = self.FromPoint(p.x, p.y)
-                
-        return res
+        This default implementation simply calls FromPoint for each point. Derived classes which can fit multiple points
+        more efficiently (e.g. with a vectorised solver) should override this and set `supports_batch_fitting` to True.
+        
+        Parameters
+        ----------
+        ofd : list
+            list of candidate points, each of which should have `x` and `y` attributes
+        roiHalfSize : int
+            half size of the fitting ROI in pixels
+        axialHalfSize : int
+            half size of the ROI along z (in frames / slices), for data with more than one slice. Passed through to
+            `FromPoint`.
+        
+        Returns
+        -------
+        res : ndarray
+            record array of fit results
+        """
+        return np.hstack([self.FromPoint(p.x, p.y, roiHalfSize=roiHalfSize, axialHalfSize=axialHalfSize) for p in ofd])
         
 FitFactory = FFBase
@@ -80,6 +80,9 @@ class BufferManager(object):
         self.bBuffer = None
         self.dataSourceID = None
         
+        #an optional buffers.SharedFrameCache, shared between all the compute processes on a node
+        self.sharedFrameCache = None
+        
     def updateBuffers(self, md, dataSourceModule, bufferLen):
         """Update the various buffers. """
         if dataSourceModule is None:
@@ -91,12 +94,19 @@ class BufferManager(object):
 
         #read the data
         if not self.dataSourceID == md.dataSourceID: #avoid unnecessary opening and closing 
-            self.dBuffer = buffers.dataBuffer(DataSource(md.dataSourceID, md.taskQueue), bufferLen)
+            self.dBuffer = buffers.dataBuffer(DataSource(md.dataSourceID, md.taskQueue), bufferLen,
+                                              sharedCache=self.sharedFrameCache, dataSourceID=md.dataSourceID)
             self.bBuffer = None
         
         #fix our background buffers
         if md.getOrDefault('Analysis.PCTBackground', 0) > 0:
-            if not isinstance(self.bBuffer, buffers.backgroundBufferM):
+            if md.getOrDefault('Analysis.StreamingPCTBackground', False):
+                # use a histogram based percentile estimate, which is much cheaper to update for large background windows
+                if not isinstance(self.bBuffer, buffers.backgroundBufferH):
+                    self.bBuffer = buffers.backgroundBufferH(self.dBuffer, md['Analysis.PCTBackground'])
+                else:
+                    self.bBuffer.pctile = md['Analysis.PCTBackground']
+            elif not isinstance(self.bBuffer, buffers.backgroundBufferM) or isinstance(self.bBuffer, buffers.backgroundBufferH):
                 try:
                     from warpdrive.buffers import Buffer as GPUPercentileBuffer
                     HAVE_GPU_PCT_BUFFER = True
@@ -122,14 +132,32 @@ class BufferManager(object):
                 self.bBuffer = buffers.backgroundBuffer(self.dBuffer)
                 
         self.dataSourceID = md.dataSourceID
+        
+    def getCorrectedBackground(self, md, bgindices):
+        """
+        Get the background for the given frames, corrected for camera offset and flatfield. The background itself is
+        recalculated for every task (background windows usually slide from frame to frame, and the frames available
+        change while a series is being spooled), but the correction maps are cached per series (see
+        `CameraInfoManager.getCorrectionMaps`).
+        """
+        return cameraMaps.correctImage(md, self.bBuffer.getBackground(bgindices))
 
 #instance of our buffer manager
 bufferManager = BufferManager()
 
+#metadata entries which determine the dark and flatfield maps (and the ROI they are cropped to) for a series
+_CORRECTION_MAP_KEYS = ('dataSourceID', 'Camera.DarkMapID', 'Camera.FlatfieldMapID', 'Camera.ADOffset',
+                        'Camera.ROIOriginX', 'Camera.ROIOriginY', 'Camera.ROIPosX', 'Camera.ROIPosY',
+                        'Camera.ROIWidth', 'Camera.ROIHeight', 'Multiview.ActiveViews', 'Multiview.ROISize')
+
 class CameraInfoManager(object):
     """Manages camera information such as dark frames, variance maps, and flatfielding"""
     def __init__(self):
         self._cache = {}
+        
+        #(dark, flatfield) maps for the current series - see getCorrectionMaps
+        self._correction_maps_key = None
+        self._correction_maps = None
 
     def _parseROI(self, md):
         """
@@ -228,6 +256,24 @@ class CameraInfoManager(object):
         else:
             return mp
 
+    def getCorrectionMaps(self, md):
+        """
+        Get the dark and flatfield maps (see `getDarkMap` and `getFlatfieldMap`) used to correct images, caching them
+        for the current series so that correcting each frame / background doesn't need to look them up again.
+        
+        Returns
+        -------
+        dark, flat : ndarray or float
+        """
+        #only compared for equality, so the (multiview) entries don't need to be hashable
+        key = tuple(md.getOrDefault(k, None) for k in _CORRECTION_MAP_KEYS)
+        
+        if not key == self._correction_maps_key:
+            self._correction_maps = (self.getDarkMap(md), self.getFlatfieldMap(md))
+            self._correction_maps_key = key
+            
+        return self._correction_maps
+
     def correctImage(self, md, img):
         """
         Parameters
@@ -242,10 +288,13 @@ class CameraInfoManager(object):
         corrected: ndarray
             ADOffset and flatfield corrected image [ADU]
         """
-        dk = self.getDarkMap(md)
-        flat = self.getFlatfieldMap(md)
+        dk, flat = self.getCorrectionMaps(md)
 
-        return (img.astype('f')-dk)*flat
+        #correct in place on our (float) copy to avoid temporaries
+        corrected = img.astype('f')
+        corrected -= dk
+        corrected *= flat
+        return corrected
 
 cameraMaps = CameraInfoManager()
 
@@ -439,7 +488,7 @@ class fitTask(taskDef.Task):
         self.sigma = self.calcSigma(md, self.data)
         if len(self.bgindices) != 0:
             # calculate the background for this frame and correct this for camera characteristics
-            self.bg = cameraMaps.correctImage(md, bufferManager.bBuffer.getBackground(self.bgindices)).reshape(self.data.shape)
+            self.bg = bufferManager.getCorrectedBackground(md, self.bgindices).reshape(self.data.shape)
 
         #if logger.isEnabledFor(logging.DEBUG):
         #    logger.debug('data_mean: %3.2f, bg: %3.2f, sigma: %3.2f' % (self.data.mean(), self.sigma.mean(), self.bg.mean()))
@@ -523,6 +572,9 @@ class fitTask(taskDef.Task):
         #perform fit for each point that we detected
         if 'FromPoints' in dir(self.fitMod):
             self.res = self.fitMod.FromPoints(self.ofd)
+        elif getattr(fitFac, 'supports_batch_fitting', False) and md.getOrDefault('Analysis.BatchFit', False):
+            #fit all candidates in the frame at once using the fit factory's vectorised solver
+            self.res = fitFac.FromPoints(self.ofd, roiHalfSize=md.getOrDefault('Analysis.ROISize', 5))
         elif 'FitResultsDType' in dir(self.fitMod): #legacy fit modules
             self.res = numpy.empty(len(self.ofd), self.fitMod.FitResultsDType)
             if 'Analysis.ROISize' in md.getEntryNames():
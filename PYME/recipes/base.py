@@ -24,10 +24,19 @@ from PYME.recipes.traits import HasTraits, Float, List, Bool, Int, CStr, Enum, F
 
 from PYME.IO.image import ImageStack
 import numpy as np
+import threading
+import collections
+from PYME import config
 
 import logging
 logger = logging.getLogger(__name__)
 
+#the number of (parameter) versions of each module's outputs to keep when memoising module outputs
+MEMO_ENTRIES_PER_MODULE = 2
+
+#the maximum number of frames read and filtered in one go by (frame-wise) filter modules
+FILTER_MAX_CHUNK_SIZE = 50
+
 all_modules = {}
 _legacy_modules = {}
 module_names = {}
@@ -360,6 +369,16 @@ class ModuleCollection(HasTraits):
         
         self.namespace = {}
         
+        #memoised module outputs, see _run_module
+        self._output_cache = {}
+        self._output_cache_lock = threading.Lock()
+        
+        #number of threads to execute independent modules on. If None, use the `recipes-num_threads` config option
+        self.num_threads = None
+        
+        #an optional PYME.recipes.profiling.RecipeProfiler instance to record module execution times etc ...
+        self.profiler = None
+        
         # we open hdf files and don't necessarily read their contents into memory - these need to be closed when we
         # either delete the recipe, or clear the namespace
         self._open_input_files = []
@@ -367,12 +386,32 @@ class ModuleCollection(HasTraits):
         self.recipe_changed = dispatch.Signal()
         self.recipe_executed = dispatch.Signal()
         
+    def __getstate__(self):
+        #don't pickle memoised outputs (or the lock) - e.g. when sending recipes to worker processes
+        state = HasTraits.__getstate__(self)
+        state.pop('_output_cache', None)
+        state.pop('_output_cache_lock', None)
+        state.pop('profiler', None)
+        return state
+    
+    def __setstate__(self, state):
+        HasTraits.__setstate__(self, state)
+        self._output_cache = {}
+        self._output_cache_lock = threading.Lock()
+        self.profiler = None
+        
     def invalidate_data(self):
         if self.execute_on_invalidation:
             self.execute()
             
     def clear(self):
         self.namespace.clear()
+        self.clear_output_cache()
+        
+    def clear_output_cache(self):
+        """Discard all memoised module outputs (see `_run_module`)"""
+        with self._output_cache_lock:
+            self._output_cache.clear()
         
     def new_output_name(self, stub):
         count = len([k.startswith(stub) for k in self.namespace.keys()])
@@ -494,20 +533,171 @@ class ModuleCollection(HasTraits):
         self.namespace.update(kwargs)
         
         exec_order = self.resolveDependencies()
+        
+        num_threads = self.num_threads
+        if num_threads is None:
+            num_threads = config.get('recipes-num_threads', 1)
 
-        for m in exec_order:
-            if isinstance(m, ModuleBase) and not m.outputs_in_namespace(self.namespace):
-                try:
-                    m.execute(self.namespace)
-                except:
-                    logger.exception("Error in recipe module: %s" % m)
-                    raise
+        if num_threads > 1:
+            self._execute_parallel(exec_order, num_threads)
+        else:
+            for m in exec_order:
+                if isinstance(m, ModuleBase) and not m.outputs_in_namespace(self.namespace):
+                    self._run_module(m)
         
         self.recipe_executed.send_robust(self)
         
         if 'output' in self.namespace.keys():
             return self.namespace['output']
             
+    def _module_key(self, module):
+        """
+        A key identifying a module and its parameters (including the names of its inputs and outputs). Used for
+        memoising module outputs.
+        """
+        params = sorted([(k, repr(v)) for k, v in module.get().items() if not k.startswith('_')])
+        return (module.__class__, repr(params))
+    
+    def _run_module(self, module):
+        """Execute a module, recording a profile if we have a profiler (see `PYME.recipes.profiling`)"""
+        if self.profiler is None:
+            self._run_module_memoised(module)
+        else:
+            from PYME.recipes.profiling import object_size
+            
+            with self.profiler.profile('module', module.__class__.__name__, inputs=sorted(module.inputs),
+                                       outputs=sorted(module.outputs)) as record:
+                record['memoised'] = self._run_module_memoised(module)
+                
+            sizes = [object_size(self.namespace.get(k, None)) for k in module.outputs]
+            record['output_bytes'] = sum([s for s in sizes if s is not None])
+    
+    def _run_module_memoised(self, module):
+        """
+        Execute a module, re-using its previous outputs if it has already been run with the same parameters on the same
+        input objects.
+        
+        Outputs are memoised using the module parameters and the identities of the input objects (we keep references to
+        the inputs so that their ids remain valid). As modules are functional, this means that when a module parameter
+        changes (pruning the outputs of that module and everything downstream of it from the namespace) only the
+        modules whose parameters or inputs have actually changed are re-run. As keeping old outputs around can use a
+        lot of memory, memoisation is opt-in, and needs to be enabled with the `recipes-memoise_outputs` config option.
+        
+        Modules without any inputs (e.g. those which load data from disk) are always re-run, as their output
+        can depend on things other than their parameters.
+        
+        Returns True if memoised outputs were used.
+        """
+        inputs = sorted(module.inputs)
+        memoise = (len(inputs) > 0) and config.get('recipes-memoise_outputs', False)
+        
+        if memoise:
+            try:
+                input_objects = [self.namespace[k] for k in inputs]
+            except KeyError:
+                #missing inputs - let the module raise an error
+                memoise = False
+        
+        if memoise:
+            key = self._module_key(module)
+            with self._output_cache_lock:
+                cached = self._output_cache.get(id(module), collections.OrderedDict()).get(key, None)
+                
+            if (cached is not None) and all([a is b for a, b in zip(cached[0], input_objects)]):
+                logger.debug('Using memoised outputs for recipe module: %s' % module)
+                self.namespace.update(cached[1])
+                return True
+        
+        try:
+            module.execute(self.namespace)
+        except:
+            logger.exception("Error in recipe module: %s" % module)
+            raise
+        
+        if memoise:
+            outputs = {k: self.namespace[k] for k in module.outputs if k in self.namespace}
+            
+            with self._output_cache_lock:
+                module_cache = self._output_cache.setdefault(id(module), collections.OrderedDict())
+                module_cache.pop(key, None)
+                module_cache[key] = (input_objects, outputs)
+                
+                while len(module_cache) > MEMO_ENTRIES_PER_MODULE:
+                    module_cache.popitem(last=False)
+                    
+                #forget about modules which have been removed from the recipe
+                ids = set([id(m) for m in self.modules])
+                for k in [k for k in self._output_cache.keys() if not k in ids]:
+                    self._output_cache.pop(k)
+                    
+        return False
+    
+    def _execute_parallel(self, exec_order, num_threads):
+        """
+        Execute modules on a pool of threads, starting each module as soon as the modules producing its inputs have
+        finished (so that independent branches of the recipe run concurrently).
+        
+        Threads rather than processes are used as the namespace is shared (and its contents are not necessarily
+        picklable). Most of the heavy lifting in modules is done in numpy / scipy / C extensions which release the GIL.
+        """
+        from multiprocessing.pool import ThreadPool
+        from six.moves import queue
+        
+        to_run = [m for m in exec_order if isinstance(m, ModuleBase) and not m.outputs_in_namespace(self.namespace)]
+        
+        if len(to_run) == 0:
+            return
+        
+        #find which of the modules we are running produce the inputs to each module
+        producers = {}
+        for m in to_run:
+            for op in m.outputs:
+                producers[op] = m
+                
+        waiting_on = {m: set([producers[ip] for ip in m.inputs if ip in producers]) for m in to_run}
+        
+        finished = queue.Queue()
+        
+        def _run(m):
+            try:
+                self._run_module(m)
+                finished.put((m, None))
+            except Exception as e:
+                finished.put((m, e))
+        
+        pool = ThreadPool(min(num_threads, len(to_run)))
+        try:
+            pending = list(to_run)
+            n_running = 0
+            error = None
+            
+            while (len(pending) > 0 and error is None) or n_running > 0:
+                if error is None:
+                    ready = [m for m in pending if len(waiting_on[m]) == 0]
+                    for m in ready:
+                        pending.remove(m)
+                        pool.apply_async(_run, (m,))
+                        n_running += 1
+                    
+                    if n_running == 0:
+                        #shouldn't happen, as the dependency resolution should have caught any cycles
+                        raise RuntimeError('Could not resolve recipe dependencies')
+                
+                m, e = finished.get()
+                n_running -= 1
+                
+                if e is not None:
+                    #wait for any running modules to complete, then re-raise
+                    error = error or e
+                
+                for other in pending:
+                    waiting_on[other].discard(m)
+            
+            if error is not None:
+                raise error
+        finally:
+            pool.close()
+            
     @classmethod
     def fromMD(cls, md):
         c = cls()
@@ -695,7 +885,11 @@ class ModuleCollection(HasTraits):
         """
         for mod in self.modules:
             if isinstance(mod, OutputModule):
-                mod.save(self.namespace, context)
+                if self.profiler is None:
+                    mod.save(self.namespace, context)
+                else:
+                    with self.profiler.profile('save', mod.__class__.__name__, inputs=sorted(mod.inputs)):
+                        mod.save(self.namespace, context)
                 
     def gather_outputs(self, context={}):
         """
@@ -725,6 +919,13 @@ class ModuleCollection(HasTraits):
         Currently only handles images (anything you can open in dh5view). TODO -
         extend to other types.
         """
+        if self.profiler is None:
+            self._load_input(filename, key)
+        else:
+            with self.profiler.profile('load', key, filename=filename):
+                self._load_input(filename, key)
+    
+    def _load_input(self, filename, key='input'):
         #modify this to allow for different file types - currently only supports images
         from PYME.IO import unifiedIO
         import os
@@ -807,6 +1008,124 @@ class ModuleCollection(HasTraits):
         
 
         
+_filter_pool = None
+_filter_pool_size = 1
+_filter_pool_lock = threading.Lock()
+
+#data sources (e.g. HDF) are not necessarily thread safe - serialise reads from filter worker threads
+_filter_read_lock = threading.Lock()
+
+def _get_filter_pool():
+    """A (lazily created) pool of threads used to evaluate filters. See `recipes-filter_num_threads`"""
+    global _filter_pool, _filter_pool_size
+    from multiprocessing.pool import ThreadPool
+    import multiprocessing
+    
+    with _filter_pool_lock:
+        if _filter_pool is None:
+            _filter_pool_size = int(config.get('recipes-filter_num_threads', multiprocessing.cpu_count()))
+            _filter_pool = ThreadPool(_filter_pool_size)
+            
+        return _filter_pool
+    
+def _allocate_output(shape, dtype):
+    """
+    Allocate an array to hold filter output. Outputs which are larger than the `recipes-filter_memmap_threshold_mb`
+    config option are backed by a temporary file (which is deleted once the array is no longer referenced) rather than
+    memory.
+    """
+    threshold = config.get('recipes-filter_memmap_threshold_mb', 0)
+    
+    if (threshold > 0) and (np.prod(shape)*np.dtype(dtype).itemsize > threshold*1e6):
+        import tempfile
+        return np.memmap(tempfile.TemporaryFile(dir=config.get('recipes-memmap_dir', None)), dtype=dtype, mode='w+',
+                         shape=tuple(shape))
+    else:
+        return np.empty(shape, dtype)
+    
+def _apply_framewise(func, images, chanNum, parallel=False):
+    """
+    Apply a function frame by frame to one channel of one or more images.
+    
+    Frames are read (in chunks) and filtered (on a pool of threads if `parallel` is True), and the results written
+    into a pre-allocated (potentially memory-mapped, see `_allocate_output`) output array.
+    
+    Parameters
+    ----------
+    func : callable
+        function to apply, called as `func(frames, frame_num)` where `frames` is a list with a 2D (float) frame from
+        each image.
+    images : list of ImageStack
+        the input images (all the same size)
+    chanNum : int
+        the channel to filter
+    parallel : bool
+        filter chunks of frames concurrently on the filter thread pool. Only safe if `func` is thread safe.
+        
+    Returns
+    -------
+    ndarray
+        3D array with the filter result for each frame concatenated along the 3rd axis
+
+    """
+    n_frames = images[0].data.shape[2]
+    
+    def _read(i0, i1):
+        with _filter_read_lock:
+            blocks = [np.asarray(im.data[:, :, i0:i1, chanNum]) for im in images]
+        
+        return [b.reshape(b.shape[0], b.shape[1], -1) for b in blocks]
+    
+    #filter the first frame to find the output shape and dtype
+    res = np.atleast_3d(func([b[:, :, 0].squeeze().astype('f') for b in _read(0, 1)], 0))
+    depth = res.shape[2]
+    
+    out = _allocate_output(res.shape[:2] + (n_frames*depth,), res.dtype)
+    out[:, :, :depth] = res
+    
+    def _filter_chunk(bounds):
+        i0, i1 = bounds
+        blocks = _read(i0, i1)
+        for j, i in enumerate(range(i0, i1)):
+            out[:, :, (i*depth):((i + 1)*depth)] = np.atleast_3d(func([b[:, :, j].squeeze().astype('f') for b in blocks], i))
+    
+    if parallel:
+        pool = _get_filter_pool()
+        chunk_size = int(max(min(np.ceil((n_frames - 1)/(4.0*_filter_pool_size)), FILTER_MAX_CHUNK_SIZE), 1))
+    else:
+        pool = None
+        chunk_size = FILTER_MAX_CHUNK_SIZE
+        
+    chunks = [(i, min(i + chunk_size, n_frames)) for i in range(1, n_frames, chunk_size)]
+    
+    if (pool is not None) and len(chunks) > 1:
+        pool.map(_filter_chunk, chunks)
+    else:
+        for c in chunks:
+            _filter_chunk(c)
+    
+    return out
+
+def _frozen_copy(module):
+    """
+    A copy of a module (for lazy evaluation) which won't see subsequent changes to the module's parameters. Parameter
+    changes prune the outputs of a module from the recipe namespace, but lazily evaluated outputs could still be
+    referenced elsewhere (e.g. displayed).
+    """
+    return module.clone_traits()
+
+def _lazy_filter(transform, images):
+    """Wrap images in a data source which applies transform frame by frame, on demand"""
+    from PYME.IO.DataSources import TransformDataSource
+    return TransformDataSource.DataSource([im.data for im in images], transform)
+
+def _map_channels(func, n_chans, parallel=False):
+    """Apply func to each channel (in parallel if `parallel` is True)"""
+    if parallel and n_chans > 1:
+        return _get_filter_pool().map(func, range(n_chans))
+    else:
+        return [func(c) for c in range(n_chans)]
+
 class Filter(ModuleBase):
     """Module with one image input and one image output"""
     inputName = Input('input')
@@ -814,16 +1133,33 @@ class Filter(ModuleBase):
     
     processFramesIndividually = Bool(True)
     
+    #set to True in derived classes whose `applyFilter` is thread safe (i.e. does not modify the module or lazily load
+    #models etc ...) to filter frames / channels in parallel. See `recipes-filter_num_threads`.
+    thread_safe = False
+    
     def filter(self, image):
-        #from PYME.util.shmarray import shmarray
-        #import multiprocessing
+        """
+        Filter an image, calling `applyFilter` on each frame (or on the whole stack for each channel if
+        processFramesIndividually is False). Frames / channels are filtered in parallel if the class declares itself
+        `thread_safe`, and serially otherwise.
         
-        if self.processFramesIndividually:
-            filt_ims = []
-            for chanNum in range(image.data.shape[3]):
-                filt_ims.append(np.concatenate([np.atleast_3d(self.applyFilter(image.data[:,:,i,chanNum].squeeze().astype('f'), chanNum, i, image)) for i in range(image.data.shape[2])], 2))
+        If the `recipes-lazy_filters` config option is set, frame-wise filters return an image which computes frames
+        on demand (see `PYME.IO.DataSources.TransformDataSource`) rather than filtering the whole stack up front.
+        """
+        if self.processFramesIndividually and config.get('recipes-lazy_filters', False):
+            mod = _frozen_copy(self)
+            filt_ims = _lazy_filter(lambda frames, z, c: mod.applyFilter(frames[0].astype('f'), c, z, image), [image, ])
+        elif self.processFramesIndividually:
+            filt_ims = [_apply_framewise(lambda frames, i: self.applyFilter(frames[0], chanNum, i, image), [image, ], chanNum,
+                                         parallel=self.thread_safe)
+                        for chanNum in range(image.data.shape[3])]
         else:
-            filt_ims = [np.atleast_3d(self.applyFilter(image.data[:,:,:,chanNum].squeeze().astype('f'), chanNum, 0, image)) for chanNum in range(image.data.shape[3])]
+            def _filter_channel(chanNum):
+                with _filter_read_lock:
+                    data = image.data[:,:,:,chanNum].squeeze().astype('f')
+                return np.atleast_3d(self.applyFilter(data, chanNum, 0, image))
+            
+            filt_ims = _map_channels(_filter_channel, image.data.shape[3], parallel=self.thread_safe)
             
         im = ImageStack(filt_ims, titleStub = self.outputName)
         im.mdh.copyEntriesFrom(image.mdh)
@@ -876,22 +1212,27 @@ class ArithmaticFilter(ModuleBase):
     
     processFramesIndividually = Bool(False)
     
+    #see `Filter.thread_safe`
+    thread_safe = False
+    
     def filter(self, image0, image1):
-        if self.processFramesIndividually:
-            filt_ims = []
-            for chanNum in range(image0.data.shape[3]):
-                out = []
-                for i in range(image0.data.shape[2]):
-                    d0 = image0.data[:,:,i,chanNum].squeeze().astype('f')
-                    d1 = image1.data[:,:,i,chanNum].squeeze().astype('f')
-                    out.append(np.atleast_3d(self.applyFilter(d0, d1, chanNum, i, image0)))
-                filt_ims.append(np.concatenate(out, 2))
+        """As for `Filter.filter`, but with two input images"""
+        if self.processFramesIndividually and config.get('recipes-lazy_filters', False):
+            mod = _frozen_copy(self)
+            filt_ims = _lazy_filter(lambda frames, z, c: mod.applyFilter(frames[0].astype('f'), frames[1].astype('f'),
+                                                                         c, z, image0), [image0, image1])
+        elif self.processFramesIndividually:
+            filt_ims = [_apply_framewise(lambda frames, i: self.applyFilter(frames[0], frames[1], chanNum, i, image0),
+                                         [image0, image1], chanNum, parallel=self.thread_safe)
+                        for chanNum in range(image0.data.shape[3])]
         else:
-            filt_ims = []
-            for chanNum in range(image0.data.shape[3]):
-                d0 = image0.data[:,:,:,chanNum].squeeze().astype('f')
-                d1 = image1.data[:,:,:,chanNum].squeeze().astype('f')
-                filt_ims.append(np.atleast_3d(self.applyFilter(d0, d1, chanNum, 0, image0)))
+            def _filter_channel(chanNum):
+                with _filter_read_lock:
+                    d0 = image0.data[:,:,:,chanNum].squeeze().astype('f')
+                    d1 = image1.data[:,:,:,chanNum].squeeze().astype('f')
+                return np.atleast_3d(self.applyFilter(d0, d1, chanNum, 0, image0))
+            
+            filt_ims = _map_channels(_filter_channel, image0.data.shape[3], parallel=self.thread_safe)
             
         im = ImageStack(filt_ims, titleStub = self.outputName)
         im.mdh.copyEntriesFrom(image0.mdh)
@@ -975,6 +1316,7 @@ class JoinChannels(ModuleBase):
 @register_module('Add')    
 class Add(ArithmaticFilter):
     """Add two images"""
+    thread_safe = True
     
     def applyFilter(self, data0, data1, chanNum, i, image0):
         
@@ -983,6 +1325,7 @@ class Add(ArithmaticFilter):
 @register_module('Subtract')    
 class Subtract(ArithmaticFilter):
     """Subtract two images"""
+    thread_safe = True
     
     def applyFilter(self, data0, data1, chanNum, i, image0):
         
@@ -991,6 +1334,7 @@ class Subtract(ArithmaticFilter):
 @register_module('Multiply')    
 class Multiply(ArithmaticFilter):
     """Multiply two images"""
+    thread_safe = True
     
     def applyFilter(self, data0, data1, chanNum, i, image0):
         
@@ -999,6 +1343,7 @@ class Multiply(ArithmaticFilter):
 @register_module('Divide')    
 class Divide(ArithmaticFilter):
     """Divide two images"""
+    thread_safe = True
     
     def applyFilter(self, data0, data1, chanNum, i, image0):
         
@@ -1007,6 +1352,7 @@ class Divide(ArithmaticFilter):
 @register_module('Pow')
 class Pow(Filter):
     "Raise an image to a given power (can be fractional for sqrt)"
+    thread_safe = True
     power = Float(2)
     
     def applyFilter(self, data, chanNum, i, image0):
@@ -1015,6 +1361,7 @@ class Pow(Filter):
 @register_module('Scale')    
 class Scale(Filter):
     """Scale an image intensities by a constant"""
+    thread_safe = True
     
     scale = Float(1)
     
@@ -1025,6 +1372,7 @@ class Scale(Filter):
 @register_module('Normalize')    
 class Normalize(Filter):
     """Normalize an image so that the maximum is 1"""
+    thread_safe = True
     
     #scale = Float(1)
     
@@ -1035,6 +1383,7 @@ class Normalize(Filter):
 @register_module('NormalizeMean')    
 class NormalizeMean(Filter):
     """Normalize an image so that the mean is 1"""
+    thread_safe = True
     
     offset = Float(0)
     
@@ -1052,6 +1401,7 @@ class Invert(Filter):
     This is implemented as :math:`B = (1-A)`. As such the results only really make sense for binary images / masks and
     for images which have been normalized such that the maximum value is 1.
     """
+    thread_safe = True
     
     #scale = Float(1)
     
@@ -1068,6 +1418,7 @@ class BinaryOr(ArithmaticFilter):
 
     This is actually implemented as :math:`(A + B) > .5`
     """
+    thread_safe = True
     
     def applyFilter(self, data0, data1, chanNum, i, image0):
         
@@ -1077,6 +1428,7 @@ class BinaryOr(ArithmaticFilter):
 @register_module('LogicalAnd')
 class LogicalAnd(ArithmaticFilter):
     """Perform a logical AND on images"""
+    thread_safe = True
 
     def applyFilter(self, data0, data1, chanNum, i, image0):
         return np.logical_and(data0, data1)
@@ -1099,6 +1451,7 @@ class IsClose(ArithmaticFilter):
     from numpy docs, tolerances are combined as: absolute(a - b) <= (atol + rtol * absolute(b))
 
     """
+    thread_safe = True
     abs_tolerance = Float(1e-8)
     rel_tolerance = Float(1e-5)
     def applyFilter(self, data0, data1, chanNum, i, image0):
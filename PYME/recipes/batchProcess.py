@@ -11,26 +11,172 @@ import os
 import glob
 from argparse import ArgumentParser
 import traceback
+import json
+import time
+import numpy as np
 
 import multiprocessing
 
+import logging
+logger = logging.getLogger(__name__)
+
 NUM_PROCS = multiprocessing.cpu_count()
 
-def runRec(args):
-    #print args
+#name of the file (in the output directory) in which we record which inputs have been processed
+CHECKPOINT_FILENAME = '.bake_checkpoint.jsonl'
+
+#the maximum number of inputs we hand to a worker process in one go
+MAX_CHUNK_SIZE = 10
+
+def _file_hash(filename):
+    import hashlib
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    
+    return h.hexdigest()
+
+def _output_signature(filename):
+    """Size, modification time, and hash of an output file. The hash is only re-checked if the size or mtime change."""
+    return [os.path.getsize(filename), os.path.getmtime(filename), _file_hash(filename)]
+
+def _output_unchanged(filename, signature):
+    if not os.path.isfile(filename):
+        return False
+    
+    if not isinstance(signature, list):
+        #checkpoint from an older version which only recorded the hash
+        return _file_hash(filename) == signature
+    
+    size, mtime, h = signature
+    if not os.path.getsize(filename) == size:
+        return False
+    
+    if os.path.getmtime(filename) == mtime:
+        #assume the file is unchanged without reading it
+        return True
+    
+    #touched, but not necessarily modified
+    return _file_hash(filename) == h
+
+def _input_signature(in_d):
+    """Identify the input files by name, size, and modification time, so we notice if they change between runs"""
+    sig = {}
+    for k, fn in in_d.items():
+        try:
+            sig[k] = [fn, os.path.getsize(fn), os.path.getmtime(fn)]
+        except (OSError, TypeError):
+            #not a local file (e.g. a cluster URI)
+            sig[k] = [fn, None, None]
+    
+    return sig
+
+def _recipe_hash(recipe):
+    """Identify the recipe (modules and parameters), so that we don't re-use results from a different recipe"""
+    import hashlib
+    return hashlib.sha1(recipe.toYAML().encode('utf8')).hexdigest()
+
+def _output_files(recipe, out_d, context):
+    """The files we expect a task to produce - from both old-style outputs and output modules"""
+    from PYME.recipes.base import OutputModule
+    
+    files = list(out_d.values())
+    for m in recipe.modules:
+        if isinstance(m, OutputModule):
+            try:
+                files.append(m._schemafy_filename(m.filePattern.format(**context)))
+            except (KeyError, IndexError, RuntimeError):
+                #pattern uses variables which are only known when saving (e.g. ReportForEachOutput), or not a file
+                pass
+    
+    return files
+
+def _run_task(task):
+    """
+    Run a single task, returning a record of what was done (see `bake`). Failures are logged and recorded rather than
+    raised so that the remaining inputs are still processed.
+    """
+    recipe, in_d, out_d, cntxt = task
+    t = time.time()
+    record = {'inputs': _input_signature(in_d), 'recipe': _recipe_hash(recipe)}
+    
     try:
         import matplotlib.pyplot as plt
-    
+        
         old_backend = plt.get_backend()
         plt.switch_backend('SVG')
-        
-        runRecipe.runRecipe(*args)
-        
-        plt.switch_backend(old_backend)
-    except:
+        try:
+            runRecipe.runRecipe(recipe, in_d, out_d, cntxt)
+        finally:
+            plt.switch_backend(old_backend)
+            #don't hold on to this input (or anything derived from it) while we process the next
+            recipe.clear()
+            
+        record['outputs'] = {fn: _output_signature(fn) for fn in _output_files(recipe, out_d, cntxt) if os.path.isfile(fn)}
+        record['status'] = 'done'
+    except Exception:
         traceback.print_exc()
+        record['status'] = 'failed'
+        record['error'] = traceback.format_exc()
+    
+    record['duration'] = time.time() - t
+    return record
+
+def _run_chunk(tasks):
+    return [_run_task(task) for task in tasks]
+
+def _guided_chunks(tasks, num_procs):
+    """
+    Split tasks into chunks whose size decreases as we go (guided scheduling). Large chunks at the start reduce
+    overhead, small chunks at the end keep all the workers busy until we are done.
+    """
+    i = 0
+    while i < len(tasks):
+        n = int(min(max(np.ceil((len(tasks) - i)/(2.0*num_procs)), 1), MAX_CHUNK_SIZE))
+        yield tasks[i:(i + n)]
+        i += n
+
+def _task_key(in_d, recipe_hash):
+    return json.dumps([recipe_hash, sorted(in_d.items())])
+
+def _load_checkpoint(checkpoint_file):
+    """Load records of completed tasks, keyed by input"""
+    done = {}
+    try:
+        with open(checkpoint_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    #partially written line (e.g. if we were killed)
+                    continue
+                
+                if record.get('status', None) == 'done':
+                    done[_task_key({k: v[0] for k, v in record['inputs'].items()}, record.get('recipe', None))] = record
+    except IOError:
+        pass
+    
+    return done
+
+def _is_done(record, in_d, recipe_hash):
+    """
+    Check that a task recorded as complete used the same recipe and inputs, and that its outputs are still there,
+    unchanged
+    """
+    if record is None or not record.get('recipe', None) == recipe_hash:
+        return False
+    
+    if not record['inputs'] == json.loads(json.dumps(_input_signature(in_d))):
+        return False
+    
+    for fn, sig in record['outputs'].items():
+        if not _output_unchanged(fn, sig):
+            return False
+        
+    return True
     
-def bake(recipe, inputGlobs, output_dir, num_procs = NUM_PROCS):
+def bake(recipe, inputGlobs, output_dir, num_procs = NUM_PROCS, resume=True, progress_callback=None):
     """Run a given recipe over using multiple proceses.
     
     Arguments:
@@ -41,7 +187,19 @@ def bake(recipe, inputGlobs, output_dir, num_procs = NUM_PROCS):
                     input.
       output_dir:   The directory to save the output in
       num_procs:    The number of worker processes to launch (defaults to the number of CPUs)
+      resume:       Skip inputs which were successfully processed by a previous run of the same recipe (and whose
+                    outputs are unchanged).
+                    Completed inputs are recorded, along with the size, mtime, and hash of their outputs, in a
+                    checkpoint file in the output directory. Outputs are only re-hashed if their size or mtime change.
+      progress_callback: A function which is called as `progress_callback(n_done, n_total, eta)` each time some inputs
+                    have been processed.
+                    
+    Returns:
+    --------
+      A dictionary with lists of the 'completed', 'skipped', and 'failed' inputs.
       
+    Inputs are handed to worker processes in dynamically sized chunks, with each worker holding only one input (and
+    its derived data) in memory at a time.
     """
     
     #check that we've supplied the right number of images for each named input/channel
@@ -64,14 +222,74 @@ def bake(recipe, inputGlobs, output_dir, num_procs = NUM_PROCS):
         cntxt = {'output_dir' : output_dir, 'file_stub': file_stub}
 
         taskParams.append((recipe, in_d, out_d, cntxt))
-
+        
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+        
+    checkpoint_file = os.path.join(output_dir, CHECKPOINT_FILENAME)
+    result = {'completed': [], 'skipped': [], 'failed': []}
+    
+    if resume:
+        done = _load_checkpoint(checkpoint_file)
+        recipe_hash = _recipe_hash(recipe)
+        
+        todo = []
+        for task in taskParams:
+            if _is_done(done.get(_task_key(task[1], recipe_hash), None), task[1], recipe_hash):
+                result['skipped'].append(task[1])
+            else:
+                todo.append(task)
+        
+        if len(result['skipped']) > 0:
+            logger.info('Skipping %d inputs which have already been processed' % len(result['skipped']))
+            
+        taskParams = todo
+    
+    n_tasks = len(taskParams)
+    if n_tasks == 0:
+        return result
+    
+    chunks = list(_guided_chunks(taskParams, num_procs))
+    
     if num_procs == 1:
-        # map(runRec, taskParams)  # map now returns iterator, which means this never runs unless we convert to list
-        [runRec(task) for task in taskParams]  # skip the map and just make the list we need anyway
+        results = (_run_chunk(chunk) for chunk in chunks)
     else:
         pool = multiprocessing.Pool(num_procs)
+        results = pool.imap_unordered(_run_chunk, chunks)
+        
+    t_start = time.time()
+    n_done = 0
+    try:
+        with open(checkpoint_file, 'a') as cf:
+            for records in results:
+                for record in records:
+                    cf.write(json.dumps(record) + '\n')
+                    
+                    in_d = {k: v[0] for k, v in record['inputs'].items()}
+                    if record['status'] == 'done':
+                        result['completed'].append(in_d)
+                    else:
+                        result['failed'].append(in_d)
+                
+                #make sure progress is recorded even if we are killed
+                cf.flush()
+                
+                n_done += len(records)
+                elapsed = time.time() - t_start
+                eta = elapsed*(n_tasks - n_done)/n_done
+                logger.info('Processed %d of %d inputs (%3.2f inputs/s, %d failed), ETA: %ds' % (n_done, n_tasks,
+                                                                    n_done/elapsed, len(result['failed']), eta))
+                if progress_callback:
+                    progress_callback(n_done, n_tasks, eta)
+    finally:
+        if not num_procs == 1:
+            pool.close()
+            pool.join()
+            
+    if len(result['failed']) > 0:
+        logger.error('Failed to process %d inputs: %s' % (len(result['failed']), result['failed']))
     
-        pool.map(runRec, taskParams)
+    return result
 
 def bake_recipe(recipe_filename, inputGlobs, output_dir, *args, **kwargs):
     with open(recipe_filename) as f:
@@ -94,7 +312,9 @@ def main():
     ap = ArgumentParser()#usage = 'usage: %(prog)s [options] recipe.yaml')
     ap.add_argument('recipe')
     ap.add_argument('output_dir')
-    ap.add_argument('-n', '--num-processes', default=NUM_PROCS)
+    ap.add_argument('-n', '--num-processes', default=NUM_PROCS, type=int)
+    ap.add_argument('--no-resume', dest='resume', action='store_false', default=True,
+                    help='re-process inputs which were successfully processed by a previous run')
     args, remainder = ap.parse_known_args()
     
     #load the recipe
@@ -105,6 +325,7 @@ def main():
 
     output_dir = args.output_dir
     num_procs = args.num_processes
+    args_resume = args.resume
     
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -119,7 +340,7 @@ def main():
     
     inputGlobs = {k: glob.glob(getattr(args, k)) for k in recipe.inputs}
     
-    bake(recipe, inputGlobs, output_dir, num_procs)
+    bake(recipe, inputGlobs, output_dir, num_procs, resume=args_resume)
         
         
 if __name__ == '__main__':
@@ -39,6 +39,8 @@ class GaussianFilter(Filter):
     def sigmas(self):
         return [self.sigmaX, self.sigmaY, self.sigmaZ]
     
+    thread_safe = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         return ndimage.gaussian_filter(data, self.sigmas[:len(data.shape)])
     
@@ -74,6 +76,8 @@ class MedianFilter(Filter):
     def sigmas(self):
         return [self.sizeX, self.sizeY, self.sizeZ]
     
+    thread_safe = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         return ndimage.median_filter(data, self.sigmas[:len(data.shape)])
     
@@ -110,6 +114,8 @@ class MaxFilter(Filter):
     def sigmas(self):
         return [self.sizeX, self.sizeY, self.sizeZ]
 
+    thread_safe = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         return ndimage.maximum_filter(data, self.sigmas[:len(data.shape)])
 
@@ -162,6 +168,8 @@ class DespeckleFilter(Filter):
     def sigmas(self):
         return [self.sizeX, self.sizeY, self.sizeZ]
     
+    thread_safe = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         return ndimage.generic_filter(data, self._filt, self.sigmas[:len(data.shape)])
     
@@ -197,6 +205,8 @@ class MeanFilter(Filter):
     def sigmas(self):
         return [self.sizeX, self.sizeY, self.sizeZ]
     
+    thread_safe = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         return ndimage.mean_filter(data, self.sigmas[:len(data.shape)])
     
@@ -221,6 +231,8 @@ class Zoom(Filter):
     """
     zoom = Float(1.0)
     
+    thread_safe = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         return ndimage.zoom(data, self.zoom)
     
@@ -247,6 +259,8 @@ class MaskEdges(Filter):
     """
     widthPixels = Int(10)
 
+    thread_safe = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         dm = data.copy()
         dm[:self.widthPixels, :] = 0
@@ -295,6 +309,8 @@ class DoGFilter(Filter):
     def sigma2s(self):
         return [self.sigma2X, self.sigma2Y, self.sigma2Z]
     
+    thread_safe = True
+    
     def applyFilter(self, data, chanNum, frNum, im):
         return ndimage.gaussian_filter(data, self.sigmas[:len(data.shape)]) - ndimage.gaussian_filter(data, self.sigma2s[:len(data.shape)])
     
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in instrumentation of recipe execution.
+
+Attach a :class:`RecipeProfiler` to a recipe (``recipe.profiler = RecipeProfiler()``) and each module run, input load,
+and output save is recorded with its wall time, peak memory use, bytes read and written, and the size of any
+outputs. :meth:`RecipeProfiler.save` writes a report (json and an optional plain text summary table).
+
+Batch processing (:func:`PYME.recipes.runRecipe.runRecipe`) and cluster recipe tasks
+(:mod:`PYME.cluster.taskWorkerHTTP`) do this automatically, saving the report next to the recipe outputs, if the
+`recipes-profile` config option is set.
+
+Notes
+-----
+Memory is tracked with `tracemalloc` (numpy registers its allocations with tracemalloc, so this includes array data),
+and I/O with process wide counters (psutil, or /proc/self/io). When modules run concurrently (see
+`recipes-num_threads`) their memory and I/O figures will include that of any modules running at the same time.
+"""
+import time
+import json
+import threading
+import contextlib
+import numpy as np
+import six
+
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import tracemalloc
+except ImportError:
+    #python 2
+    tracemalloc = None
+
+
+def _io_counters():
+    """Bytes read and written by this process so far, or None if we can't tell on this platform"""
+    try:
+        import psutil
+        c = psutil.Process().io_counters()
+        return c.read_chars, c.write_chars
+    except (ImportError, AttributeError):
+        pass
+
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict([l.split(':') for l in f.read().splitlines()])
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+
+def object_size(obj):
+    """
+    The (approximate) size in bytes of a recipe output. For images and tables this is estimated from their shape (so as
+    not to force evaluation of lazily computed data). Returns None for objects we don't know how to size.
+    """
+    from PYME.IO.image import ImageStack
+    from PYME.IO import tabular
+
+    try:
+        if isinstance(obj, np.ndarray):
+            return int(obj.nbytes)
+        elif isinstance(obj, ImageStack):
+            shape = obj.data.shape[:4]
+            try:
+                itemsize = np.dtype(obj.data.dtype).itemsize
+            except (AttributeError, TypeError):
+                itemsize = 4
+            return int(np.prod(shape))*itemsize
+        elif isinstance(obj, tabular.TabularBase):
+            return len(obj)*len(obj.keys())*8
+    except Exception:
+        pass
+
+    return None
+
+
+class RecipeProfiler(object):
+    def __init__(self, track_memory=True):
+        """
+
+        Parameters
+        ----------
+        track_memory : bool
+            record memory usage using tracemalloc (which slows down python, although not numpy, memory allocation)
+        """
+        self.records = []
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+
+        self._track_memory = track_memory and (tracemalloc is not None)
+        self._started_tracemalloc = False
+        if self._track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+
+    def finish(self):
+        """Stop memory tracking (if we started it)"""
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    @contextlib.contextmanager
+    def profile(self, kind, name, **info):
+        """
+        Profile a block of code, e.g.::
+
+            with profiler.profile('module', 'Gaussian filter') as record:
+                ...
+                record['extra_info'] = ...
+
+        Parameters
+        ----------
+        kind : str
+            the kind of operation, e.g. 'module', 'load', or 'save'
+        name : str
+            what is being profiled
+        info
+            any additional information to record
+        """
+        record = dict(kind=kind, name=name, **info)
+
+        if self._track_memory:
+            mem_start = tracemalloc.get_traced_memory()[0]
+            try:
+                tracemalloc.reset_peak()
+            except AttributeError:
+                #python < 3.9, we can only get the peak since tracing started
+                pass
+
+        io_start = _io_counters()
+        t = time.time()
+        record['start'] = t - self._start_time
+
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.time() - t
+
+            io_end = _io_counters()
+            if (io_start is not None) and (io_end is not None):
+                record['bytes_read'] = io_end[0] - io_start[0]
+                record['bytes_written'] = io_end[1] - io_start[1]
+
+            if self._track_memory and tracemalloc.is_tracing():
+                record['peak_memory_delta'] = max(tracemalloc.get_traced_memory()[1] - mem_start, 0)
+
+            with self._lock:
+                self.records.append(record)
+
+    def report(self):
+        """The profile as a (json serializable) dictionary"""
+        with self._lock:
+            records = list(self.records)
+
+        return {'total_time': time.time() - self._start_time, 'records': records}
+
+    def summary_table(self):
+        """A plain text table summarising the profile, slowest first"""
+        cols = [('kind', '%-8s', '%-8s'), ('name', '%-40s', '%-40s'), ('wall_time', '%10s', '%10.3f'),
+                ('peak_memory_delta', '%12s', '%12.1f'), ('bytes_read', '%12s', '%12.1f'),
+                ('bytes_written', '%12s', '%12.1f'), ('output_bytes', '%12s', '%12.1f')]
+        scale = {'peak_memory_delta': 1e-6, 'bytes_read': 1e-6, 'bytes_written': 1e-6, 'output_bytes': 1e-6}
+
+        header = ' '.join([h % k.replace('peak_memory_delta', 'peak_mem') for k, h, f in cols])
+        lines = ['Times in s, sizes in MB', '', header, '-'*len(header)]
+        for r in sorted(self.report()['records'], key=lambda r: -r['wall_time']):
+            fields = []
+            for k, h, f in cols:
+                v = r.get(k, None)
+                if v is None:
+                    fields.append(h % '-')
+                else:
+                    fields.append(f % (v*scale.get(k, 1) if not isinstance(v, six.string_types) else v[:40]))
+            lines.append(' '.join(fields))
+
+        return '\n'.join(lines)
+
+    def save(self, filename_stub, summary=True):
+        """
+        Save the profile to `filename_stub + '.json'` and (if `summary` is True) a summary table to
+        `filename_stub + '.txt'`.
+        """
+        with open(filename_stub + '.json', 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+        if summary:
+            with open(filename_stub + '.txt', 'w') as f:
+                f.write(self.summary_table())
@@ -14,6 +14,9 @@ import tables
 from PYME.IO import tabular
 from PYME.IO import MetaDataHandler
 from PYME.IO import unifiedIO
+from PYME.recipes.profiling import RecipeProfiler
+from PYME import config
+import os
 
 import logging
 logger = logging.getLogger(__name__)
@@ -64,7 +67,7 @@ def saveOutput(output, filename):
     else: #hope we can convert to a tabular format
         saveTabular(tabular.MappingFilter(output), filename)
         
-def runRecipe(recipe, inputs, outputs, context={}):
+def runRecipe(recipe, inputs, outputs, context={}, profile=None):
     """Load inputs and run recipe, saving outputs.
     
     Parameters
@@ -76,7 +79,15 @@ def runRecipe(recipe, inputs, outputs, context={}):
       - outputs : a dictionary mapping recipe output names to filenames. The
                   corresponding members of the namespace are saved to disk
                   following execution of the recipe.
+      - profile : record the time, memory, and I/O used by each module, input and output, and save a report (as
+                  `{output_dir}/{file_stub}_profile.json` and `.txt`). Defaults to the `recipes-profile` config option.
     """
+    if profile is None:
+        profile = config.get('recipes-profile', False)
+        
+    if profile:
+        recipe.profiler = RecipeProfiler()
+        
     try:
         #the recipe instance might be re-used - clear any previous data
         recipe.namespace.clear()
@@ -97,6 +108,25 @@ def runRecipe(recipe, inputs, outputs, context={}):
     except:
         logger.exception('Error running recipe')
         raise
+    finally:
+        if profile:
+            save_profile(recipe, context)
+            
+def save_profile(recipe, context):
+    """Save the profile report for a recipe run next to its outputs, and detach the profiler from the recipe"""
+    profiler, recipe.profiler = recipe.profiler, None
+    profiler.finish()
+    
+    try:
+        stub = os.path.join(context['output_dir'], context['file_stub'] + '_profile')
+    except KeyError:
+        logger.info('No output location for recipe profile:\n' + profiler.summary_table())
+        return
+    
+    try:
+        profiler.save(stub, summary=config.get('recipes-profile_summary', True))
+    except (IOError, OSError):
+        logger.exception('Error saving recipe profile')
     
 
 def main():
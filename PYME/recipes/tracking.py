@@ -27,6 +27,7 @@ class TrackFeatures(ModuleBase):
     pNew = Float(0.2)
     r0 = Float(500)
     pLinkCutoff = Float(0.2)
+    sparseLinkage = Bool(True, desc='only consider linking objects which are close to each other (found using a KD-tree), rather than comparing all pairs of objects. Much faster for large numbers of objects, with the same result')
     
     minTrackLength = Int(5)
     maxParticleSize = Float(20)
@@ -44,7 +45,7 @@ class TrackFeatures(ModuleBase):
             self._tracker.r0 = self.r0
             self._tracker.linkageCuttoffProb = self.pLinkCutoff
             
-    @on_trait_change('features')   
+    @on_trait_change('features, sparseLinkage')
     def OnFeaturesChanged(self):
         self._tracker = None
         
@@ -67,22 +68,19 @@ class TrackFeatures(ModuleBase):
             
             feats = np.vstack([w*np.array(objects[fn]) for w, fn in weightedFeats])
             
-            self._tracker = tracking.Tracker(np.array(objects['t']).astype('i'), feats)
+            if self.sparseLinkage:
+                self._tracker = tracking.SparseTracker(np.array(objects['t']).astype('i'), feats)
+            else:
+                self._tracker = tracking.Tracker(np.array(objects['t']).astype('i'), feats)
             
             self._tracker.pNew=self.pNew
             self._tracker.r0 = self.r0
             self._tracker.linkageCuttoffProb = self.pLinkCutoff
 
         for i in range(1, (int(objects['t'].max()) + 1)):
-            L = self._tracker.calcLinkages(i,i-1)
-            self._tracker.updateTrack(i, L)
+            self._tracker.linkFrames(i, i-1)
             
-        clumpSizes = np.zeros_like(self._tracker.clumpIndex)
-        
-        for i in set(self._tracker.clumpIndex):
-            ind = (self._tracker.clumpIndex == i)
-            
-            clumpSizes[ind] = ind.sum()
+        clumpSizes = np.bincount(self._tracker.clumpIndex)[self._tracker.clumpIndex]
             
         trackVelocities = trackUtils.calcTrackVelocity(objects['x'], objects['y'], self._tracker.clumpIndex, objects['t'])
         
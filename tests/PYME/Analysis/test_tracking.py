@@ -0,0 +1,60 @@
+import numpy as np
+
+from PYME.Analysis.Tracking import tracking
+
+
+def _random_walks(n_particles=100, n_frames=20, step=100., size=1e4, seed=42):
+    rng = np.random.RandomState(seed)
+    x = rng.uniform(0, size, (n_particles, 2))
+    xs, ts = [], []
+    for t in range(n_frames):
+        x = x + rng.normal(0, step, x.shape)
+        #some particles are missed in each frame
+        detected = rng.rand(n_particles) > 0.05
+        xs.append(x[detected])
+        ts.append(t*np.ones(detected.sum(), 'i'))
+
+    return np.concatenate(ts), np.concatenate(xs).T
+
+
+def _track(tracker):
+    for i in range(1, tracker.t.max() + 1):
+        tracker.linkFrames(i, i - 1)
+    return tracker.clumpIndex
+
+
+def test_objects_by_frame():
+    t = np.array([2, 0, 0, 3, 2, 5])
+    tracker = tracking.Tracker(t, np.arange(12.).reshape(2, 6))
+
+    assert [list(ind) for ind in tracker.indicesByT] == [[1, 2], [], [0, 4], [3], [], [5]]
+    assert np.all(tracker.xvsByT[2] == [[0, 4], [6, 10]])
+
+
+def test_sparse_linkage_candidates():
+    t, xvs = _random_walks()
+    dense = tracking.Tracker(t, xvs, r0=100, linkageCuttoffProb=0.2)
+    sparse = tracking.SparseTracker(t, xvs, r0=100, linkageCuttoffProb=0.2)
+
+    for i in [1, 10]:
+        l_dense = dense.calcLinkages(i, i - 1)
+        l_sparse = sparse.calcLinkages(i, i - 1)
+
+        assert sorted(l_dense.keys()) == sorted(l_sparse.keys())
+        for k in l_dense.keys():
+            assert np.all(l_dense[k][0] == l_sparse[k][0])
+            assert np.allclose(l_dense[k][1], l_sparse[k][1], atol=1e-5)
+
+
+def test_sparse_tracking_matches_dense():
+    t, xvs = _random_walks()
+    ci_dense = _track(tracking.Tracker(t, xvs, r0=100, linkageCuttoffProb=0.2))
+
+    assert np.all(_track(tracking.SparseTracker(t, xvs, r0=100, linkageCuttoffProb=0.2)) == ci_dense)
+
+    #going via the dictionary of candidate linkages (as used interactively) should give the same result
+    sparse = tracking.SparseTracker(t, xvs, r0=100, linkageCuttoffProb=0.2)
+    for i in range(1, t.max() + 1):
+        sparse.updateTrack(i, sparse.calcLinkages(i, i - 1))
+
+    assert np.all(sparse.clumpIndex == ci_dense)
@@ -0,0 +1,92 @@
+import numpy as np
+
+
+def test_shared_frame_cache():
+    from PYME.IO.buffers import SharedFrameCache
+
+    cache = SharedFrameCache(size_mb=1)
+    cache.put('test_series', 0, np.zeros((64, 64), 'uint16'))
+    
+    # slots are sized from the first frame
+    assert cache.slot_bytes == 64*64*2
+    assert cache.n_slots == 1024*1024//(64*64*2)
+    n_slots = cache.n_slots
+
+    for i in range(1, 2*n_slots):
+        cache.put('test_series', i, i*np.ones((64, 64), 'uint16'))
+
+    assert n_slots/2 < len(cache) <= n_slots
+
+    f = cache.get('test_series', 2*n_slots - 1)
+    assert f.dtype == np.uint16
+    assert f.shape == (64, 64)
+    assert np.all(f == 2*n_slots - 1)
+
+    # frames are keyed on series as well as frame index
+    assert cache.get('another_series', 2*n_slots - 1) is None
+
+    # frames which are too large are not cached
+    cache.put('test_series', -1, np.ones((128, 128), 'uint16'))
+    assert cache.get('test_series', -1) is None
+    
+    
+def _same_set_frames(cache, frame, n):
+    """Frames which hash to the same set of slots as `frame`"""
+    key = cache._key('test_series')
+    s = cache._set(key, frame)
+    frames = []
+    i = frame + 1
+    while len(frames) < n:
+        if cache._set(key, i) == s:
+            frames.append(i)
+        i += 1
+    return frames
+
+
+def test_shared_frame_cache_lru_and_pinning():
+    from PYME.IO.buffers import SharedFrameCache
+    
+    cache = SharedFrameCache(size_mb=1)
+    cache.put('test_series', 0, np.zeros((64, 64), 'uint16'))
+    ways = cache.max_ways
+    
+    # filling the set evicts the least recently used frame
+    for i in _same_set_frames(cache, 0, ways):
+        cache.put('test_series', i, i*np.ones((64, 64), 'uint16'))
+    assert cache.get('test_series', 0) is None
+    
+    # pinned frames are read-only views into the shared memory, and are not evicted while pinned
+    first = _same_set_frames(cache, 0, 1)[0]
+    with cache.pinned('test_series', first) as view:
+        assert np.shares_memory(view, cache._data)
+        assert not view.flags.writeable
+        
+        for i in _same_set_frames(cache, 0, 4*ways)[ways:]:
+            cache.put('test_series', i, i*np.ones((64, 64), 'uint16'))
+            
+        assert np.all(view == first)
+        assert cache.get('test_series', first) is not None
+        
+    with cache.pinned('another_series', 0) as view:
+        assert view is None
+
+
+def test_bg_histogram_buffer():
+    """Check that the streaming percentile estimate tracks the exact percentile as we slide the window"""
+    from PYME.IO.buffers import bgHistogramBuffer
+
+    np.random.seed(42)
+    frames = [np.random.poisson(100*np.ones((32, 32))).astype('uint16') for i in range(60)]
+    window = 30
+
+    bfb = bgHistogramBuffer(percentile=.25)
+    for i in range(window):
+        bfb.addFrame(i, frames[i])
+
+    for i in range(window, len(frames)):
+        bfb.removeFrame(i - window)
+        bfb.addFrame(i, frames[i])
+
+        exact = np.sort(np.array(frames[(i - window + 1):(i + 1)]), 0)[int(window*.25)]
+        # noise standard deviation is ~10, so this should be well within the noise
+        assert np.abs(bfb.getPercentile(.25) - exact).max() < 2.0
@@ -0,0 +1,44 @@
+import collections
+import socket
+
+from PYME.IO import clusterIO
+
+
+class _FakeInfo(object):
+    def __init__(self, port):
+        self.address = socket.inet_aton('127.0.0.1')
+        self.port = port
+
+
+class _FakeNS(object):
+    def __init__(self, n_servers):
+        self._services = [('PYMEDataServer [TESTCHOOSE]: server%d' % i, _FakeInfo(9000 + i)) for i in range(n_servers)]
+        
+    def get_advertised_services(self):
+        return self._services
+    
+
+def test_choose_server_stripes_by_speed(monkeypatch):
+    ns = _FakeNS(3)
+    monkeypatch.setattr(clusterIO, 'get_ns', lambda : ns)
+    monkeypatch.setattr(clusterIO, '_update_free_space', lambda serverfilter : None)
+    
+    speeds = {ns._services[0][0]: 100e6, ns._services[1][0]: 100e6, ns._services[2][0]: 200e6}
+    for k, v in speeds.items():
+        monkeypatch.setitem(clusterIO._lastwritespeed, k, v)
+    
+    counts = collections.Counter([clusterIO._chooseServer('TESTCHOOSE', nbytes=10e6)[0] for i in range(400)])
+    
+    #the fast server should get half the data
+    assert abs(counts[ns._services[2][0]] - 200) <= 2
+    assert abs(counts[ns._services[0][0]] - 100) <= 2
+    
+    
+def test_choose_server_avoids_full_servers(monkeypatch):
+    ns = _FakeNS(2)
+    monkeypatch.setattr(clusterIO, 'get_ns', lambda : ns)
+    monkeypatch.setattr(clusterIO, '_update_free_space', lambda serverfilter : None)
+    monkeypatch.setitem(clusterIO._diskfreespace, '127.0.0.1:9000', 0)
+    
+    for i in range(10):
+        assert clusterIO._chooseServer('TESTCHOOSE', nbytes=1e6)[0] == ns._services[1][0]
@@ -0,0 +1,55 @@
+import json
+import threading
+import numpy as np
+
+from PYME.IO import PZFFormat, clusterIO
+from PYME.IO.DataSources import ClusterPZFDataSource
+
+
+def _fake_cluster(monkeypatch, n_frames=20):
+    """Serve a series from memory rather than from the cluster, recording which frames are requested"""
+    files = {'test/series/metadata.json': json.dumps({}).encode()}
+    for i in range(n_frames):
+        files['test/series/frame%05d.pzf' % i] = PZFFormat.dumps(i*np.ones((8, 8), 'u2'))
+
+    requests = []
+    lock = threading.Lock()
+
+    def get_file(filename, serverfilter=None, **kwargs):
+        with lock:
+            requests.append(filename)
+        return files[filename]
+
+    def listdir(dirname, serverfilter=None):
+        return sorted([f.split('/')[-1] for f in files.keys()])
+
+    monkeypatch.setattr(clusterIO, 'get_file', get_file)
+    monkeypatch.setattr(clusterIO, 'listdir', listdir)
+
+    return requests
+
+
+def test_prefetch_sequential(monkeypatch):
+    requests = _fake_cluster(monkeypatch)
+    ds = ClusterPZFDataSource.DataSource('PYME-CLUSTER://TEST/test/series', prefetch=4)
+
+    for i in range(20):
+        assert np.all(ds.getSlice(i) == i)
+
+    #every frame should have been fetched exactly once
+    frames = [r for r in requests if r.endswith('.pzf')]
+    assert sorted(frames) == ['test/series/frame%05d.pzf' % i for i in range(20)]
+
+
+def test_prefetch_random_access(monkeypatch):
+    requests = _fake_cluster(monkeypatch)
+    ds = ClusterPZFDataSource.DataSource('PYME-CLUSTER://TEST/test/series', prefetch=4)
+
+    order = [3, 11, 0, 19, 7, 18, 17, 16, 15, 4]
+    for i in order:
+        assert np.all(ds.getSlice(i) == i)
+
+    #no prefetching until we have a run (17, 16 with a stride of -1), and never past the start or end of the series
+    frames = [r for r in requests if r.endswith('.pzf')]
+    assert frames[:7] == ['test/series/frame%05d.pzf' % i for i in order[:7]]
+    assert all([0 <= int(f[-9:-4]) < 20 for f in frames])
@@ -44,6 +44,12 @@ def test_put():
     
     assert testdata == retrieved
     
+def test_put_leaves_no_temporary_files():
+    clusterIO.put_file('_testing/test_tmp/test.txt', b'foo bar\n', 'TEST')
+    
+    files = [f for d, _, fns in os.walk(tmp_root) if d.endswith('test_tmp') for f in fns]
+    assert files == ['test.txt']
+    
 def test_putfiles_and_list():
     test_files = [('_testing/test_list/file_%d' % i, b'testing ... \n') for i in range(10)]
     
@@ -100,4 +106,101 @@ def test_dircache_purge():
     
         listing = clusterIO.listdir('_testing/lots_of_folders/test_%d/' % i, 'TEST')
     
-    #assert (len(listing) == 10)
\ No newline at end of file
+    #assert (len(listing) == 10)
+
+def test_aggregate_txt():
+    clusterIO.put_file('__aggregate_txt/_testing/test_agg.txt', b'foo\n', 'TEST')
+    clusterIO.put_file('__aggregate_txt/_testing/test_agg.txt', b'bar\n', 'TEST')
+    
+    #the server holds the file open between appends - make sure a read sees everything written so far
+    retrieved = clusterIO.get_file('_testing/test_agg.txt', 'TEST', use_file_cache=False)
+    
+    assert retrieved == b'foo\nbar\n'
+    
+    
+def test_locate_and_glob():
+    test_files = [('_testing/test_locate/frame%05d.pzf' % i, b'testing ... \n') for i in range(10)]
+    clusterIO.put_files(test_files, 'TEST')
+    
+    assert len(clusterIO.locate_file('_testing/test_locate/frame00003.pzf', 'TEST')) == 1
+    assert len(clusterIO.locate_file('_testing/test_locate/frame00011.pzf', 'TEST')) == 0
+    assert clusterIO.exists('_testing/test_locate/frame00009.pzf', 'TEST')
+    assert not clusterIO.exists('_testing/test_locate/frame00010.pzf', 'TEST')
+    
+    #files added after the directory has been indexed
+    clusterIO.put_file('_testing/test_locate/frame00010.pzf', b'testing ... \n', 'TEST')
+    assert clusterIO.exists('_testing/test_locate/frame00010.pzf', 'TEST')
+    
+    matches = clusterIO.cglob('_testing/test_locate/frame0000*.pzf', 'TEST')
+    assert sorted(matches) == sorted([f for f, d in test_files])
+
+
+def test_spooler_events():
+    from PYME.Acquire import HTTPSpooler
+    from PYME.IO.DataSources import ClusterPZFDataSource
+    import numpy as np
+    import dispatch
+
+    frame = np.zeros((1, 64, 64), 'uint16')
+    spooler = HTTPSpooler.Spooler('test_events_%3.1f' % time.time(), dispatch.Signal(), frameShape=None,
+                                  serverfilter='TEST')
+    try:
+        spooler.StartSpool()
+        spooler.evtLogger.logEvent('ProtocolFocus', '0, 1.5')
+        for i in range(5):
+            spooler.OnFrame(None, frame)
+
+        #events should be readable while we are still spooling
+        time.sleep(2*HTTPSpooler.EVENT_FLUSH_INTERVAL + 1)
+        ds = ClusterPZFDataSource.DataSource(spooler.getURL())
+        assert b'ProtocolFocus' in ds.getEvents()['EventName'].tolist()
+
+        spooler.evtLogger.logEvent('ProtocolTask', 'done')
+        spooler.StopSpool()
+    finally:
+        spooler.cleanup()
+
+    evts = ds.getEvents()
+    assert evts['EventName'].tolist() == [b'ProtocolFocus', b'ProtocolTask']
+    assert evts['EventDescr'].tolist() == [b'0, 1.5', b'done']
+    assert np.all(np.diff(evts['Time']) >= 0)
+
+
+def test_thread_pool_more_sessions_than_threads():
+    import threading
+    import http.server
+    import requests
+    from PYME.cluster.HTTPDataServer import ThreadPoolHTTPServer
+    
+    class _Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok')
+            
+        def log_message(self, *args):
+            pass
+    
+    server = ThreadPoolHTTPServer(('127.0.0.1', 0), _Handler, num_threads=2, keepalive_timeout=30)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    try:
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+        
+        #more persistent sessions than pool threads, each kept alive between requests
+        sessions = [requests.Session() for i in range(6)]
+        t0 = time.time()
+        for i in range(3):
+            for s in sessions:
+                r = s.get(url, timeout=5)
+                assert r.content == b'ok'
+        
+        #idle keep-alive connections should not stop other sessions being served
+        assert (time.time() - t0) < 5
+    finally:
+        server.shutdown()
+        server.server_close()
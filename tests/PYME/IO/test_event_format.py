@@ -0,0 +1,49 @@
+import numpy as np
+
+from PYME.IO import eventFormat
+
+
+EVENTS = [('StartAq', '0', 1.5), ('ProtocolFocus', u'12, 3.5µm', 2.25), ('ProtocolTask', '', 3.0)]
+
+
+def test_roundtrip():
+    evts = eventFormat.loads(eventFormat.dumps(EVENTS))
+
+    assert evts.dtype == eventFormat.EVENTS_DTYPE
+    assert evts['EventName'].tolist() == [b'StartAq', b'ProtocolFocus', b'ProtocolTask']
+    assert evts['EventDescr'].tolist() == [b'0', u'12, 3.5µm'.encode('utf8'), b'']
+    assert np.allclose(evts['Time'], [1.5, 2.25, 3.0])
+
+
+def test_appended_blocks():
+    #a log written incrementally is a concatenation of blocks, and can be read while the last block is being written
+    data = eventFormat.dumps(EVENTS[:2]) + eventFormat.dumps([]) + eventFormat.dumps(EVENTS[2:])
+
+    evts = eventFormat.loads(data)
+    assert evts['EventName'].tolist() == [b'StartAq', b'ProtocolFocus', b'ProtocolTask']
+    assert evts['EventDescr'][1] == u'12, 3.5µm'.encode('utf8')
+
+    evts = eventFormat.loads(data[:-3])
+    assert evts['EventName'].tolist() == [b'StartAq', b'ProtocolFocus']
+
+
+def test_record_array():
+    #e.g. the Events table of an .h5 file
+    evts = np.array([(b'a desc', b'StartAq', 1.0), (b'', b'ProtocolTask', 2.0)],
+                    dtype=[('EventDescr', 'S256'), ('EventName', 'S32'), ('Time', '<f8')])
+
+    out = eventFormat.loads(eventFormat.dumps(evts))
+    assert out['EventName'].tolist() == evts['EventName'].tolist()
+    assert out['EventDescr'].tolist() == evts['EventDescr'].tolist()
+    assert np.all(out['Time'] == evts['Time'])
+
+
+def test_invalid():
+    assert eventFormat.is_event_log(eventFormat.dumps(EVENTS))
+    assert not eventFormat.is_event_log(b'[["StartAq", "0", 1.5]]')
+
+    try:
+        eventFormat.loads(b'[["StartAq", "0", 1.5]]')
+        raise AssertionError('Expected ValueError')
+    except ValueError:
+        pass
@@ -0,0 +1,44 @@
+import numpy as np
+import tempfile
+import os
+
+
+def test_append_coalescing():
+    import tables
+    from PYME.IO import h5rFile
+    
+    filename = os.path.join(tempfile.mkdtemp(), 'test_append.h5r')
+    
+    for i in range(200):
+        with h5rFile.openH5R(filename, 'a') as h5f:
+            h5f.appendToTable('FitResults', np.ones(5, dtype=[('a', '<f4'), ('b', '<i4')]))
+            
+    h5rFile.close_all()
+    assert len(h5rFile.file_cache) == 0
+    
+    with tables.open_file(filename) as f:
+        assert f.root.FitResults.nrows == 1000
+
+
+def test_append_after_close():
+    import tables
+    from PYME.IO import h5rFile
+    
+    filename = os.path.join(tempfile.mkdtemp(), 'test_append_after_close.h5r')
+    
+    h5f = h5rFile.openH5R(filename, 'w')
+    h5f.appendToTable('FitResults', np.ones(5, dtype=[('a', '<f4'), ('b', '<i4')]))
+    
+    # simulate being handed the file from the cache just as the poll thread closes it
+    h5f.close_when_idle()
+    h5f._pollThread.join()
+    assert not h5f.is_alive
+    
+    h5f.appendToTable('FitResults', np.ones(3, dtype=[('a', '<f4'), ('b', '<i4')]))
+    
+    h5rFile.close_all()
+    assert len(h5rFile.file_cache) == 0
+    
+    # the data appended after closing is written (and the file was re-opened without truncating it)
+    with tables.open_file(filename) as f:
+        assert f.root.FitResults.nrows == 8
@@ -0,0 +1,31 @@
+import os
+import tempfile
+
+from PYME.IO import clusterListing
+
+
+def test_location_index():
+    root = tempfile.mkdtemp()
+    for i in range(5):
+        with open(os.path.join(root, 'frame%05d.pzf' % i), 'wb') as f:
+            f.write(b'foo')
+            
+    index = clusterListing.LocationIndex()
+    
+    assert index.has_file(os.path.join(root, 'frame00001.pzf'))
+    assert not index.has_file(os.path.join(root, 'frame00005.pzf'))
+    assert index.find_prefix(root, 'frame0000') == ['frame%05d.pzf' % i for i in range(5)]
+    
+    #written through the data server (which updates the index)
+    with open(os.path.join(root, 'frame00005.pzf'), 'wb') as f:
+        f.write(b'foo')
+    index.add(os.path.join(root, 'frame00005.pzf'))
+    assert index.find_prefix(root, 'frame00005') == ['frame00005.pzf']
+    
+    #written by other means
+    with open(os.path.join(root, 'frame00006.pzf'), 'wb') as f:
+        f.write(b'foo')
+    assert index.has_file(os.path.join(root, 'frame00006.pzf'))
+    
+    assert index.glob(os.path.join(root, 'frame*.pzf')) == [os.path.join(root, 'frame%05d.pzf' % i) for i in range(7)]
+    assert index.find_prefix(os.path.join(root, 'missing')) == []
@@ -120,4 +120,35 @@ def test_PZFFormat_lossless_uint8():
 
     #print result.squeeze(), test_data, result.shape, test_data.shape
 
-    assert np.allclose(result.squeeze(), test_data.squeeze())
\ No newline at end of file
+    assert np.allclose(result.squeeze(), test_data.squeeze())
+
+def test_PZFFormat_raw_into_buffers():
+    from PYME.IO import PZFFormat
+    test_data = np.random.poisson(100, 10000).reshape(100,100).astype('uint16')
+    
+    buf = bytearray(PZFFormat.HEADER_LENGTH_V3 + test_data.nbytes + 100)
+    nbytes = PZFFormat.dumps_into(buf, test_data, frameNum=5)
+    
+    assert nbytes == PZFFormat.HEADER_LENGTH_V3 + test_data.nbytes
+    
+    out = np.zeros_like(test_data)
+    result, header = PZFFormat.loads(memoryview(buf)[:nbytes], out=out)
+    
+    assert header['FrameNum'] == 5
+    assert np.shares_memory(result, out)
+    assert np.allclose(out, test_data)
+    
+    with pytest.raises(ValueError):
+        PZFFormat.dumps_into(bytearray(10), test_data)
+    
+def test_PZFFormat_chunked_into_buffer():
+    from PYME.IO import PZFFormat
+    test_data = np.random.poisson(100, 10000).reshape(100,100).astype('uint16')
+    
+    s = PZFFormat.dumps(test_data, compression=PZFFormat.DATA_COMP_HUFFCODE_CHUNKS, num_chunks=3, num_threads=2)
+    
+    out = np.zeros(test_data.nbytes, 'u1')
+    result, header = PZFFormat.loads(s, out=out, num_threads=3)
+
+    assert np.shares_memory(result, out)
+    assert np.allclose(result.squeeze(), test_data)
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+test_dtype = [('tIndex', '<i4'), ('fitResults', [('A', '<f4'), ('x0', '<f4')]), ('v', '<f4', (3,)), ('name', 'S5')]
+
+
+@pytest.mark.parametrize('compression', [0, 1])
+def test_record_stream_round_trip(compression):
+    from PYME.IO import recordFormat
+    
+    data = np.zeros(100, dtype=test_dtype)
+    data['tIndex'] = np.arange(100)
+    data['fitResults']['x0'] = np.random.rand(100)
+    data['v'][:, 1] = 3
+    data['name'] = b'foo'
+    
+    s = recordFormat.dumps(data, compression=compression)
+    assert recordFormat.is_record_stream(s)
+    
+    result = recordFormat.loads(s)
+    
+    assert result.dtype == data.dtype
+    assert np.all(result == data)
+    
+    
+def test_decode_results_no_pickle():
+    from PYME.IO import recordFormat
+    
+    data = np.ones(10, dtype=[('a', '<f4'), ('b', '<f4')])
+    
+    assert np.all(recordFormat.decode_results(recordFormat.dumps(data)) == data)
+    
+    with pytest.raises(Exception):
+        recordFormat.decode_results(data.dumps())
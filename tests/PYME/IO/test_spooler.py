@@ -47,6 +47,23 @@ def test_spooler(nFrames=50):
     ts = testClusterSpooling.TestSpooler(testFrameSize=[1024,256], serverfilter='TEST')
     ts.run(nFrames=nFrames)
     
+    
+def test_spooler_queue_status(nFrames=500):
+    ts = testClusterSpooling.TestSpooler(testFrameSize=[1024,256], serverfilter='TEST')
+    ts.run(nFrames=nFrames)
+    
+    #wait for the frames flushed when stopping to be sent
+    t = time.time()
+    while not ts.spooler.finished() and (time.time() - t) < 60:
+        time.sleep(.1)
+    
+    status = ts.spooler.queue_status()
+    assert status['queued_frames'] == 0
+    assert status['queued_bytes'] == 0
+    assert status['frame_rate'] > 0
+    #batches should have grown with the (high) frame rate
+    assert ts.spooler.buflen > HTTPSpooler.MIN_BATCH_SIZE
+    
 
 from PYME.util import fProfile
     
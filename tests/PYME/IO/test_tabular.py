@@ -0,0 +1,164 @@
+import numpy as np
+from PYME.IO import tabular
+
+
+def _source(n=1000):
+    return tabular.DictSource({'x': np.random.rand(n), 'y': np.random.rand(n), 't': np.arange(n, dtype='f'),
+                               'A': np.ones(n)})
+
+
+def test_mapping_cache():
+    src = _source()
+    m = tabular.MappingFilter(src)
+    m.setMapping('r', 'sqrt(x**2 + y**2)')
+    m.setMapping('r2', 'r*2')
+    
+    r = m['r']
+    assert np.allclose(r, np.sqrt(src['x']**2 + src['y']**2))
+    
+    #repeated access should not re-evaluate
+    cached = m._column_cache['r']
+    assert np.allclose(m['r'], r)
+    assert m._column_cache['r'] is cached
+    assert np.allclose(m['r2'], 2*r)
+    assert np.allclose(m['r2', 10:20], 2*r[10:20])
+    
+    #setting the same mapping again keeps the cache, changing it invalidates
+    m.setMapping('r', 'sqrt(x**2 + y**2)')
+    assert m._column_cache['r'] is cached
+    m.setMapping('r', 'x + y')
+    assert np.allclose(m['r'], src['x'] + src['y'])
+    assert np.allclose(m['r2'], 2*(src['x'] + src['y']))
+    
+    
+def test_mapping_cache_variables():
+    src = _source()
+    m = tabular.MappingFilter(src)
+    m.addVariable('a', 2)
+    m.setMapping('xa', 'x*a')
+    assert np.allclose(m['xa'], 2*src['x'])
+    m.set_variables(a=3)
+    assert np.allclose(m['xa'], 3*src['x'])
+    
+    
+def test_mapping_cache_readonly_does_not_affect_source():
+    src = _source()
+    m = tabular.MappingFilter(src)
+    m.setMapping('x_raw', 'x')
+    m['x_raw']
+    assert not m._column_cache['x_raw'].flags.writeable
+    src['x'][0] = 5 #would raise if we had marked the source array as read-only
+    
+    
+def test_cached_columns_can_be_modified():
+    #callers (e.g. LMVis.Extras.vibration) modify the columns they get back in place - this must not change the cache
+    src = _source()
+    m = tabular.MappingFilter(src)
+    m.setMapping('x2', 'x*2')
+    f = tabular.ResultsFilter(m, x=[0, 0.5])
+    c = tabular.ColourFilter(f)
+    
+    for source, key in [(m, 'x2'), (f, 'x'), (c, 'x')]:
+        x = source[key]
+        x0 = x.copy()
+        x -= x.mean()
+        assert np.allclose(source[key], x0)
+    
+    
+def test_selection_filter_cache():
+    src = _source()
+    f = tabular.SelectionFilter(src, src['x'] < 0.5)
+    x = f['x']
+    assert np.all(x < 0.5)
+    cached = f._column_cache['x']
+    assert np.allclose(f['x'], x)
+    assert f._column_cache['x'] is cached
+    
+    f.Index = src['x'] > 0.5
+    assert np.all(f['x'] > 0.5)
+    
+    
+def test_colour_filter_cache():
+    src = _source()
+    f = tabular.SelectionFilter(src, src['x'] < 0.5)
+    c = tabular.ColourFilter(f)
+    x = c['x']
+    assert np.allclose(x, f['x'])
+    
+    #replacing the source (as done in Pipeline.Rebuild) invalidates the cache
+    c.resultsSource = tabular.SelectionFilter(src, src['x'] >= 0.5)
+    assert np.all(c['x'] >= 0.5)
+
+
+def _write_h5r(n=5000):
+    import os, tempfile
+    import tables
+    
+    dt = np.dtype([('tIndex', '<i4'), ('fitResults', [('A', '<f4'), ('x0', '<f4'), ('y0', '<f4')]),
+                   ('fitError', [('x0', '<f4'), ('y0', '<f4')])])
+    data = np.zeros(n, dt)
+    #not quite in time order, as for results written by multiple workers
+    data['tIndex'] = np.arange(n)//10 + np.random.randint(0, 3, n)
+    data['fitResults']['A'] = np.random.rand(n)
+    data['fitResults']['x0'] = 1e4*np.random.rand(n)
+    data['fitResults']['y0'] = 1e4*np.random.rand(n)
+    data['fitError']['x0'] = 30*np.random.rand(n)
+    
+    filename = os.path.join(tempfile.mkdtemp(), 'test_streaming.h5r')
+    with tables.open_file(filename, 'w') as h5f:
+        h5f.create_table(h5f.root, 'FitResults', data)
+    
+    return filename
+
+
+def test_streaming_h5r_source():
+    filename = _write_h5r()
+    
+    with tables_file(filename) as h5f:
+        ref = tabular.H5RSource(h5f)
+        src = tabular.StreamingH5RSource(h5f, chunk_size=700)
+        
+        assert len(src) == len(ref)
+        assert set(src.keys()) == set(ref.keys())
+        
+        assert np.all(np.diff(src['t']) >= 0)
+        _assert_same_rows(src, ref, ['t', 'x', 'fitError_x0', 'tIndex'])
+        assert np.all(src['x', 10:20] == src['x'][10:20])
+        
+        #only requested columns are read
+        assert set(src._columns.keys()) == {'tIndex', 'fitResults_x0', 'fitError_x0'}
+        
+        
+def test_streaming_h5r_pushdown():
+    filename = _write_h5r()
+    ranges = {'t': [100, 200], 'x': [1000, 8000], 'error_x': [0, 20]}
+    
+    with tables_file(filename) as h5f:
+        ref = tabular.ResultsFilter(tabular.H5RSource(h5f), **ranges)
+        src = tabular.StreamingH5RSource(h5f, filters=ranges, chunk_size=700)
+        filt = tabular.ResultsFilter(tabular.StreamingH5RSource(h5f, chunk_size=700), **ranges)
+        
+        #filtering the streaming source should not have loaded full columns (just tIndex, for sorting)
+        assert len(filt.resultsSource._columns) <= 1
+        
+        assert len(src) == len(ref) > 0
+        assert len(filt) == len(ref)
+        _assert_same_rows(src, ref, ['t', 'x', 'y', 'error_x'])
+        _assert_same_rows(filt, ref, ['t', 'x', 'y', 'error_x'])
+        
+        chunks = list(src.iterchunks(['x', 'tIndex']))
+        assert sum([len(c['x']) for c in chunks]) == len(ref)
+        assert np.all(np.sort(np.hstack([c['x'] for c in chunks])) == np.sort(ref['x']))
+
+
+def _assert_same_rows(src, ref, keys):
+    #both are sorted by time, but the order of rows within a frame is arbitrary
+    I_src = np.lexsort([src['x'], src['t']])
+    I_ref = np.lexsort([ref['x'], ref['t']])
+    for k in keys:
+        assert np.all(src[k][I_src] == ref[k][I_ref])
+
+
+def tables_file(filename):
+    import tables
+    return tables.open_file(filename)
@@ -0,0 +1,63 @@
+import numpy as np
+
+
+def _imb(size=2000.):
+    from PYME.IO.image import ImageBounds
+    return ImageBounds(0, 0, size, size)
+
+
+def _points(n=2000, size=2000., seed=42):
+    rs = np.random.RandomState(seed)
+    return rs.uniform(0, size, n), rs.uniform(0, size, n)
+
+
+def test_rendJitTriang_deterministic_with_seeds():
+    from PYME.LMVis import visHelpers
+    x, y = _points()
+
+    im1 = visHelpers.rendJitTriang(x, y, 4, 10., 0.9, _imb(), 20., seeds=[1, 2], geometric_mean=False)
+    im2 = visHelpers.rendJitTriang(x, y, 4, 10., 0.9, _imb(), 20., seeds=[1, 2], geometric_mean=False)
+
+    assert im1.shape == (100, 100)
+    assert np.all(np.isfinite(im1))
+    assert np.allclose(im1, im2)
+    assert im1.sum() > 0
+
+
+def test_rendJitTri_matches_rendJitTriang():
+    from PYME.LMVis import visHelpers
+    x, y = _points()
+    
+    im = np.zeros((100, 100))
+    visHelpers.rendJitTri(im, x, y, 10., 0.9, _imb(), 20., n=4, seed=1)
+    ref = visHelpers.rendJitTriang(x, y, 4, 10., 0.9, _imb(), 20., seeds=[1], geometric_mean=False)
+    
+    assert np.allclose(im/4, ref)
+
+
+def test_repair_jittered_is_valid():
+    from PYME.LMVis import visHelpers
+    x, y = _points()
+    base = visHelpers._BaseTriangulation(x, y)
+
+    rs = np.random.RandomState(7)
+    xj, yj = x + 5*rs.randn(len(x)), y + 5*rs.randn(len(y))
+    T = visHelpers._repair_jittered(base, xj, yj)
+
+    #no folded triangles, and (to a good approximation) the triangles tile the convex hull of the points
+    area = visHelpers._signed_area(xj, yj, T.triangles)
+    full_area = abs(visHelpers._signed_area(xj, yj, visHelpers._delaunay(xj, yj).triangles)).sum()
+    assert abs(abs(area).sum() - full_area) < 0.001*full_area
+
+
+def test_rendJitTriang_incremental_similar():
+    from PYME.LMVis import visHelpers
+    x, y = _points()
+
+    im_full = visHelpers.rendJitTriang(x, y, 8, 5., 1, _imb(), 20., seeds=[1, 2], geometric_mean=False,
+                                       incremental=False)
+    im_inc = visHelpers.rendJitTriang(x, y, 8, 5., 1, _imb(), 20., seeds=[1, 2], geometric_mean=False,
+                                      incremental=True)
+
+    assert np.all(np.isfinite(im_inc))
+    assert abs(im_inc.sum() - im_full.sum()) < 0.05*im_full.sum()
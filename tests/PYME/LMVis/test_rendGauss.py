@@ -0,0 +1,102 @@
+import numpy as np
+from PYME.IO.image import ImageBounds
+
+
+def _points(N=300):
+    np.random.seed(42)
+    x = np.random.uniform(200, 1800, N)
+    y = np.random.uniform(200, 1800, N)
+    sx = np.random.uniform(5, 40, N)
+    return x, y, sx
+
+
+def test_rendGauss():
+    from PYME.LMVis import visHelpers
+    x, y, sx = _points()
+    
+    X = np.arange(0, 2000, 5.) + 2.5
+    ref = np.zeros((len(X), len(X)))
+    for i in range(len(x)):
+        ref += np.exp(-((X[:, None] - x[i])**2 + (X[None, :] - y[i])**2)/(2*sx[i]**2))/sx[i]
+    
+    im = visHelpers.rendGauss(x, y, sx, ImageBounds(0, 0, 2000, 2000), 5.)
+    assert im.shape == ref.shape
+    assert np.abs(im - ref).max() < 0.01*ref.max()
+    
+    #with a large ROI, we should be (almost) exact
+    im = visHelpers.rendGauss(x, y, sx, ImageBounds(0, 0, 2000, 2000), 5., roiSigmas=6)
+    assert np.allclose(im, ref, atol=1e-5*ref.max())
+
+
+def test_rendGauss_threads():
+    from PYME.LMVis import gaussSplat
+    x, y, sx = _points(20000)
+    X = np.arange(0, 2000, 5.)
+    
+    args = ([X, X], [x, y], [sx, sx], 1.0/sx, [np.ceil(3*sx/5.), np.ceil(3*sx/5.)])
+    
+    im1 = gaussSplat.splat_gaussians(*args, num_threads=1)
+    im4 = gaussSplat.splat_gaussians(*args, num_threads=4)
+    
+    assert np.allclose(im1, im4, atol=1e-5*im1.max())
+    
+    
+def test_splat_dense_3d_memory(monkeypatch):
+    """Dense 3D tiles should be rendered in batches, bounding the temporary memory used"""
+    import tracemalloc
+    from PYME.LMVis import gaussSplat
+    
+    rs = np.random.RandomState(0)
+    n = 20000
+    x, y, z = rs.normal(100, 3, n), rs.normal(100, 3, n), rs.uniform(0, 20, n)
+    s = 1.5*np.ones(n)
+    args = ([np.arange(200.), np.arange(200.), np.arange(20.)], [x, y, z], [s, s, s], 1., [np.ceil(3*s)]*3)
+    
+    ref = gaussSplat.splat_gaussians(*args, num_threads=1)
+    
+    monkeypatch.setattr(gaussSplat, 'BATCH_SIZE', 2**16)
+    tracemalloc.start()
+    try:
+        im = gaussSplat.splat_gaussians(*args, num_threads=1)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    
+    assert np.allclose(im, ref, atol=1e-5*ref.max())
+    #the output, plus a tile and a few batches worth of temporaries
+    assert peak < 3*im.nbytes + 20*8*2**16
+    
+    
+def test_rendGauss_large_roi():
+    """points with very different ROI sizes, including some off the edge of the image"""
+    from PYME.LMVis import gaussSplat
+    X = np.arange(0, 100.)
+    x = np.array([10, 50, 90, -20, 50.])
+    y = np.array([10, 50, 90, 50, 130.])
+    s = np.array([1, 30, 2, 10, 10.])
+    
+    im = gaussSplat.splat_gaussians([X, X], [x, y], [s, s], 1, [np.ceil(6*s), np.ceil(6*s)])
+    
+    ref = np.exp(-((X[:, None, None] - x[None, None, :])**2 + (X[None, :, None] - y[None, None, :])**2)/(2*s**2)).sum(2)
+    assert np.allclose(im, ref, atol=1e-5)
+    
+
+def test_rendGauss3D():
+    from PYME.LMVis import visHelpers
+    x, y, sx = _points(2)
+    z, sz = np.array([-150., 120]), np.array([150., 50])
+    
+    im = visHelpers.rendGauss3D(x, y, z, sx, sz, ImageBounds(0, 0, 2000, 2000), 5., (-500, 500), 100, roiSigmas=6)
+    
+    X = np.arange(0, 2000, 5.)
+    Z = np.arange(-500, 500, 100.)
+    szr = np.maximum(sz, 100)
+    ref = 0
+    for i in range(2):
+        g = np.exp(-((X[:, None, None] - x[i])**2 + (X[None, :, None] - y[i])**2)/(2*sx[i]**2) - (Z[None, None, :] - z[i])**2/(2*szr[i]**2))
+        #axial extent of each point is +- 2 sz
+        g[:, :, np.abs(np.arange(len(Z)) - np.round((z[i] - Z[0])/100.)) > np.round(2*sz[i]/100.)] = 0
+        ref = ref + 1e3/(sx[i]**2*szr[i]*15.75)*g
+    
+    assert im.shape == ref.shape
+    assert np.allclose(im, ref, atol=1e-5*ref.max())
@@ -0,0 +1,152 @@
+import numpy as np
+import threading
+
+from PYME.IO import tabular, MetaDataHandler
+from PYME.IO.image import ImageBounds
+from PYME.LMVis import renderers
+
+
+class _Pipeline(object):
+    """Minimal stand in for PYME.LMVis.pipeline.Pipeline"""
+    def __init__(self, n=2000):
+        np.random.seed(0)
+        ds = tabular.DictSource({'x': np.random.uniform(0, 5000, n), 'y': np.random.uniform(0, 3000, n),
+                                 'error_x': np.random.uniform(5, 20, n), 't': np.arange(n)})
+        self.colourFilter = tabular.ColourFilter(ds)
+        self.mdh = MetaDataHandler.NestedClassMDHandler()
+        self.imageBounds = ImageBounds(0, 0, 5000, 3000)
+        self.filterKeys = {}
+        self.data_version = 0
+        
+    def __getitem__(self, key):
+        return self.colourFilter[key]
+    
+    def keys(self):
+        return list(self.colourFilter.keys())
+    
+    
+SETTINGS = {'pixelSize': 5., 'jitterVariable': 'error_x', 'jitterScale': 1.0, 'colours': [None],
+            'zSliceThickness': 50., 'zBounds': [0, 0]}
+
+
+def _render(renderer, imb):
+    return renderer._render_channel(None, SETTINGS, imb, MetaDataHandler.NestedClassMDHandler())[:, :, 0]
+
+
+def _count_genIm(renderer):
+    calls = []
+    genIm = renderer.genIm
+    
+    def _genIm(settings, imb, mdh):
+        calls.append(imb)
+        return genIm(settings, imb, mdh)
+    
+    renderer.genIm = _genIm
+    return calls
+
+
+def test_tiled_render_matches():
+    renderers.render_cache.clear()
+    p = _Pipeline()
+    r = renderers.GaussianRenderer(None, p)
+    
+    im = r.Generate(SETTINGS)
+    assert im.mdh['Rendering.JitterVariable'] == 'error_x'
+    
+    #check the tiles were stitched properly, including with (pixel aligned) bounds which don't line up with the tiles
+    imb = ImageBounds(1005, 515, 4010, 2800)
+    ref = r.genIm(SETTINGS, imb, MetaDataHandler.NestedClassMDHandler())
+    assert np.allclose(_render(r, imb), ref, atol=1e-3*ref.max())
+    
+    
+def test_render_cache_reuse():
+    renderers.render_cache.clear()
+    p = _Pipeline()
+    r = renderers.GaussianRenderer(None, p)
+    calls = _count_genIm(r)
+    
+    im1 = _render(r, p.imageBounds)
+    assert len(calls) == 1
+    
+    #same view - should be served entirely from the cache
+    im2 = _render(r, p.imageBounds)
+    assert len(calls) == 1
+    assert np.all(im1 == im2)
+    
+    #a sub-region (e.g. after panning / zooming in) should also come from the cache
+    im3 = _render(r, ImageBounds(1000, 500, 2000, 1500))
+    assert len(calls) == 1
+    assert np.all(im3 == im1[200:400, 100:300])
+    
+    #new data invalidates
+    p.data_version += 1
+    r.Generate(SETTINGS)
+    assert len(calls) == 2
+    
+    
+def test_render_cache_lru():
+    cache = renderers.RenderCache(3*800)
+    for i in range(5):
+        cache.put(i, np.zeros(100), {'tile': i})
+        
+    assert cache.get(0) is None
+    assert cache.get(4) is not None
+    assert cache.nbytes <= 3*800
+    
+    #metadata is evicted with the tiles
+    assert cache.get_metadata(0) is None
+    assert cache.get_metadata(4) == {'tile': 4}
+    assert len(cache._metadata) == len(cache._tiles)
+    
+    
+def test_progressive():
+    renderers.render_cache.clear()
+    p = _Pipeline()
+    r = renderers.GaussianRenderer(None, p)
+    
+    results = []
+    done = threading.Event()
+    
+    def _cb(im, final):
+        results.append((im.pixelSize, final))
+        if final:
+            done.set()
+    
+    r.GenerateProgressive(SETTINGS, _cb)
+    assert done.wait(10)
+    assert results == [(20., False), (5., True)]
+    
+    #generating a channel should not have changed the colour filter
+    assert p.colourFilter.currentColour is None
+
+
+def test_progressive_rebuild():
+    renderers.render_cache.clear()
+    p = _Pipeline()
+    r = renderers.GaussianRenderer(None, p)
+    genIm = r.genIm
+    
+    def _genIm(settings, imb, mdh):
+        if settings['pixelSize'] == SETTINGS['pixelSize'] and p.data_version == 0:
+            #simulate the pipeline being rebuilt while we are rendering the full resolution image
+            p.data_version += 1
+        return genIm(settings, imb, mdh)
+    
+    r.genIm = _genIm
+    
+    results = []
+    done = threading.Event()
+    
+    def _cb(im, final):
+        results.append((im, final))
+        if final:
+            done.set()
+    
+    r.GenerateProgressive(SETTINGS, _cb)
+    assert done.wait(10)
+    assert results[-1] == (None, True)
+    
+    #tiles rendered during the rebuild should not be re-used for the new data
+    calls = _count_genIm(r)
+    _render(r, p.imageBounds)
+    assert len(calls) == 1
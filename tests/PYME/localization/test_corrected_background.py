@@ -0,0 +1,32 @@
+import numpy as np
+
+
+class _FakeBackgroundBuffer(object):
+    def __init__(self):
+        self.value = 0
+    
+    def getBackground(self, bgindices):
+        return self.value*np.ones((8, 8), 'uint16')
+
+
+def test_corrected_background_not_stale():
+    from PYME.IO.MetaDataHandler import NestedClassMDHandler
+    from PYME.localization.remFitBuf import BufferManager
+    
+    md = NestedClassMDHandler()
+    md['dataSourceID'] = 'test_series'
+    md['Camera.ADOffset'] = 100.
+    
+    bm = BufferManager()
+    bm.bBuffer = _FakeBackgroundBuffer()
+    
+    bm.bBuffer.value = 110
+    assert np.all(bm.getCorrectedBackground(md, [0, 1, 2]) == 10)
+    
+    # the same background frames can give a different background (e.g. more frames available while spooling)
+    bm.bBuffer.value = 120
+    assert np.all(bm.getCorrectedBackground(md, [0, 1, 2]) == 20)
+    
+    # correction maps follow the metadata
+    md['Camera.ADOffset'] = 105.
+    assert np.all(bm.getCorrectedBackground(md, [0, 1, 2]) == 15)
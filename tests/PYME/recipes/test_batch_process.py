@@ -0,0 +1,69 @@
+import os
+
+
+def _fake_run_recipe(recipe, inputs, outputs, context={}):
+    fn = list(inputs.values())[0]
+    if 'bad' in fn:
+        raise RuntimeError('failed to process %s' % fn)
+    
+    with open(os.path.join(context['output_dir'], context['file_stub'] + '.csv'), 'w') as f:
+        f.write(fn)
+
+
+def test_bake_resume(tmpdir, monkeypatch):
+    from PYME.recipes import batchProcess, runRecipe
+    from PYME.recipes.base import ModuleCollection
+    from PYME.recipes.output import CSVOutput
+    monkeypatch.setattr(runRecipe, 'runRecipe', _fake_run_recipe)
+    
+    recipe = ModuleCollection()
+    recipe.add_module(CSVOutput(recipe, inputName='measurements'))
+    
+    inputs = []
+    for name in ['a', 'b', 'c', 'bad']:
+        inputs.append(str(tmpdir.join('%s.tif' % name)))
+        with open(inputs[-1], 'w') as f:
+            f.write(name)
+    
+    out_dir = str(tmpdir.join('out'))
+    
+    res = batchProcess.bake(recipe, {'input': inputs}, out_dir, num_procs=1)
+    assert len(res['completed']) == 3 and len(res['failed']) == 1
+    assert os.path.exists(os.path.join(out_dir, 'a.csv'))
+    
+    #only re-process things which failed or whose outputs have changed
+    with open(os.path.join(out_dir, 'b.csv'), 'w') as f:
+        f.write('modified')
+    
+    res = batchProcess.bake(recipe, {'input': inputs}, out_dir, num_procs=1)
+    assert len(res['skipped']) == 2 and len(res['completed']) == 1 and len(res['failed']) == 1
+    assert res['completed'][0]['input'] == inputs[1]
+    
+    #unchanged outputs aren't re-hashed, and touching an output without changing it doesn't force re-processing
+    hashed = []
+    file_hash = batchProcess._file_hash
+    monkeypatch.setattr(batchProcess, '_file_hash', lambda fn: hashed.append(fn) or file_hash(fn))
+    res = batchProcess.bake(recipe, {'input': inputs}, out_dir, num_procs=1)
+    assert len(res['skipped']) == 3 and hashed == []
+    
+    os.utime(os.path.join(out_dir, 'a.csv'), (0, 0))
+    res = batchProcess.bake(recipe, {'input': inputs}, out_dir, num_procs=1)
+    assert len(res['skipped']) == 3 and hashed == [os.path.join(out_dir, 'a.csv')]
+    
+    #changing the recipe means nothing is up to date
+    recipe.modules[0].inputName = 'other_measurements'
+    res = batchProcess.bake(recipe, {'input': inputs}, out_dir, num_procs=1)
+    assert len(res['skipped']) == 0 and len(res['completed']) == 3
+    
+    res = batchProcess.bake(recipe, {'input': inputs}, out_dir, num_procs=2, resume=False)
+    assert len(res['skipped']) == 0 and len(res['completed']) == 3
+
+
+def test_guided_chunks():
+    from PYME.recipes import batchProcess
+    
+    chunks = list(batchProcess._guided_chunks(list(range(100)), 4))
+    
+    assert sum(chunks, []) == list(range(100))
+    assert len(chunks[0]) >= len(chunks[-1]) == 1
+    assert max([len(c) for c in chunks]) <= batchProcess.MAX_CHUNK_SIZE
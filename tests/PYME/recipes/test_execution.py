@@ -0,0 +1,108 @@
+import threading
+import time
+import collections
+
+from PYME.recipes.base import ModuleCollection, ModuleBase
+from PYME.recipes.traits import Input, Output, Float
+
+
+class _Scale(ModuleBase):
+    input_name = Input('input')
+    factor = Float(2)
+    output_name = Output('scaled')
+    
+    def execute(self, namespace):
+        _Scale.n_runs[self.output_name] += 1
+        namespace[self.output_name] = namespace[self.input_name]*self.factor
+
+
+class _Sleep(ModuleBase):
+    input_name = Input('input')
+    output_name = Output('slept')
+    
+    def execute(self, namespace):
+        _Sleep.threads.add(threading.current_thread().ident)
+        time.sleep(0.5)
+        namespace[self.output_name] = namespace[self.input_name]
+
+
+def _recipe():
+    _Scale.n_runs = collections.Counter()
+    recipe = ModuleCollection()
+    a = _Scale(recipe, input_name='input', factor=2, output_name='a')
+    b = _Scale(recipe, input_name='a', factor=3, output_name='b')
+    c = _Scale(recipe, input_name='input', factor=5, output_name='c')
+    for m in [a, b, c]:
+        recipe.add_module(m)
+    
+    return recipe, a, b, c
+
+
+def _runs():
+    return _Scale.n_runs['a'], _Scale.n_runs['b'], _Scale.n_runs['c']
+
+
+def test_incremental_execution(monkeypatch):
+    from PYME import config
+    monkeypatch.setitem(config.config, 'recipes-memoise_outputs', True)
+    recipe, a, b, c = _recipe()
+    recipe.execute(input=1.0)
+    assert recipe.namespace['b'] == 6 and recipe.namespace['c'] == 5
+    
+    #changing a parameter only re-runs the module and those downstream of it
+    b.factor = 4
+    recipe.execute()
+    assert recipe.namespace['b'] == 8
+    assert _runs() == (1, 2, 1)
+    
+    #changing it back re-uses the memoised output
+    b.factor = 3
+    recipe.execute()
+    assert recipe.namespace['b'] == 6
+    assert _runs() == (1, 2, 1)
+    
+    #new inputs invalidate everything
+    recipe.execute(input=2.0)
+    assert recipe.namespace['b'] == 12
+    assert _runs() == (2, 3, 2)
+
+
+def test_memoisation_off_by_default():
+    recipe, a, b, c = _recipe()
+    recipe.execute(input=1.0)
+    
+    b.factor = 4
+    recipe.execute()
+    b.factor = 3
+    recipe.execute()
+    assert recipe.namespace['b'] == 6
+    assert _runs() == (1, 3, 1)
+    assert len(recipe._output_cache) == 0
+
+
+def test_parallel_execution():
+    _Sleep.threads = set()
+    _Scale.n_runs = collections.Counter()
+    recipe = ModuleCollection()
+    recipe.num_threads = 2
+    recipe.add_module(_Sleep(recipe, output_name='s1'))
+    recipe.add_module(_Sleep(recipe, output_name='s2'))
+    recipe.add_module(_Scale(recipe, input_name='s1', output_name='s3'))
+    
+    t = time.time()
+    recipe.execute(input=1.0)
+    
+    assert time.time() - t < 0.9
+    assert len(_Sleep.threads) == 2
+    assert recipe.namespace['s3'] == 2
+
+
+def test_pickle():
+    #recipes are pickled to send them to worker processes (e.g. in batchProcess.bake)
+    import pickle
+    recipe, a, b, c = _recipe()
+    recipe.execute(input=1.0)
+    
+    recipe2 = pickle.loads(pickle.dumps(recipe))
+    assert [m.factor for m in recipe2.modules] == [2, 3, 5]
+    assert recipe2._output_cache == {}
@@ -0,0 +1,125 @@
+import numpy as np
+from scipy import ndimage
+
+from PYME.IO.image import ImageStack
+
+
+def _image(shape=(32, 30, 20), n_chans=2, seed=3):
+    rs = np.random.RandomState(seed)
+    return ImageStack([rs.rand(*shape) for c in range(n_chans)])
+
+
+def test_framewise_filter():
+    from PYME.recipes.filters import GaussianFilter
+    im = _image()
+    
+    filt = GaussianFilter(sigmaX=2, sigmaY=2, processFramesIndividually=True).apply_simple(im)
+    
+    assert filt.data.shape[:4] == im.data.shape[:4]
+    for c in range(2):
+        expected = np.concatenate([ndimage.gaussian_filter(im.data[:, :, i, c].squeeze().astype('f'), [2, 2])[:, :, None]
+                                   for i in range(20)], 2)
+        assert np.allclose(filt.data[:, :, :, c].squeeze(), expected)
+
+
+def test_arithmetic_filter():
+    from PYME.recipes.base import Subtract
+    im0, im1 = _image(), _image(seed=4)
+    
+    for frame_wise in [True, False]:
+        mod = Subtract(inputName0='a', inputName1='b', processFramesIndividually=frame_wise)
+        res = mod.apply(inputName0=im0, inputName1=im1)['filtered_image']
+        expected = im0.data[:, :, :, 1].squeeze() - im1.data[:, :, :, 1].squeeze()
+        assert np.allclose(res.data[:, :, :, 1].squeeze(), expected, atol=1e-6)
+
+
+def test_unsafe_filter_runs_serially():
+    import threading
+    from PYME.recipes.base import Filter
+    
+    class _RecordThread(Filter):
+        def applyFilter(self, data, chanNum, frNum, im):
+            threads.add(threading.current_thread())
+            return data
+    
+    im = _image()
+    for frame_wise in [True, False]:
+        threads = set()
+        _RecordThread(processFramesIndividually=frame_wise).apply_simple(im)
+        assert threads == {threading.current_thread()}
+
+
+def test_memmapped_output(monkeypatch):
+    from PYME import config
+    from PYME.recipes.base import Scale
+    monkeypatch.setitem(config.config, 'recipes-filter_memmap_threshold_mb', 1e-3)
+    im = _image(n_chans=1)
+    
+    res = Scale(scale=2, processFramesIndividually=True).apply_simple(im)
+    
+    assert isinstance(res.data.wrapList[0].data, np.memmap)
+    assert np.allclose(res.data[:, :, :, 0].squeeze(), 2*im.data[:, :, :, 0].squeeze())
+
+
+def test_lazy_filter_chain(monkeypatch):
+    from PYME import config
+    from PYME.recipes.base import Scale, Subtract
+    from PYME.IO.DataSources import TransformDataSource
+    monkeypatch.setitem(config.config, 'recipes-lazy_filters', True)
+    im = _image()
+    
+    s1 = Scale(scale=2, processFramesIndividually=True)
+    scaled = s1.apply_simple(im)
+    res = Subtract(inputName0='a', inputName1='b', processFramesIndividually=True).apply(inputName0=scaled,
+                                                                                          inputName1=im)['filtered_image']
+    
+    assert isinstance(res.data, TransformDataSource.DataSource)
+    assert res.data.shape[:4] == im.data.shape[:4]
+    
+    #changing parameters after execution doesn't change the (lazily evaluated) output
+    s1.scale = 5
+    assert np.allclose(res.data[:, :, :, 1].squeeze(), im.data[:, :, :, 1].squeeze())
+    assert np.allclose(res.data.getSlice(25), im.data[:, :, 5, 1].squeeze())
+
+
+def test_transform_datasource_cache():
+    from PYME.IO.DataSources import TransformDataSource
+    im = _image(n_chans=1)
+    calls = []
+    
+    def _transform(frames, z, c):
+        calls.append(z)
+        return frames[0]*2
+    
+    frame_mb = 32*30*8/1e6
+    ds = TransformDataSource.DataSource([im.data], _transform, cache_size_mb=3.5*frame_mb)
+    
+    for i in [0, 1, 2, 0, 3, 4, 0, 1]:
+        ds.getSlice(i)
+    
+    assert calls == [0, 1, 2, 3, 4, 1]
+    assert not ds.getSlice(0).flags.writeable
+
+
+def test_depth_2_filter(monkeypatch):
+    from PYME import config
+    from PYME.recipes.base import Filter
+    
+    class _Split(Filter):
+        #returns two planes for each input frame
+        def applyFilter(self, data, chanNum, frNum, im):
+            return np.concatenate([data[:, :, None], -data[:, :, None]], 2)
+    
+    im = _image()
+    expected = np.zeros((32, 30, 40, 2))
+    for c in range(2):
+        expected[:, :, ::2, c] = im.data[:, :, :, c].squeeze()
+        expected[:, :, 1::2, c] = -im.data[:, :, :, c].squeeze()
+    
+    for lazy in [False, True]:
+        monkeypatch.setitem(config.config, 'recipes-lazy_filters', lazy)
+        res = _Split(processFramesIndividually=True).apply_simple(im)
+        
+        assert tuple(res.data.shape[:4]) == (32, 30, 40, 2)
+        for c in range(2):
+            assert np.allclose(res.data[:, :, :, c].squeeze(), expected[:, :, :, c], atol=1e-6)
@@ -0,0 +1,41 @@
+import json
+import numpy as np
+
+from PYME.recipes.base import ModuleCollection, ModuleBase
+from PYME.recipes.traits import Input, Output
+
+
+class _Double(ModuleBase):
+    input_name = Input('input')
+    output_name = Output('doubled')
+    
+    def execute(self, namespace):
+        namespace[self.output_name] = 2*namespace[self.input_name]
+
+
+def test_recipe_profile(tmpdir):
+    from PYME.recipes.profiling import RecipeProfiler
+    
+    recipe = ModuleCollection()
+    recipe.add_module(_Double(recipe, input_name='input', output_name='a'))
+    recipe.add_module(_Double(recipe, input_name='a', output_name='b'))
+    
+    recipe.profiler = RecipeProfiler()
+    try:
+        recipe.execute(input=np.ones(int(1e6)))
+    finally:
+        recipe.profiler.finish()
+    
+    records = recipe.profiler.report()['records']
+    assert [r['name'] for r in records] == ['_Double', '_Double']
+    assert records[0]['outputs'] == ['a']
+    assert records[1]['output_bytes'] == 8e6
+    assert all([r['wall_time'] >= 0 for r in records])
+    assert records[0]['peak_memory_delta'] >= 8e6
+    
+    stub = str(tmpdir.join('profile'))
+    recipe.profiler.save(stub)
+    with open(stub + '.json') as f:
+        assert len(json.load(f)['records']) == 2
+    with open(stub + '.txt') as f:
+        assert '_Double' in f.read()